@@ -1,6 +1,9 @@
 from flask import Flask, session
 from flask_mongoengine import MongoEngine
 from datetime import timedelta
+import os
+
+from app.mongo import mongo_settings_from_env, mongo_routes_from_env
 
 db = MongoEngine()  # declare globally so it can be imported in models.py later
 
@@ -11,11 +14,180 @@ def create_app():
     app.config['REMEMBER_COOKIE_DURATION'] = timedelta(days=7)
     app.config['REMEMBER_COOKIE_REFRESH_EACH_REQUEST'] = False
 
-    app.config['MONGODB_SETTINGS'] = {
-        'db': 'libraryDB',
-        'host': 'localhost',
-        'port': 27017
+    #Book listing page size (overridable per request with ?page_size=)
+    app.config['BOOKS_PAGE_SIZE'] = 24
+    app.config['BOOKS_MAX_PAGE_SIZE'] = 100
+
+    #My Loans page size (newest first, across the loans and loans_archive collections)
+    app.config['LOANS_PAGE_SIZE'] = 25
+
+    #MongoDB connection, pool, timeouts, read preference and write concern from
+    #MONGODB_* environment variables (localhost/libraryDB when none are set), and
+    #per-route read preference / write concern for catalogue, members and reports
+    app.config['MONGODB_SETTINGS'] = mongo_settings_from_env()
+    app.config['MONGODB_ROUTES'] = mongo_routes_from_env()
+
+    #Catalogue read-through cache: 'memory' (per worker), 'redis' (shared) or 'none'
+    app.config['CATALOGUE_CACHE_BACKEND'] = 'memory'
+    app.config['CATALOGUE_CACHE_SIZE'] = 1024
+    app.config['CATALOGUE_CACHE_TTL'] = 60
+    app.config['CATALOGUE_CACHE_URL'] = 'redis://localhost:6379/0'
+
+    #Cache-Control max-age (seconds) for catalogue pages served to anonymous users
+    app.config['HTTP_CACHE_MAX_AGE'] = 60
+
+    #Password hashing: Werkzeug method/cost, and the thread pool that runs it
+    app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+    app.config['PASSWORD_SALT_LENGTH'] = 16
+    app.config['PASSWORD_HASH_WORKERS'] = 4
+    app.config['PASSWORD_HASH_MAX_PENDING'] = 16
+    app.config['PASSWORD_HASH_WAIT'] = 5.0
+
+    #Token-bucket rate limits per endpoint: (requests, seconds) per client address ('ip') and
+    #per logged-in user ('user'), optionally for some methods only. Buckets are kept per worker
+    #('memory') or in Redis, shared by all workers ('redis'); 'none' turns the limits off
+    app.config['RATE_LIMIT_BACKEND'] = 'memory'
+    app.config['RATE_LIMIT_URL'] = 'redis://localhost:6379/0'
+    app.config['RATE_LIMIT_SIZE'] = 100000
+    app.config['RATE_LIMITS'] = {
+        'login': {'ip': (10, 60), 'methods': ('POST',)},
+        'register': {'ip': (5, 300), 'methods': ('POST',)},
+        'make_loan': {'user': (10, 60), 'ip': (30, 60)},
+        'make_loan_by_title': {'user': (10, 60), 'ip': (30, 60)},
+        'return_loan': {'user': (30, 60), 'ip': (60, 60)},
+        'renew_loan': {'user': (30, 60), 'ip': (60, 60)},
+        'delete_loan': {'user': (30, 60), 'ip': (60, 60)},
+        'return_loans': {'user': (10, 60), 'ip': (30, 60)},
+        'renew_loans': {'user': (10, 60), 'ip': (30, 60)},
     }
 
+    #Requests running at once per worker process; more are refused with 429 and Retry-After
+    #(seconds) instead of queueing (0 = no limit)
+    app.config['MAX_CONCURRENT_REQUESTS'] = 64
+    app.config['CONCURRENCY_RETRY_AFTER'] = 1
+
+    #Cached login principal (id, name, is_admin) per worker, instead of a User query per request
+    app.config['PRINCIPAL_CACHE_TTL'] = 30
+    app.config['PRINCIPAL_CACHE_SIZE'] = 10000
+
+    #In-process catalogue snapshot answering the book listing reads (see app.snapshot):
+    #seconds between catalogue version checks (other workers' writes) and before a full rebuild
+    app.config['CATALOGUE_SNAPSHOT'] = True
+    app.config['CATALOGUE_SNAPSHOT_POLL'] = 5
+    app.config['CATALOGUE_SNAPSHOT_MAX_AGE'] = 3600
+
+    #Seconds before the in-process search index is rebuilt to pick up other workers' writes
+    app.config['SEARCH_INDEX_MAX_AGE'] = 300
+
+    #Seconds between in-process overdue sweeps (0 = off; use `flask sweep-overdue` from cron)
+    app.config['OVERDUE_SWEEP_INTERVAL'] = 0
+
+    #Returned loans move to loans_archive after LOAN_ARCHIVE_AFTER_DAYS, so the loans collection
+    #stays small. Seconds between in-process runs (0 = off; use `flask archive-loans` from cron)
+    app.config['LOAN_ARCHIVE_AFTER_DAYS'] = 90
+    app.config['LOAN_ARCHIVE_BATCH_SIZE'] = 1000
+    app.config['LOAN_ARCHIVE_INTERVAL'] = 0
+
+    #Loan events outbox consumers (statistics, other workers' caches): 'thread' polls in each
+    #worker from its first request on (never in CLI commands), 'off' leaves them to a separate
+    #`flask consume-loan-events` process
+    app.config['LOAN_EVENTS_CONSUMERS'] = 'thread'
+    app.config['LOAN_EVENTS_POLL'] = 1.0
+    app.config['LOAN_EVENTS_BATCH_SIZE'] = 500
+    app.config['LOAN_EVENTS_SETTLE_SECONDS'] = 2.0
+    app.config['LOAN_EVENTS_LEASE_SECONDS'] = 30
+
+    #Index verification at startup: 'build' reports and builds missing indexes,
+    #'report' only logs them, 'off' skips the check. Off by default so worker boot
+    #does no database work; `flask bootstrap` builds the indexes once per deployment.
+    app.config['MONGODB_INDEX_CHECK'] = 'off'
+
+    #Per-request MongoDB query counts/time in response headers, and the slow-query log (0 = off)
+    app.config['QUERY_STATS_HEADERS'] = True
+    app.config['QUERY_STATS_DETAIL'] = False
+    app.config['SLOW_QUERY_MS'] = 100
+
+    #Prometheus metrics at /metrics. With several worker processes set a directory
+    #(emptied at server start) where each process keeps its values; None = this process only
+    app.config['METRICS_MULTIPROC_DIR'] = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+    #Rendered book cards cached per worker (0 = off), compiled templates kept in a
+    #bytecode cache (None = Jinja's temp directory) and all templates loaded at startup
+    app.config['FRAGMENT_CACHE_SIZE'] = 5000
+    app.config['TEMPLATE_BYTECODE_CACHE'] = True
+    app.config['TEMPLATE_BYTECODE_DIR'] = os.environ.get('TEMPLATE_BYTECODE_DIR')
+    app.config['TEMPLATE_PRELOAD'] = True
+
+    #Server-Timing entry with each page's template render time
+    app.config['RENDER_TIMING_HEADER'] = True
+
+    #Async serving mode (uvicorn app.asgi:application): requests running through the Flask
+    #app at once per worker, once they have fully arrived on the event loop
+    app.config['ASYNC_WSGI_THREADS'] = 8
+
+    #Flask-DebugToolbar with a MongoDB panel (needs the optional flask-debugtoolbar package)
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    # Extensions: each module keeps one instance at module level, like `db`, so models and
+    # views import it directly; init_app(app) below reads its settings from the config above
+    # and registers its hooks. The order matters where noted.
+
+    # Registered before db.init_app so the MongoDB client reports its commands and pool waits to them
+    from app.query_stats import query_stats
+    query_stats.init_app(app)
+
+    from app.metrics import metrics
+    metrics.init_app(app)
+
+    # After metrics, so refused requests are still timed and counted per status
+    from app.ratelimit import limiter
+    limiter.init_app(app)
+
     db.init_app(app)  
+
+    from app.mongo import routing
+    routing.init_app(app)
+
+    from app.cache import cache
+    cache.init_app(app)
+
+    from app.search import search_index
+    search_index.init_app(app)
+
+    from app.snapshot import catalogue_snapshot
+    catalogue_snapshot.init_app(app)
+
+    from app.fragments import fragments
+    fragments.init_app(app)
+
+    from app.principal import principals
+    principals.init_app(app)
+
+    from app.passwords import hasher
+    hasher.init_app(app)
+
+    from app.cli import register_commands
+    register_commands(app)
+
+    from app import overdue
+    overdue.init_app(app)
+
+    from app import archive
+    archive.init_app(app)
+
+    from app.outbox import outbox
+    outbox.init_app(app)
+
+    if app.config['DEBUG_TB_ENABLED']:
+        try:
+            from app import debug_panel
+        except ImportError:
+            app.logger.warning("DEBUG_TB_ENABLED is set but flask-debugtoolbar is not installed.")
+        else:
+            debug_panel.init_app(app)
+
+    if app.config['MONGODB_INDEX_CHECK'] != 'off':
+        from app.indexes import verify_indexes
+        verify_indexes(app, build=app.config['MONGODB_INDEX_CHECK'] == 'build')
+
     return app
@@ -1,13 +1,23 @@
 
-from flask import Flask, render_template, request, flash,redirect, url_for, session
+from flask import Flask, render_template, request, flash,redirect, url_for, session, jsonify, Response
 from app import create_app, db 
-from app.model import Book, User, Loan
+from app.cache import cache
+from app.search import search_index
+from app.principal import principals
+from app.passwords import PasswordHashingBusy
+from app.model import Book, User, Loan, LoanArchive, CatalogueVersion, CirculationStat, decode_cursor, decode_loan_cursor
+from app.http_cache import make_etag, conditional_page
+from app.metrics import metrics, LOGINS
 from app.forms import RegistrationForm, LoginForm, NewBookForm
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 
 import random
+import sys
+import time
 from datetime import datetime,timedelta
+
+_boot_started = time.perf_counter()
+
 # Create Flask app and initialize MongoDB
 app = create_app()
 
@@ -18,11 +28,11 @@ login_manager.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.objects(pk=user_id).first()
+    # Slim cached principal (id, name, is_admin) instead of a User query per request
+    return principals.load(user_id)
 
-# Ensure Book collection is populated when app starts
-with app.app_context():
-    Book.initialize_collection()
+# Seeding the Book collection and building indexes is done once per deployment
+# with `flask bootstrap` (see app/cli.py), so worker startup does no database work.
 
 #Code to clear db - for testing purposes only
 # @app.route("/clear_db")
@@ -41,35 +51,110 @@ def book_titles():
     # Get selected category from dropdown
     current_category = request.args.get('category', 'All')
 
-    # Use the database method. This method should handle filtering AND sorting.
-    # We will update Book.find_by_category to handle sorting.
-    filtered_books = Book.find_by_category(current_category) 
-    
-    # REMOVE: Python-based sorting is no longer necessary if DB does it.
-    # sorted_books = filtered_books 
-
-    return render_template(
-        'book_titles.html',
-        # Pass the already sorted results
-        all_books=filtered_books, 
-        current_category=current_category 
-    )
+    # Page size from the query string, clamped to the configured maximum
+    page_size = request.args.get('page_size', app.config['BOOKS_PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, app.config['BOOKS_MAX_PAGE_SIZE']))
+
+    # Keyset cursor of the last book on the previous page (absent on the first page)
+    after = request.args.get('after')
+
+    if after:
+        try:
+            decode_cursor(after)
+        except ValueError as e:
+            return str(e), 400
+
+    # Validators come from the catalogue version, so a 304 needs neither the books nor a render
+    version, last_modified = CatalogueVersion.current(current_category)
+    etag = make_etag('book_titles', current_category, version, after, page_size)
+
+    def render():
+        # Sorted by (title, _id), card fields only: from the catalogue snapshot, or filtered by the database
+        books, next_cursor = Book.get_page(current_category, after=after, page_size=page_size)
+        return render_template(
+            'book_titles.html',
+            all_books=books,
+            total_books=Book.count_by_category(current_category),
+            current_category=current_category,
+            page_size=page_size,
+            after=after,
+            next_cursor=next_cursor
+        )
+
+    return conditional_page(etag, last_modified, render)
 
 # ----------------------------------------------------------------------------------
 # --- FEATURE 2: Book Details Page (Retrieval) ---
 # ----------------------------------------------------------------------------------
+@app.route('/book/<slug>')
+def book_details(slug):
+    # Point read on the unique slug index
+    the_book = Book.find_by_slug(slug)
+
+    if not the_book:
+        return "Book not found", 404
+
+    etag = make_etag('book_details', the_book.id, the_book.updatedAt, the_book.available)
+    return conditional_page(
+        etag, the_book.updatedAt,
+        lambda: render_template('book_details.html', book=the_book)
+    )
+
 @app.route('/book_details/<book_title>')
-def book_details(book_title):
-    # Use MongoDB method to find book by title
+def book_details_by_title(book_title):
+    # Old title-based URL: redirect permanently to the slug URL
     the_book = Book.find_by_title(book_title)
 
     if not the_book:
         return "Book not found", 404
 
-    return render_template(
-        'book_details.html',
-        book=the_book
-    )
+    return redirect(url_for('book_details', slug=the_book.slug), code=301)
+
+# ----------------------------------------------------------------------------------
+# --- FEATURE 3: Catalogue Search API ---
+# ----------------------------------------------------------------------------------
+@app.route('/search')
+def search():
+    """Ranked full-text search over title, authors, genres and description, with facets."""
+    query = request.args.get('q', '').strip()
+    category = request.args.get('category') or None
+    genre = request.args.get('genre') or None
+    limit = max(1, min(request.args.get('limit', 20, type=int), app.config['BOOKS_MAX_PAGE_SIZE']))
+
+    found = search_index.search(query, category=category, genre=genre, limit=limit)
+
+    # Ranked ids come from memory; the card fields (incl. live availability) in one $in query
+    scores = dict(found['results'])
+    books = Book.get_listing_by_ids([book_id for book_id, _ in found['results']])
+
+    return jsonify({
+        'query': query,
+        'total': found['total'],
+        'facets': found['facets'],
+        'results': [
+            {
+                'id': str(book['_id']),
+                'title': book['title'],
+                'slug': book.get('slug'),
+                'authors': book.get('authors', []),
+                'category': book.get('category'),
+                'genres': book.get('genres', []),
+                'url': book.get('url'),
+                'available': book.get('available', 0),
+                'score': round(scores[book['_id']], 4),
+            }
+            for book in books
+        ],
+    })
+
+
+@app.route('/search/suggest')
+def search_suggest():
+    """Typeahead: best-matching titles for a partial query."""
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    return jsonify(search_index.suggest(query, limit=limit))
+
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -84,7 +169,11 @@ def register():
             email=form.email.data,
             name=form.name.data
         )
-        new_user.set_password(form.password.data)
+        try:
+            new_user.set_password(form.password.data)
+        except PasswordHashingBusy as e:
+            flash(str(e), "warning")
+            return render_template("register.html", form=form), 503
         new_user.save()
         return redirect(url_for('login'))
 
@@ -98,13 +187,24 @@ def login():
     if form.validate_on_submit():
         user = User.objects(email=form.email.data).first()
         if not user:
+            LOGINS.inc(outcome='unknown_email')
             flash("Email not registered!", "danger")
             return render_template("login.html", form=form)
         
-        if not user.check_password(form.password.data):
+        # Verified on the bounded hashing pool; outdated hashes are upgraded on success
+        try:
+            password_ok = user.verify_password(form.password.data)
+        except PasswordHashingBusy as e:
+            LOGINS.inc(outcome='busy')
+            flash(str(e), "warning")
+            return render_template("login.html", form=form), 503
+
+        if not password_ok:
+            LOGINS.inc(outcome='wrong_password')
             flash("Incorrect password!", "danger")
             return render_template("login.html", form=form)
         
+        LOGINS.inc(outcome='success')
         login_user(user, remember=form.remember.data)
         return redirect(url_for('book_titles'))
 
@@ -160,7 +260,17 @@ def add_book():
     return render_template('add_book.html', form=form)
 
 @app.route('/make_loan/<book_title>')
-def make_loan(book_title):
+def make_loan_by_title(book_title):
+    # Old title-based URL: redirect to the slug URL
+    book = Book.find_by_title(book_title)
+    if not book:
+        flash(f"Book '{book_title}' not found.", "danger")
+        return redirect(url_for('book_titles'))
+
+    return redirect(url_for('make_loan', slug=book.slug))
+
+@app.route('/book/<slug>/loan')
+def make_loan(slug):
     if not current_user.is_authenticated:
         flash("Please login or register first to get an account", "warning")
         return redirect(url_for('login'))
@@ -169,27 +279,19 @@ def make_loan(book_title):
         flash("Admins cannot borrow books.", "warning")
         return redirect(url_for('book_titles'))
 
-    book = Book.find_by_title(book_title)
+    book = Book.find_by_slug(slug)
     if not book:
-        flash(f"Book '{book_title}' not found.", "danger")
-        return redirect(url_for('book_titles'))
-
-    # Check if user already has unreturned loan for this book
-    existing_loan = Loan.objects(member=current_user._get_current_object(), book=book, returnDate=None).first()
-    if existing_loan:
-        flash(f"You already have an unreturned loan for '{book.title}'.", "warning")
+        flash("Book not found.", "danger")
         return redirect(url_for('book_titles'))
 
-    if book.available <= 0:
-        flash(f"'{book.title}' is currently not available for loan.", "danger")
-        return redirect(url_for('book_titles'))
+    # Duplicate-loan and availability checks happen atomically inside Loan.create_loan
 
     # Random borrow date 10–20 days ago
     days_ago = random.randint(10, 20)
     borrow_date = datetime.utcnow() - timedelta(days=days_ago)
 
     try:
-        loan = Loan.create_loan(current_user._get_current_object(), book, borrow_date=borrow_date)
+        loan = Loan.create_loan(current_user, book, borrow_date=borrow_date)
         flash(f"Loan successful! You borrowed '{book.title}'. Due date: {loan.dueDate.strftime('%Y-%m-%d')}", "success")
     except ValueError as e:
         flash(str(e), "danger")
@@ -203,15 +305,26 @@ def view_loans():
         flash("Admins cannot have loans.", "warning")
         return redirect(url_for('book_titles'))
 
-    loans = Loan.get_member_loans(current_user._get_current_object())
-    return render_template('view_loans.html', loans=loans, now=datetime.utcnow())
+    # Keyset cursor of the last loan on the previous page (absent on the first page)
+    after = request.args.get('after')
+    if after:
+        try:
+            decode_loan_cursor(after)
+        except ValueError as e:
+            return str(e), 400
+
+    # One page across both tiers (loans, loans_archive) and its books, in three queries
+    loans, next_cursor = Loan.get_member_history(current_user, after=after,
+                                                 page_size=app.config['LOANS_PAGE_SIZE'])
+    return render_template('view_loans.html', loans=loans, now=datetime.utcnow(),
+                           after=after, next_cursor=next_cursor)
 
 @app.route('/return_loan/<loan_id>', methods=['POST'])
 @login_required
 def return_loan(loan_id):
     """Handle returning a borrowed book."""
     try:
-        loan = Loan.objects.get(id=loan_id, member=current_user)
+        loan = Loan.objects.get(id=loan_id, member=current_user.pk)
         loan.return_loan()
         flash(f"You have successfully returned '{loan.book.title}'.", "success")
     except Loan.DoesNotExist:
@@ -222,6 +335,50 @@ def return_loan(loan_id):
     return redirect(url_for('view_loans'))
 
 
+def flash_outcomes(outcomes, action):
+    """One success flash for the loans that went through, one danger flash per failure."""
+    done = [o.title for o in outcomes if o.ok]
+    if done:
+        flash(f"{action} {len(done)} loan(s): " + ", ".join(f"'{title}'" for title in done), "success")
+    for outcome in outcomes:
+        if not outcome.ok:
+            flash(f"{outcome.title or 'Loan'}: {outcome.message}", "danger")
+
+
+@app.route('/return_loans', methods=['POST'])
+@login_required
+def return_loans():
+    """Return every selected loan in one request (constant number of database round trips)."""
+    if current_user.is_admin:
+        flash("Admins cannot return loans.", "warning")
+        return redirect(url_for('book_titles'))
+
+    loan_ids = request.form.getlist('loan_ids')
+    if not loan_ids:
+        flash("No loans selected.", "warning")
+        return redirect(url_for('view_loans'))
+
+    flash_outcomes(Loan.return_many(current_user, loan_ids), "Returned")
+    return redirect(url_for('view_loans'))
+
+
+@app.route('/renew_loans', methods=['POST'])
+@login_required
+def renew_loans():
+    """Renew every selected loan in one request (constant number of database round trips)."""
+    if current_user.is_admin:
+        flash("Admins cannot renew loans.", "warning")
+        return redirect(url_for('book_titles'))
+
+    loan_ids = request.form.getlist('loan_ids')
+    if not loan_ids:
+        flash("No loans selected.", "warning")
+        return redirect(url_for('view_loans'))
+
+    flash_outcomes(Loan.renew_many(current_user, loan_ids), "Renewed")
+    return redirect(url_for('view_loans'))
+
+
 @app.route('/renew_loan/<loan_id>', methods=['POST'])
 @login_required
 def renew_loan(loan_id):
@@ -230,7 +387,7 @@ def renew_loan(loan_id):
         flash("Admins cannot renew loans.", "warning")
         return redirect(url_for('book_titles'))
 
-    loan = Loan.objects(id=loan_id, member=current_user._get_current_object()).first()
+    loan = Loan.objects(id=loan_id, member=current_user.pk).first()
     if not loan:
         flash("Loan not found or unauthorized.", "danger")
         return redirect(url_for('view_loans'))
@@ -252,14 +409,15 @@ def delete_loan(loan_id):
         flash("Admins cannot delete loans.", "warning")
         return redirect(url_for('book_titles'))
 
-    # Fetch loan belonging to the current user
-    loan = Loan.objects(id=loan_id, member=current_user._get_current_object()).first()
+    # Fetch loan belonging to the current user (loans returned long ago are in the archive)
+    loan = (Loan.objects(id=loan_id, member=current_user.pk).first()
+            or LoanArchive.objects(id=loan_id, member=current_user.pk).first())
     if not loan:
         flash("Loan not found or unauthorized.", "danger")
         return redirect(url_for('view_loans'))
 
     try:
-        # Use the Loan model method
+        # Use the Loan (or LoanArchive) model method
         loan.delete_loan()
         flash(f"Loan for '{loan.book.title}' has been deleted.", "success")
     except ValueError as e:
@@ -268,5 +426,60 @@ def delete_loan(loan_id):
     return redirect(url_for('view_loans'))
 
 
+@app.route('/admin/cache_stats')
+@login_required
+def cache_stats():
+    """Catalogue cache hit/miss counters for this worker (admins only)."""
+    if not current_user.is_admin:
+        return "Forbidden", 403
+    return jsonify(cache.stats())
+
+
+@app.route('/admin/overdue')
+@login_required
+def overdue_report():
+    """Overdue loans per member and per book, from the sweeper's materialised state (admins only)."""
+    if not current_user.is_admin:
+        flash("Only admins can view the overdue report.", "warning")
+        return redirect(url_for('book_titles'))
+
+    return render_template('overdue_report.html', report=Loan.overdue_report())
+
+
+@app.route('/admin/stats')
+@login_required
+def circulation_stats():
+    """Circulation counters: total, per category and genre, top books, last 30 days (admins only)."""
+    if not current_user.is_admin:
+        return "Forbidden", 403
+
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 100)
+    except ValueError:
+        return "Invalid limit", 400
+    today = datetime.utcnow().date()
+    return jsonify({
+        'total': CirculationStat.get('total', 'all'),
+        'categories': CirculationStat.top('category', limit=None),
+        'genres': CirculationStat.top('genre', limit=None),
+        'books': CirculationStat.top('book', limit=limit),
+        'days': CirculationStat.days(today - timedelta(days=29), today),
+    })
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint (all worker processes when METRICS_MULTIPROC_DIR is set)."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Startup-time report: how long building the app took and what it had to import
+app.extensions['startup_report'] = {
+    'seconds': time.perf_counter() - _boot_started,
+    'app_modules': sorted(name for name in sys.modules if name == 'app' or name.startswith('app.')),
+}
+app.logger.info("App ready in %.1f ms", app.extensions['startup_report']['seconds'] * 1000)
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""
+Background archiving of returned loans.
+
+Loan.archive_returned() moves loans returned more than LOAN_ARCHIVE_AFTER_DAYS ago
+from `loans` to `loans_archive`, LOAN_ARCHIVE_BATCH_SIZE at a time, so the loans
+collection and its indexes hold active and recent loans only and stay in memory.
+The My Loans page reads both (Loan.get_member_history). It can run:
+
+    - from cron, with `flask archive-loans`, or
+    - in-process, every LOAN_ARCHIVE_INTERVAL seconds (see app.periodic).
+
+Overlapping runs from several workers copy the same loans with idempotent upserts
+and only one of them deletes each loan, so they are harmless.
+"""
+from datetime import timedelta
+
+from flask import current_app
+
+from app.periodic import PeriodicTask
+
+
+def archive_age(app):
+    """How long a returned loan stays in `loans`, from LOAN_ARCHIVE_AFTER_DAYS."""
+    return timedelta(days=app.config.get('LOAN_ARCHIVE_AFTER_DAYS', 90))
+
+
+def archive():
+    """One run of the in-process archiver; a half-done batch is completed by the next one."""
+    from app.model import Loan
+
+    moved = Loan.archive_returned(archive_age(current_app),
+                                  batch_size=current_app.config.get('LOAN_ARCHIVE_BATCH_SIZE', 1000))
+    if moved:
+        current_app.logger.info("Archived %d returned loan(s).", moved)
+
+
+def init_app(app):
+    """Start the in-process archiver if LOAN_ARCHIVE_INTERVAL is set."""
+    interval = app.config.get('LOAN_ARCHIVE_INTERVAL', 0)
+    if interval:
+        app.extensions['loan_archiver'] = PeriodicTask(app, interval, 'loan-archiver', archive).start()
@@ -0,0 +1,74 @@
+"""
+Async serving mode: the Flask app as an ASGI application.
+
+    pip install uvicorn "flask[async]"
+    uvicorn app.asgi:application --host 0.0.0.0 --port 5000 --workers 4
+
+Connections and request bodies are handled on the event loop, so a slow client
+still sending its request holds no thread: one process can keep thousands of
+such connections open. Once a request has fully arrived it runs through the
+Flask app (the same views, URL map, templates, models and session as under a
+WSGI server) with asgiref's WsgiToAsgi, on one of at most ASYNC_WSGI_THREADS
+threads at a time. bench/async_vs_wsgi.py compares the two modes.
+"""
+import asyncio
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from app.app import app
+
+
+async def read_body(receive):
+    """The whole request body, or None if the client went away before sending it."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+class AsyncServer:
+    """ASGI application: reads each request on the event loop, then runs it through the WSGI app on a thread."""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.threads = flask_app.config.get('ASYNC_WSGI_THREADS', 8)
+        self._slots = None  # asyncio.Semaphore, created in the worker's event loop
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+        # Before taking a thread: a slow client only holds this task
+        body = await read_body(receive)
+        if body is None:
+            return
+
+        async def received():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.threads)
+        async with self._slots:
+            # A thread of its own for this request; WsgiToAsgi alone runs every request on one shared thread
+            async with ThreadSensitiveContext():
+                await self.wsgi(scope, received, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = AsyncServer(app)
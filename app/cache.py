@@ -0,0 +1,197 @@
+"""
+Read-through cache for catalogue queries (book listing pages, counts, title/slug lookups).
+
+Configured in create_app():
+
+    CATALOGUE_CACHE_BACKEND  'memory' (per-process LRU + TTL), 'redis' (shared) or 'none'
+    CATALOGUE_CACHE_SIZE     max entries for the memory backend
+    CATALOGUE_CACHE_TTL      seconds an entry may be served
+    CATALOGUE_CACHE_URL      redis:// URL for the shared backend (needs the `redis` package)
+
+Listing keys carry a per-category generation number ('All' is its own category).
+A write to a book bumps the generation of its category and of 'All', and deletes
+its title and slug keys, so only the affected entries stop being served.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from app.metrics import CACHE_LOOKUPS
+
+
+class MemoryBackend:
+    """In-process LRU store with a per-entry TTL."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+
+    # Generations live outside the LRU so eviction can never reset them
+    def generation(self, scope):
+        return self._generations.get(scope, 0)
+
+    def bump(self, scope):
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+
+class RedisBackend:
+    """Shared store so every worker process sees the same entries and invalidations."""
+
+    def __init__(self, url, ttl=60, prefix="catalogue:"):
+        import redis  # optional dependency, only needed for the shared backend
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+    def generation(self, scope):
+        return int(self.client.get(self.prefix + "gen:" + scope) or 0)
+
+    def bump(self, scope):
+        self.client.incr(self.prefix + "gen:" + scope)
+
+
+class CatalogueCache:
+    """
+    Read-through cache used by the Book query methods.
+    With no backend configured every call goes straight to the loader.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        backend = app.config.get('CATALOGUE_CACHE_BACKEND', 'memory')
+        ttl = app.config.get('CATALOGUE_CACHE_TTL', 60)
+
+        if backend == 'memory':
+            self.backend = MemoryBackend(app.config.get('CATALOGUE_CACHE_SIZE', 1024), ttl)
+        elif backend == 'redis':
+            self.backend = RedisBackend(app.config['CATALOGUE_CACHE_URL'], ttl)
+        elif backend == 'none':
+            self.backend = None
+        else:
+            raise ValueError(f"Unknown CATALOGUE_CACHE_BACKEND '{backend}'.")
+
+    # ----------------------------
+    # Reads
+    # ----------------------------
+    def listing(self, category, parts, loader):
+        """Cache a listing-style result (page, count, full list) of one category."""
+        if self.backend is None:
+            return loader()
+        return self._get_or_load(self._listing_key(category, parts), loader)
+
+    def title(self, title, loader):
+        """Cache a single-book lookup by title."""
+        if self.backend is None:
+            return loader()
+        return self._get_or_load("title:" + title, loader)
+
+    def slug(self, slug, loader):
+        """Cache a single-book lookup by slug."""
+        if self.backend is None:
+            return loader()
+        return self._get_or_load("slug:" + slug, loader)
+
+    def _listing_key(self, category, parts):
+        return ":".join(["list", category, str(self.backend.generation(category))] + [str(p) for p in parts])
+
+    def _get_or_load(self, key, loader):
+        value = self._lookup(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.backend.set(key, value)
+        return value
+
+    def _lookup(self, key):
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result='hit')
+        else:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result='miss')
+        return value
+
+    # ----------------------------
+    # Invalidation
+    # ----------------------------
+    def invalidate_book(self, title, category, slug=None):
+        """Drop everything that may show this book: its title/slug entries and its category's listings."""
+        if self.backend is None:
+            return
+        self.invalidations += 1
+        self.backend.delete("title:" + title)
+        if slug:
+            self.backend.delete("slug:" + slug)
+        self.backend.bump(category)
+        self.backend.bump("All")
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        """Hit/miss counters for this process."""
+        total = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+cache = CatalogueCache()
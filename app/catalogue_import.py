@@ -0,0 +1,198 @@
+"""
+Streaming bulk import of books from JSON Lines or CSV files.
+
+Rows are read one at a time, validated against the Book schema and written in
+fixed-size batches with a single unordered bulk_write each, so memory use depends
+on the batch size only, never on the file size.
+
+CSV files need a header row with the Book field names. List fields (genres,
+authors, description) hold their items separated by '|'.
+"""
+import csv
+import json
+import time
+from datetime import datetime
+from itertools import islice
+
+from mongoengine import ValidationError, FieldDoesNotExist
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.cache import cache
+from app.search import search_index
+from app.snapshot import catalogue_snapshot
+from app.model import Book, CatalogueVersion, slugify
+
+LIST_FIELDS = ('genres', 'authors', 'description')
+MAX_REJECTS_KEPT = 100  # rejected rows kept for the report; the rest are only counted
+
+
+class ImportReport:
+    """Counters collected while importing."""
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self.rejects = []  # (row number, reason), capped at MAX_REJECTS_KEPT
+        self.categories = set()  # categories touched, for the catalogue version bump
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def reject(self, row_number, reason):
+        self.rejected += 1
+        if len(self.rejects) < MAX_REJECTS_KEPT:
+            self.rejects.append((row_number, reason))
+
+    @property
+    def rows_per_second(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (f"Read {self.read} rows in {self.elapsed:.2f}s ({self.rows_per_second:.0f} rows/s): "
+                f"{self.inserted} inserted, {self.updated} updated, {self.rejected} rejected.")
+
+
+# ----------------------------
+# Reading
+# ----------------------------
+def read_jsonl(path):
+    """
+    Yield one dict per non-empty line of a JSON Lines file.
+    A line that is not valid JSON is yielded as its ValueError, to be rejected.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield e
+
+
+def read_csv(path):
+    """Yield one dict per CSV row, splitting list fields (numbers are converted by the schema)."""
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            for field in LIST_FIELDS:
+                if row.get(field):
+                    row[field] = [item.strip() for item in row[field].split('|') if item.strip()]
+            yield {key: value for key, value in row.items() if value not in (None, '')}
+
+
+def read_rows(path):
+    """Pick a reader from the file extension (.csv, otherwise JSON Lines)."""
+    return read_csv(path) if path.lower().endswith('.csv') else read_jsonl(path)
+
+
+# ----------------------------
+# Validation and writing
+# ----------------------------
+def to_document(row):
+    """
+    Validate a row against the Book schema and return its MongoDB representation.
+    Raises ValidationError (or ValueError/TypeError for malformed rows).
+    """
+    if isinstance(row, Exception):
+        raise ValueError(f"Unreadable row: {row}")
+    if not isinstance(row, dict):
+        raise ValueError("Row is not an object.")
+    row = dict(row)
+    row.setdefault('available', row.get('copies', 0))
+    book = Book(**row)
+    book.validate()
+    doc = book.to_mongo().to_dict()
+    doc.pop('_id', None)
+    doc.setdefault('slug', slugify(doc['title']))
+    doc['updatedAt'] = datetime.utcnow()
+    return doc
+
+
+def upsert_request(doc):
+    """
+    Update pipeline inserting a book or updating the one with its slug (the unique key).
+    A new book gets the row's `available`; an existing one keeps its loans: its available
+    count moves by the change in copies, within 0..copies.
+    """
+    doc = dict(doc)
+    slug, available = doc.pop('slug'), doc.pop('available')
+    # $literal: a title such as "$100 Startup" is a value, not a field path
+    fields = {key: {'$literal': value} for key, value in doc.items()}
+    # On insert there are no old counts: they default to the row's, so nothing moves
+    old_available = {'$ifNull': ['$available', available]}
+    moved = {'$subtract': [doc['copies'], {'$ifNull': ['$copies', doc['copies']]}]}
+    fields['available'] = {'$min': [doc['copies'], {'$max': [0, {'$add': [old_available, moved]}]}]}
+    return UpdateOne({'slug': slug}, [{'$set': fields}], upsert=True)
+
+
+def _write_batch(collection, docs, row_numbers, mode, report):
+    """Write one batch with a single unordered bulk_write; row_numbers[i] is the row of docs[i]."""
+    if mode == 'insert':
+        requests = [InsertOne(doc) for doc in docs]
+    else:
+        requests = [upsert_request(doc) for doc in docs]
+
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+        report.inserted += result.inserted_count + result.upserted_count
+        report.updated += result.modified_count
+    except BulkWriteError as e:
+        details = e.details
+        report.inserted += details.get('nInserted', 0) + details.get('nUpserted', 0)
+        report.updated += details.get('nModified', 0)
+        for error in details.get('writeErrors', []):
+            # `index` is the failed request's position in the batch
+            report.reject(row_numbers[error['index']], error.get('errmsg', 'write error'))
+
+
+def import_rows(rows, mode='upsert', batch_size=1000):
+    """
+    Validate and write an iterable of book dicts in batches.
+    mode: 'upsert' (insert or update by slug, given or made from the title) or
+    'insert' (plain inserts, for seeding).
+    Returns an ImportReport.
+    """
+    if mode not in ('upsert', 'insert'):
+        raise ValueError(f"Unknown import mode '{mode}'.")
+
+    collection = Book._get_collection()
+    report = ImportReport()
+    rows = iter(rows)
+    row_number = 0
+
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+
+        docs, row_numbers = [], []
+        for row in chunk:
+            row_number += 1
+            report.read += 1
+            try:
+                doc = to_document(row)
+                docs.append(doc)
+                row_numbers.append(row_number)
+                report.categories.add(doc['category'])
+            except (ValidationError, FieldDoesNotExist, ValueError, TypeError) as e:
+                report.reject(row_number, str(e))
+
+        if docs:
+            _write_batch(collection, docs, row_numbers, mode, report)
+
+    # Listings, lookups and the search index may all have changed
+    cache.clear()
+    search_index.invalidate()
+    catalogue_snapshot.invalidate()
+    if report.categories:
+        CatalogueVersion.bump(report.categories)
+
+    report.elapsed = time.perf_counter() - report.started
+    return report
+
+
+def import_file(path, mode='upsert', batch_size=1000):
+    """Stream a JSON Lines or CSV file into the books collection."""
+    return import_rows(read_rows(path), mode=mode, batch_size=batch_size)
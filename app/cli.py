@@ -0,0 +1,134 @@
+"""
+Flask CLI commands, registered on the app in create_app().
+
+    flask bootstrap                   once per deployment: build indexes, seed the catalogue
+    flask import-books catalogue.jsonl --batch-size 1000 --mode upsert
+    flask startup-report              how long app startup took and what it imported
+    flask sweep-overdue               mark loans past their due date as overdue (for cron)
+    flask archive-loans               move old returned loans to loans_archive (for cron)
+    flask rebuild-stats               recompute the circulation counters from loan history
+    flask consume-loan-events         run the loan event consumers (with LOAN_EVENTS_CONSUMERS='off')
+    flask replay-loan-events          re-run stored loan events through replayable consumers, ignoring checkpoints
+    flask compile-templates           fill the template bytecode cache (at deployment)
+"""
+import click
+from flask import current_app
+
+
+def register_commands(app):
+    """Attach the project's commands to app.cli."""
+
+    @app.cli.command('bootstrap')
+    @click.option('--skip-seed', is_flag=True, help='Only build indexes, do not seed the catalogue.')
+    def bootstrap(skip_seed):
+        """Build missing indexes and seed an empty catalogue (run once per deployment)."""
+        from app.indexes import verify_indexes
+        from app.model import Book
+
+        click.echo("Building missing indexes...")
+        verify_indexes(current_app, build=True, background=False)
+
+        if not skip_seed:
+            Book.initialize_collection()
+        click.echo("Bootstrap complete.")
+
+    @app.cli.command('startup-report')
+    def startup_report():
+        """Show how long app startup took and which app modules it imported."""
+        report = current_app.extensions.get('startup_report')
+        if report is None:
+            click.echo("No startup report (the app was not created through app/app.py).")
+            return
+        click.echo(f"Startup time: {report['seconds'] * 1000:.1f} ms")
+        click.echo("App modules loaded: " + ", ".join(report['app_modules']))
+
+    @app.cli.command('import-books')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', default=1000, show_default=True, help='Rows per bulk write.')
+    @click.option('--mode', type=click.Choice(['upsert', 'insert']), default='upsert', show_default=True,
+                  help="'upsert' inserts or updates by slug; 'insert' only inserts (fresh seed).")
+    def import_books(path, batch_size, mode):
+        """Stream a JSON Lines (.jsonl) or CSV (.csv) catalogue into the books collection."""
+        from app.catalogue_import import import_file
+
+        report = import_file(path, mode=mode, batch_size=batch_size)
+        click.echo(report.summary())
+        for row_number, reason in report.rejects:
+            click.echo(f"  rejected row {row_number if row_number is not None else '?'}: {reason}")
+        if report.rejected > len(report.rejects):
+            click.echo(f"  ... and {report.rejected - len(report.rejects)} more rejected rows")
+
+    @app.cli.command('sweep-overdue')
+    def sweep_overdue():
+        """Mark active loans past their due date as overdue (run from cron)."""
+        from app.model import Loan
+
+        click.echo(f"Marked {Loan.sweep_overdue()} loan(s) overdue.")
+
+    @app.cli.command('archive-loans')
+    @click.option('--older-than-days', type=int, help='Default: LOAN_ARCHIVE_AFTER_DAYS.')
+    @click.option('--batch-size', type=int, help='Loans per batch. Default: LOAN_ARCHIVE_BATCH_SIZE.')
+    def archive_loans(older_than_days, batch_size):
+        """Move loans returned long ago from loans to loans_archive (run from cron)."""
+        from datetime import timedelta
+        from app.archive import archive_age
+        from app.model import Loan
+
+        older_than = timedelta(days=older_than_days) if older_than_days is not None else archive_age(current_app)
+        moved = Loan.archive_returned(older_than, batch_size=batch_size or current_app.config['LOAN_ARCHIVE_BATCH_SIZE'])
+        click.echo(f"Archived {moved} loan(s).")
+
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats():
+        """Recompute the circulation statistics from the loans and loans_archive collections."""
+        from app.model import CirculationStat
+        from app.outbox import outbox
+
+        # The rebuild covers every loan so far, so the stats consumer skips the events written until now
+        outbox.seek('stats')
+        click.echo(f"Rebuilt {CirculationStat.rebuild()} stats document(s).")
+
+    @app.cli.command('consume-loan-events')
+    @click.option('--once', is_flag=True, help='Catch up once and exit instead of polling.')
+    @click.option('--consumer', 'names', multiple=True, help='Only these consumers (repeatable).')
+    def consume_loan_events(once, names):
+        """Run the loan event consumers in this process."""
+        import time
+        from app.outbox import outbox
+
+        while True:
+            handled = outbox.drain(names)
+            if once:
+                for name, count in handled.items():
+                    click.echo(f"{name}: {count} event(s)")
+                return
+            time.sleep(outbox.poll)
+
+    @app.cli.command('replay-loan-events')
+    @click.option('--consumer', 'names', multiple=True, help='Only these consumers (repeatable).')
+    @click.option('--since', type=click.DateTime(), help='First event time (UTC).')
+    @click.option('--until', type=click.DateTime(), help='Stop before this time (UTC).')
+    def replay_loan_events(names, since, until):
+        """Run stored loan events through consumers again, without touching their checkpoints."""
+        from app.outbox import outbox
+
+        try:
+            handled = outbox.replay(names or None, since=since, until=until)
+        except ValueError as e:
+            raise click.UsageError(f"{e} Use `flask rebuild-stats` for the statistics.")
+        for name, count in handled.items():
+            click.echo(f"{name}: {count} event(s)")
+
+    @app.cli.command('compile-templates')
+    def compile_templates():
+        """Compile every template into the bytecode cache, so workers start without parsing any."""
+        from app.fragments import preload_templates
+
+        if current_app.jinja_env.bytecode_cache is None:
+            click.echo("TEMPLATE_BYTECODE_CACHE is off; nothing to fill.")
+            return
+        # Start from scratch: create_app() may have loaded templates from an older cache
+        current_app.jinja_env.cache.clear()
+        current_app.jinja_env.bytecode_cache.clear()
+        count, seconds = preload_templates(current_app)
+        click.echo(f"Compiled {count} template(s) in {seconds * 1000:.1f} ms.")
@@ -0,0 +1,78 @@
+"""
+Flask-DebugToolbar panel listing the MongoDB commands of the current request.
+
+Needs the optional flask-debugtoolbar package. create_app() adds this panel to
+DEBUG_TB_PANELS and turns on QUERY_STATS_DETAIL when DEBUG_TB_ENABLED is set.
+"""
+import json
+
+from flask_debugtoolbar import DebugToolbarExtension
+from flask_debugtoolbar.panels import DebugPanel
+from markupsafe import escape
+
+from app.query_stats import query_stats
+
+# Flask-DebugToolbar's own panels, minus SQLAlchemy (this app uses MongoDB)
+DEFAULT_PANELS = [
+    'flask_debugtoolbar.panels.versions.VersionDebugPanel',
+    'flask_debugtoolbar.panels.timer.TimerDebugPanel',
+    'flask_debugtoolbar.panels.headers.HeaderDebugPanel',
+    'flask_debugtoolbar.panels.request_vars.RequestVarsDebugPanel',
+    'flask_debugtoolbar.panels.config_vars.ConfigVarsDebugPanel',
+    'flask_debugtoolbar.panels.template.TemplateDebugPanel',
+    'flask_debugtoolbar.panels.logger.LoggingPanel',
+    'flask_debugtoolbar.panels.route_list.RouteListDebugPanel',
+    'flask_debugtoolbar.panels.profiler.ProfilerDebugPanel',
+    'flask_debugtoolbar.panels.g.GDebugPanel',
+]
+
+
+class QueryStatsPanel(DebugPanel):
+    name = 'MongoDB'
+    has_content = True
+
+    def __init__(self, jinja_env, context=None):
+        super().__init__(jinja_env, context)
+        self.queries = None
+
+    def process_response(self, request, response):
+        self.queries = query_stats.current()
+
+    def nav_title(self):
+        return 'MongoDB'
+
+    def nav_subtitle(self):
+        if self.queries is None:
+            return ''
+        return f"{self.queries.count} queries in {self.queries.ms:.1f} ms"
+
+    def title(self):
+        return 'MongoDB commands'
+
+    def url(self):
+        return ''
+
+    def content(self):
+        if self.queries is None or not self.queries.commands:
+            return '<p>No MongoDB commands were sent for this request.</p>'
+        rows = "".join(
+            f"<tr><td>{escape(name)}</td><td>{escape(collection)}</td><td>{ms:.2f}</td>"
+            f"<td>{documents}</td><td><code>{escape(json.dumps(shape, default=str))}</code></td></tr>"
+            for name, collection, shape, ms, documents in self.queries.commands
+        )
+        return (
+            f"<p>{self.queries.count} commands, {self.queries.documents} documents, "
+            f"{self.queries.ms:.1f} ms</p>"
+            "<table><thead><tr><th>Command</th><th>Collection</th><th>ms</th>"
+            "<th>Documents</th><th>Shape</th></tr></thead>"
+            f"<tbody>{rows}</tbody></table>"
+        )
+
+
+def init_app(app):
+    """Enable the toolbar with the MongoDB panel added to the configured (or default) panels."""
+    panels = list(app.config.get('DEBUG_TB_PANELS', DEFAULT_PANELS))
+    if 'app.debug_panel.QueryStatsPanel' not in panels:
+        panels.append('app.debug_panel.QueryStatsPanel')
+    app.config['DEBUG_TB_PANELS'] = panels
+    DebugToolbarExtension(app)
@@ -0,0 +1,88 @@
+"""
+Cached template fragments and precompiled templates.
+
+Book cards: book_titles.html calls book_card(book) for every book on the page.
+A card (_book_card.html) is rendered once per book version, keyed by the book's
+id and updatedAt (which every write to the book moves on), and then served from
+a per-process LRU, so a listing page is mostly a concatenation of cached strings.
+
+Templates: compiled templates are kept in a Jinja bytecode cache on disk and
+create_app() loads every template at startup, so a worker never parses a template
+while serving a request. `flask compile-templates` fills the cache ahead of time
+(e.g. at deployment, next to `flask bootstrap`) so even worker startup only
+unmarshals code.
+
+Configured in create_app():
+
+    FRAGMENT_CACHE_SIZE       cards kept per worker (0 = render every card)
+    TEMPLATE_BYTECODE_CACHE   keep compiled templates on disk
+    TEMPLATE_BYTECODE_DIR     where (None = Jinja's per-user temporary directory)
+    TEMPLATE_PRELOAD          load every template when the app is created
+"""
+import os
+import time
+
+from flask import request
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+from app.cache import MemoryBackend
+from app.metrics import FRAGMENT_LOOKUPS
+
+CARD_TEMPLATE = '_book_card.html'
+
+
+class FragmentCache:
+    def __init__(self):
+        self.backend = None
+        self.app = None
+
+    def init_app(self, app):
+        self.app = app
+        size = app.config.get('FRAGMENT_CACHE_SIZE', 5000)
+        # Keys carry the book version, so entries never go stale; the TTL only frees memory
+        self.backend = MemoryBackend(maxsize=size, ttl=24 * 3600) if size else None
+        app.add_template_global(self.book_card, 'book_card')
+
+        if app.config.get('TEMPLATE_BYTECODE_CACHE', True):
+            directory = app.config.get('TEMPLATE_BYTECODE_DIR')
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+        if app.config.get('TEMPLATE_PRELOAD', True):
+            preload_templates(app)
+
+    def book_card(self, book):
+        """The card markup of one book (a raw listing dict or a snapshot BookRecord)."""
+        if self.backend is None:
+            return self._render_card(book)
+
+        # URLs in the card depend on where the app is mounted
+        key = f"{book['_id']}:{book.get('updatedAt')}:{request.script_root}"
+        card = self.backend.get(key)
+        if card is None:
+            FRAGMENT_LOOKUPS.inc(fragment='book_card', result='miss')
+            card = self._render_card(book)
+            self.backend.set(key, card)
+        else:
+            FRAGMENT_LOOKUPS.inc(fragment='book_card', result='hit')
+        return card
+
+    def _render_card(self, book):
+        return Markup(self.app.jinja_env.get_template(CARD_TEMPLATE).render(book=book))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def preload_templates(app):
+    """Load (compiling, or reading from the bytecode cache) every template; returns (count, seconds)."""
+    started = time.perf_counter()
+    names = app.jinja_env.list_templates(filter_func=lambda name: name.endswith('.html'))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names), time.perf_counter() - started
+
+
+fragments = FragmentCache()
@@ -0,0 +1,66 @@
+"""
+Conditional GET support (ETag / Last-Modified / 304) for catalogue pages.
+
+A view computes its validators from the catalogue version, without querying the
+page data, and hands a render callback to conditional_page(). If the client's
+copy is still current the callback is never called and a 304 is returned.
+
+Pages also show who is logged in, so the ETag includes the viewer. Anonymous
+pages are publicly cacheable for HTTP_CACHE_MAX_AGE seconds; pages for logged-in
+users are private and always revalidated. Pages carrying flash messages are
+never cached.
+"""
+import hashlib
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+
+def viewer_tag():
+    """Part of the ETag identifying who the page was rendered for."""
+    if not current_user.is_authenticated:
+        return "anon"
+    return f"user-{current_user.get_id()}-{int(bool(current_user.is_admin))}"
+
+
+def make_etag(*parts):
+    """Short, opaque ETag value from the given parts and the viewer."""
+    raw = "|".join(str(part) for part in parts + (viewer_tag(),))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def is_fresh(etag, last_modified=None):
+    """True if the request's If-None-Match / If-Modified-Since still match."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def conditional_page(etag, last_modified, render):
+    """
+    Return a 304 if the client's copy is current, otherwise call render() and
+    return its output with ETag, Last-Modified, Vary and Cache-Control set.
+    """
+    # Flash messages are shown once, so such a page must be rendered and never cached
+    if session.get("_flashes"):
+        response = make_response(render())
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    if is_fresh(etag, last_modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.vary.add("Cookie")
+
+    if current_user.is_authenticated:
+        response.headers["Cache-Control"] = "private, no-cache"
+    else:
+        response.headers["Cache-Control"] = f"public, max-age={current_app.config.get('HTTP_CACHE_MAX_AGE', 60)}"
+    return response
@@ -0,0 +1,158 @@
+"""
+Startup verification of the MongoDB indexes declared in app.model.
+
+Each model declares its indexes in meta['indexes'] with auto_create_index
+switched off, so nothing is built implicitly in the middle of a request.
+verify_indexes() compares those declarations with the live collections by
+index name, keys and options, reports missing, different and unused indexes,
+and optionally builds the missing ones.
+"""
+import threading
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+def _index_name(fields):
+    """MongoDB's default name for an index key list, e.g. member_1_borrowDate_-1."""
+    return "_".join(f"{name}_{direction}" for name, direction in fields)
+
+
+def index_usage(collection):
+    """
+    Return {index_name: ops} from $indexStats (operations since the server started).
+    Returns an empty dict if the server does not support $indexStats.
+    """
+    try:
+        stats = collection.aggregate([{"$indexStats": {}}])
+        return {s["name"]: s["accesses"]["ops"] for s in stats}
+    except (OperationFailure, NotImplementedError):
+        return {}
+
+
+# Options compared with the live index of the same name (absent means the server default)
+COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+def declared_indexes(model):
+    """{name: spec} of a model's declared indexes, unnamed ones under MongoDB's default name."""
+    return {spec.get("name") or _index_name(spec["fields"]): spec for spec in model._meta["index_specs"]}
+
+
+def _options(index):
+    return {option: index[option] for option in COMPARED_OPTIONS if index.get(option) not in (None, False)}
+
+
+def compare_indexes(model):
+    """
+    Compare a model's declared indexes with index_information() by name, key and
+    options. (MongoEngine's compare_indexes() looks at key lists only, so an index
+    with the same keys as another, e.g. a second partial index, never shows up as missing.)
+    Returns (missing, different, extra) lists of index names.
+    """
+    declared = declared_indexes(model)
+    live = model._get_collection().index_information()
+    missing, different = [], []
+    for name, spec in declared.items():
+        index = live.get(name)
+        if index is None:
+            missing.append(name)
+        elif [tuple(key) for key in index["key"]] != [tuple(key) for key in spec["fields"]] \
+                or _options(index) != _options(spec):
+            different.append(name)
+    extra = [name for name in live if name != "_id_" and name not in declared]
+    return missing, different, extra
+
+
+def check_model(model):
+    """
+    Compare one model's declared indexes with its collection. Returns a dict with the
+    collection name and lists of missing, different (same name, other keys or options),
+    extra and unused indexes.
+    """
+    missing, different, extra = compare_indexes(model)
+    usage = index_usage(model._get_collection())
+
+    return {
+        "collection": model._get_collection_name(),
+        "missing": missing,
+        "different": different,
+        "extra": extra,
+        # Indexes that exist but have served no operations (the _id index is always kept)
+        "unused": [name for name, ops in usage.items() if ops == 0 and name != "_id_"],
+    }
+
+
+def build_missing(model):
+    """
+    Build the declared indexes that are missing, without blocking reads and writes.
+    Returns {index name: error} for the ones the server refused (e.g. a conflicting
+    index under another name); the others are still built.
+    """
+    missing, _, _ = compare_indexes(model)
+    collection = model._get_collection()
+
+    # Some models need their data adjusted first (e.g. Loan's active flag for its partial index)
+    if missing and hasattr(model, "prepare_indexes"):
+        model.prepare_indexes()
+
+    failed = {}
+    for name, spec in declared_indexes(model).items():
+        if name not in missing:
+            continue
+        spec = dict(spec, name=name)
+        fields = spec.pop("fields")
+        try:
+            collection.create_index(fields, background=True, **spec)
+        except OperationFailure as e:
+            failed[name] = e
+    return failed
+
+
+def verify_indexes(app, models=None, build=False, background=True):
+    """
+    Report missing/unused indexes for every model and optionally build the missing ones.
+    By default runs in a daemon thread so an unreachable database never blocks app
+    startup, and returns the started thread. With background=False it runs inline
+    (used by the bootstrap command) and returns None.
+    """
+    if models is None:
+        from app.model import Book, User, Loan, LoanArchive, LoanEvent, CirculationStat
+        models = [Book, User, Loan, LoanArchive, LoanEvent, CirculationStat]
+
+    def run():
+        with app.app_context():
+            for model in models:
+                try:
+                    report = check_model(model)
+                    if report["missing"]:
+                        app.logger.warning("Missing indexes on '%s': %s",
+                                           report["collection"], ", ".join(report["missing"]))
+                    if report["different"]:
+                        # Not rebuilt automatically: dropping an index in use is an operator's decision
+                        app.logger.warning("Indexes on '%s' differ from their declaration (drop them to rebuild): %s",
+                                           report["collection"], ", ".join(report["different"]))
+                    if report["extra"]:
+                        app.logger.info("Undeclared indexes on '%s': %s",
+                                        report["collection"], ", ".join(report["extra"]))
+                    if report["unused"]:
+                        app.logger.info("Unused indexes on '%s': %s",
+                                        report["collection"], ", ".join(report["unused"]))
+
+                    if build and report["missing"]:
+                        failed = build_missing(model)
+                        for name, error in failed.items():
+                            app.logger.error("Could not build index '%s' on '%s': %s",
+                                             name, report["collection"], error)
+                        if len(failed) < len(report["missing"]):
+                            app.logger.warning("Built missing indexes on '%s'.", report["collection"])
+                except PyMongoError as e:
+                    app.logger.error("Index verification failed for '%s': %s",
+                                     model._get_collection_name(), e)
+
+    if not background:
+        run()
+        return None
+
+    thread = threading.Thread(target=run, name="index-verification", daemon=True)
+    thread.start()
+    return thread
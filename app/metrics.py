@@ -0,0 +1,345 @@
+"""
+Prometheus-style metrics (counters and histograms), exposed as text at /metrics.
+
+Configured in create_app():
+
+    METRICS_MULTIPROC_DIR   directory for per-process value files (create_app() takes
+                            it from the PROMETHEUS_MULTIPROC_DIR environment variable)
+    RENDER_TIMING_HEADER    add a Server-Timing 'render' entry with the page's
+                            template render time to every response
+
+With several worker processes (gunicorn -w N) set the directory: each process
+keeps its values in its own memory-mapped file there and /metrics sums the files
+of all processes, so whichever worker answers a scrape reports the whole server.
+Empty the directory when the server starts (not when a single worker restarts,
+or its counts would be lost). Without it, values live in this process only.
+
+Recording a value is a dict lookup and an in-place update under a lock, no I/O.
+The metrics the app records are declared at the bottom of this module.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import g, request, before_render_template, template_rendered
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# --------------------------------------------------------------------------
+# Value stores
+# --------------------------------------------------------------------------
+class MemoryValues:
+    """Values of this process only."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class FileValues:
+    """
+    This process's values in <directory>/metrics_<pid>.db, read by every process.
+
+    Layout: an 8-byte count of bytes in use, then entries of (4-byte key length,
+    key padded to 8 bytes, float64 value). An entry is written before the count
+    grows to include it, so readers never see half of one. A file left by a dead
+    process whose pid is reused is carried on, not restarted, so the counters
+    summed over all files never go backwards.
+    """
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        """Start this process's file (on first use, and again in a forked worker)."""
+        self._pid = os.getpid()
+        # No O_TRUNC: the file may hold the values of an earlier process with this pid
+        fd = os.open(os.path.join(self.directory, f"metrics_{self._pid}.db"), os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, 'r+b')
+        size = os.fstat(fd).st_size
+        self._capacity = max(size, self.INITIAL_SIZE)
+        if size < self._capacity:
+            self._file.truncate(self._capacity)
+        self._mmap = mmap.mmap(self._file.fileno(), self._capacity)
+        self._used = struct.unpack_from('<q', self._mmap, 0)[0] if size >= 8 else 0
+        if self._used < 8:
+            self._used = 8
+            struct.pack_into('<q', self._mmap, 0, self._used)
+        self._positions = {key: position for key, position in self._entries(self._mmap)}
+
+    def _add(self, key):
+        encoded = key.encode('utf-8')
+        padded = len(encoded) + (-(4 + len(encoded)) % 8)
+        size = 4 + padded + 8
+        if self._used + size > self._capacity:
+            while self._used + size > self._capacity:
+                self._capacity *= 2
+            self._mmap.close()
+            self._file.truncate(self._capacity)
+            self._mmap = mmap.mmap(self._file.fileno(), self._capacity)
+
+        struct.pack_into(f'<i{padded}sd', self._mmap, self._used, len(encoded), encoded, 0.0)
+        position = self._used + 4 + padded
+        self._used += size
+        struct.pack_into('<q', self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def inc(self, key, amount):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._open()
+            position = self._positions.get(key)
+            if position is None:
+                position = self._add(key)
+            value, = struct.unpack_from('<d', self._mmap, position)
+            struct.pack_into('<d', self._mmap, position, value + amount)
+
+    @staticmethod
+    def _entries(data):
+        """(key, position of its value) of every entry in a file's bytes."""
+        if len(data) < 8:
+            return
+        used, = struct.unpack_from('<q', data, 0)
+        position = 8
+        while position < used:
+            length, = struct.unpack_from('<i', data, position)
+            padded = length + (-(4 + length) % 8)
+            key = bytes(data[position + 4:position + 4 + length]).decode('utf-8')
+            yield key, position + 4 + padded
+            position += 4 + padded + 8
+
+    @classmethod
+    def _read(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        for key, position in cls._entries(data):
+            yield key, struct.unpack_from('<d', data, position)[0]
+
+    def items(self):
+        """Values summed over the files of all processes, alive or not."""
+        totals = {}
+        for name in os.listdir(self.directory):
+            if name.startswith('metrics_') and name.endswith('.db'):
+                for key, value in self._read(os.path.join(self.directory, name)):
+                    totals[key] = totals.get(key, 0.0) + value
+        return list(totals.items())
+
+
+# --------------------------------------------------------------------------
+# Metric types
+# --------------------------------------------------------------------------
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._keys = {}
+
+    def _key(self, suffix, values, extra=()):
+        cache_key = (suffix, values, extra)
+        key = self._keys.get(cache_key)
+        if key is None:
+            key = json.dumps([self.name + suffix, [list(pair) for pair in zip(self.labelnames, values)]
+                              + [list(pair) for pair in extra]])
+            self._keys[cache_key] = key
+        return key
+
+    def inc(self, amount=1, **labels):
+        values = tuple(str(labels[name]) for name in self.labelnames)
+        self.registry.store.inc(self._key('', values), amount)
+
+    def samples(self, series):
+        for (name, labels), value in sorted(series.items()):
+            yield f"{name}{_format_labels(labels)} {value:g}"
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        values = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        le = repr(float(self.buckets[index])) if index < len(self.buckets) else '+Inf'
+        store = self.registry.store
+        store.inc(self._key('_bucket', values, (('le', le),)), 1)  # per bucket; cumulated in samples()
+        store.inc(self._key('_sum', values), value)
+        store.inc(self._key('_count', values), 1)
+
+    def samples(self, series):
+        per_labels = {}
+        for (name, labels), value in series.items():
+            if name == self.name + '_bucket':
+                le = dict(labels)['le']
+                base = tuple(pair for pair in labels if pair[0] != 'le')
+                per_labels.setdefault(base, {})[le] = value
+        for base, counts in sorted(per_labels.items()):
+            running = 0.0
+            for le in [repr(float(b)) for b in self.buckets] + ['+Inf']:
+                running += counts.get(le, 0.0)
+                yield f"{self.name}_bucket{_format_labels(base + (('le', le),))} {running:g}"
+            yield f"{self.name}_sum{_format_labels(base)} {series.get((self.name + '_sum', base), 0.0):g}"
+            yield f"{self.name}_count{_format_labels(base)} {series.get((self.name + '_count', base), 0.0):g}"
+
+
+# --------------------------------------------------------------------------
+# Registry
+# --------------------------------------------------------------------------
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Records how long requests wait for a pooled MongoDB connection."""
+
+    def connection_checked_out(self, event):
+        POOL_WAIT.observe(event.duration or 0.0)
+
+    def connection_check_out_failed(self, event):
+        POOL_WAIT.observe(event.duration or 0.0)
+        POOL_CHECKOUT_FAILURES.inc(reason=event.reason)
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_checked_in(self, event): pass
+
+
+class Metrics:
+    def __init__(self):
+        self.store = MemoryValues()
+        self._metrics = []
+        self._local = threading.local()
+        self._registered = False
+        self.render_header = True
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(self, name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def init_app(self, app):
+        """Pick the value store and hook request, template and pool timing (before db.init_app)."""
+        self.render_header = app.config.get('RENDER_TIMING_HEADER', True)
+        directory = app.config.get('METRICS_MULTIPROC_DIR')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.store = FileValues(directory)
+        if not self._registered:
+            monitoring.register(MongoPoolListener())
+            self._registered = True
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+
+    def _start_request(self):
+        g._metrics_started = time.perf_counter()
+
+    def _finish_request(self, response):
+        started = g.pop('_metrics_started', None)
+        endpoint = request.endpoint or 'unmatched'  # one series for all 404s, not one per URL
+        if started is not None:
+            REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        rendered = g.pop('_render_seconds', None)
+        if rendered is not None and self.render_header:
+            response.headers.add('Server-Timing', f'render;dur={rendered * 1000:.1f};desc="templates"')
+        return response
+
+    def _start_render(self, sender, template, context, **extra):
+        self._local.__dict__.setdefault('renders', []).append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        renders = self._local.__dict__.get('renders')
+        if renders:
+            seconds = time.perf_counter() - renders.pop()
+            TEMPLATE_RENDER.observe(seconds, template=template.name)
+            g._render_seconds = g.get('_render_seconds', 0.0) + seconds  # this page, for Server-Timing
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        series = {}
+        for key, value in self.store.items():
+            name, labels = json.loads(key)
+            series[(name, tuple(tuple(pair) for pair in labels))] = value
+
+        lines = []
+        for metric in self._metrics:
+            own = {key: value for key, value in series.items()
+                   if key[0] == metric.name or key[0].startswith(metric.name + '_')}
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(own))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+REQUEST_LATENCY = metrics.histogram('flask_request_duration_seconds', 'Request latency by endpoint.',
+                                    ('endpoint', 'method'))
+REQUESTS = metrics.counter('flask_requests_total', 'Responses by endpoint, method and status.',
+                           ('endpoint', 'method', 'status'))
+TEMPLATE_RENDER = metrics.histogram('template_render_seconds', 'Jinja template render time.', ('template',))
+POOL_WAIT = metrics.histogram('mongodb_pool_checkout_seconds', 'Wait for a MongoDB connection from the pool.',
+                              buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+POOL_CHECKOUT_FAILURES = metrics.counter('mongodb_pool_checkout_failures_total',
+                                         'Failed MongoDB connection checkouts by reason.', ('reason',))
+LOAN_OPERATIONS = metrics.counter('loan_operations_total',
+                                  'Loan operations by outcome, with the reason for failures.',
+                                  ('operation', 'outcome', 'reason'))
+REQUESTS_REJECTED = metrics.counter('requests_rejected_total',
+                                    'Requests refused with 429 by the rate and concurrency limits (app.ratelimit).',
+                                    ('endpoint', 'reason'))
+LOGINS = metrics.counter('logins_total', 'Login attempts by outcome.', ('outcome',))
+CACHE_LOOKUPS = metrics.counter('catalogue_cache_lookups_total', 'Catalogue cache lookups by result.',
+                                ('result',))
+FRAGMENT_LOOKUPS = metrics.counter('template_fragment_lookups_total', 'Cached template fragment lookups by result.',
+                                   ('fragment', 'result'))
+LOANS_ARCHIVED = metrics.counter('loans_archived_total', 'Returned loans moved to loans_archive.')
+LOAN_EVENTS_CONSUMED = metrics.counter('loan_events_consumed_total', 'Loan events handled by each outbox consumer.',
+                                       ('consumer',))
+LOAN_EVENT_BATCHES_FAILED = metrics.counter('loan_event_batches_failed_total',
+                                            'Loan event batches whose consumer raised (retried later).',
+                                            ('consumer',))
@@ -1,14 +1,191 @@
 from app import db
-from app.books import all_books
+from app.cache import cache
+from app.search import search_index
+from app.snapshot import catalogue_snapshot
 from flask_mongoengine import Document
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from app.passwords import hasher
+from app.metrics import LOAN_OPERATIONS, LOANS_ARCHIVED
+from app.mongo import Routed, routing
 from datetime import datetime,timedelta
 import random
+import base64
+import functools
+import json
+import re
+import unicodedata
+from collections import namedtuple
 from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
 from mongoengine import *
 
-class Book(db.Document):
+# Fields rendered by the book cards on book_titles.html, plus updatedAt, which keys
+# the cached card (app.fragments). The card shows the first and the last paragraph
+# of the description, so it is fetched whole.
+LISTING_FIELDS = ('title', 'slug', 'url', 'authors', 'available', 'category', 'genres', 'pages', 'description',
+                  'updatedAt')
+LISTING_PROJECTION = dict.fromkeys(LISTING_FIELDS, 1)
+PAGE_SORT = [('title', 1), ('_id', 1)]
+SLUG_MAX_LENGTH = 80
+SLUG_ATTEMPTS = 5  # saves tried with the next free suffix when a concurrent save takes the slug
+
+
+# Read-only rows for the My Loans page, built by Loan.get_member_history()
+BookSummary = namedtuple('BookSummary', ['id', 'title', 'url', 'authors'])
+LoanRow = namedtuple('LoanRow', ['id', 'book', 'borrowDate', 'dueDate', 'returnDate', 'renewCount'])
+LOAN_ROW_FIELDS = ('book', 'borrowDate', 'dueDate', 'returnDate', 'renewCount')
+HISTORY_SORT = [('borrowDate', -1), ('_id', -1)]
+
+# Fields a loan keeps when Loan.archive_returned() moves it to loans_archive
+ARCHIVE_FIELDS = ('member', 'book', 'borrowDate', 'dueDate', 'returnDate', 'renewCount')
+BOOK_SUMMARY_FIELDS = ('title', 'url', 'authors')
+
+# Per-item result of Loan.return_many() / renew_many(); reason is a short code for failures
+LoanOutcome = namedtuple('LoanOutcome', ['loan_id', 'title', 'ok', 'message', 'reason'], defaults=[None])
+
+
+class LoanError(ValueError):
+    """A loan operation that cannot go ahead. `reason` is a short code for metrics."""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+def tracked(operation):
+    """Count calls of a loan operation in loan_operations_total, by outcome and failure reason."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            try:
+                result = method(*args, **kwargs)
+            except ValueError as e:
+                LOAN_OPERATIONS.inc(operation=operation, outcome='failure', reason=getattr(e, 'reason', 'other'))
+                raise
+            LOAN_OPERATIONS.inc(operation=operation, outcome='success', reason='')
+            return result
+        return wrapper
+    return decorate
+
+
+def count_outcomes(operation, outcomes):
+    """Count the items of a batch operation in loan_operations_total."""
+    for outcome in outcomes:
+        LOAN_OPERATIONS.inc(operation=operation, outcome='success' if outcome.ok else 'failure',
+                            reason='' if outcome.ok else outcome.reason or 'other')
+
+
+def random_date_after(start):
+    """
+    Random date 10–20 days after `start`, capped at now (simulated return/renewal dates).
+    Rounded to milliseconds, the precision MongoDB stores, so it compares equal once saved.
+    """
+    date = min(start + timedelta(days=random.randint(10, 20)), datetime.utcnow())
+    return date.replace(microsecond=date.microsecond // 1000 * 1000)
+
+
+def renewed_from(loan):
+    """Filter on a raw loan's current renewCount (loans saved before it existed have none)."""
+    count = loan.get('renewCount', 0)
+    return count if count else {'$in': [0, None]}
+
+
+def copies_back(count, now):
+    """Update pipeline putting `count` copies of a book back, capped at its copies."""
+    return [{'$set': {'available': {'$min': ['$copies', {'$add': ['$available', count]}]}, 'updatedAt': now}}]
+
+
+def slugify(title):
+    """URL-safe slug for a title, e.g. 'Atomic Habits: An Easy Way' -> 'atomic-habits-an-easy-way'."""
+    text = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii').lower()
+    slug = re.sub(r"[^a-z0-9]+", "-", text).strip("-")[:SLUG_MAX_LENGTH].rstrip("-")
+    return slug or "book"
+
+
+def unique_slug(title, taken):
+    """Slug for a title that is not in `taken`, adding -2, -3, ... for duplicate titles."""
+    base = slugify(title)
+    slug, n = base, 2
+    while slug in taken:
+        slug, n = f"{base}-{n}", n + 1
+    return slug
+
+
+def encode_cursor(title, book_id):
+    """Encode a (title, _id) keyset position as an opaque, URL-safe token."""
+    raw = json.dumps([title, str(book_id)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token made by encode_cursor. Raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        title, book_id = json.loads(raw.decode('utf-8'))
+        return str(title), ObjectId(book_id)
+    except (ValueError, TypeError, InvalidId) as e:
+        raise ValueError("Invalid page cursor.") from e
+
+
+def encode_loan_cursor(borrow_date, loan_id):
+    """Encode a (borrowDate, _id) position in a member's loan history as an opaque, URL-safe token."""
+    raw = json.dumps([borrow_date.isoformat(), str(loan_id)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_loan_cursor(token):
+    """Decode a token made by encode_loan_cursor. Raises ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        borrow_date, loan_id = json.loads(raw.decode('utf-8'))
+        return datetime.fromisoformat(borrow_date), ObjectId(loan_id)
+    except (ValueError, TypeError, InvalidId) as e:
+        raise ValueError("Invalid page cursor.") from e
+
+class CatalogueVersion(Routed, db.Document):
+    """
+    Single document holding a change counter and last-modified time per category
+    (plus 'All'), bumped on every Book write. Used for ETag/Last-Modified headers.
+    """
+    id = db.StringField(primary_key=True, default='catalogue')
+    versions = db.DictField()
+    updated = db.DictField()
+
+    mongo_route = 'catalogue'  # read preference / write concern, see app.mongo
+    meta = {'collection': 'catalogue_version', 'auto_create_index': False}
+
+    @classmethod
+    def bump(cls, categories):
+        """Record a change to books of the given categories (one upsert round trip)."""
+        scopes = {'All'} | {category for category in categories if category}
+        cls._get_collection().update_one(
+            {'_id': 'catalogue'},
+            {
+                '$inc': {f'versions.{scope}': 1 for scope in scopes},
+                '$set': {f'updated.{scope}': datetime.utcnow() for scope in scopes},
+            },
+            upsert=True,
+        )
+
+    @classmethod
+    def current(cls, category="All"):
+        """
+        Return (version, last_modified) for a category. Cached until the next local
+        change to that category, so conditional requests usually need no query.
+        """
+        return cache.listing(category, ["version"],
+                             lambda: cls.version_of(cls._get_collection().find_one({'_id': 'catalogue'}), category))
+
+    @staticmethod
+    def version_of(doc, category):
+        """(version, last_modified) of a category from the raw catalogue_version document."""
+        doc = doc or {}
+        return doc.get('versions', {}).get(category, 0), doc.get('updated', {}).get(category)
+
+
+class Book(Routed, db.Document):
     """
     MongoEngine model for books in the library.
     """
@@ -21,94 +198,294 @@ class Book(db.Document):
     pages = db.IntField()
     available = db.IntField(default=0) 
     copies = db.IntField(default=0)
+    slug = db.StringField(max_length=SLUG_MAX_LENGTH + 10)  # stable URL key, set on first save
+    updatedAt = db.DateTimeField()  # last write of any kind, for Last-Modified/ETag
 
-    meta = {'collection': 'books'}
+    mongo_route = 'catalogue'  # read preference / write concern, see app.mongo
+    # Indexes are built by app.indexes.verify_indexes() at startup, not lazily on first query
+    meta = {
+        'collection': 'books',
+        'auto_create_index': False,
+        'indexes': [
+            # book_titles (All): sort + keyset on (title, _id); prefix also serves find_by_title
+            ('title', 'id'),
+            # book_titles (by category): equality on category, then sort + keyset on (title, _id)
+            ('category', 'title', 'id'),
+            # /book/<slug> routes: unique point lookups (sparse until older books are backfilled)
+            {'fields': ['slug'], 'unique': True, 'sparse': True},
+        ],
+    }
 
     # --- Class Methods ---
     @classmethod
     def initialize_collection(cls):
         """
         Populate the collection from all_books if empty.
+        Uses one count query and batched unordered inserts.
+        Run once per deployment through `flask bootstrap`, never at import time.
         """
-        if cls.objects.count() == 0:
+        from app.catalogue_import import import_rows
+        from app.books import all_books  # large literal, only loaded when seeding
+
+        count = cls.objects.count()
+        if count == 0:
             print("Book collection is empty. Initializing from all_books...")
-            for book_data in all_books:
-                # The data structure in books.py already matches the model,
-                # except for the default values which MongoEngine handles.
-                cls(**book_data).save()
-            print(f"✅ Book collection initialized from all_books.")
+            report = import_rows(all_books, mode='insert')
+            print(f"✅ Book collection initialized from all_books. {report.summary()}")
         else:
-            print(f"ℹ️ Book collection already populated with {cls.objects.count()} documents. Skipping initialization.")
+            print(f"ℹ️ Book collection already populated with {count} documents. Skipping initialization.")
 
 
     @classmethod
     def get_all_books(cls):
         """
         Retrieve all books from MongoDB, sorted by title (Required for Q2(a) effect).
+        With the catalogue snapshot on (app.snapshot) this is a tuple of BookRecords from memory.
         """
+        if catalogue_snapshot.enabled:
+            return catalogue_snapshot.all_books()
         # --- CORRECTION 3: Added sorting by title ---
-        return list(cls.objects.order_by('title').as_pymongo())
+        return cache.listing("All", ["all"], lambda: list(cls.objects.order_by('title').as_pymongo()))
 
     @classmethod
     def find_by_title(cls, title):
         """
         Find a single book by title.
         Returns the Book document (not a dict).
+        The raw document is cached, so every caller gets its own Book instance.
         """
-        return cls.objects(title=title).first()
+        def load():
+            book = cls.objects(title=title).first()
+            return book.to_mongo().to_dict() if book else None
+
+        son = cache.title(title, load)
+        return cls._from_son(son) if son else None
+
+    @classmethod
+    def find_by_slug(cls, slug):
+        """
+        Find a single book by its slug (unique index point read).
+        Returns the Book document (not a dict).
+        """
+        def load():
+            book = cls.objects(slug=slug).first()
+            return book.to_mongo().to_dict() if book else None
+
+        son = cache.slug(slug, load)
+        return cls._from_son(son) if son else None
 
 
     @classmethod
     def find_by_category(cls, category):
         """
         Retrieve books filtered by category (or all if category='All'), sorted by title.
+        With the catalogue snapshot on (app.snapshot) this is a tuple of BookRecords from memory.
         """
+        if catalogue_snapshot.enabled:
+            return catalogue_snapshot.by_category(category)
         if category == "All":
             return cls.get_all_books()
             
         #sorting by title 
-        return list(cls.objects(category=category).order_by('title').as_pymongo())
+        return cache.listing(category, ["all"],
+                             lambda: list(cls.objects(category=category).order_by('title').as_pymongo()))
+
+    @classmethod
+    def get_page(cls, category="All", after=None, page_size=24):
+        """
+        Retrieve one page of books for the listing view, sorted by (title, _id).
+        Uses keyset pagination: `after` is the cursor returned with the previous page,
+        so every page costs the same no matter how deep into the catalogue it is.
+        Returns (books, next_cursor); next_cursor is None on the last page.
+        With the catalogue snapshot on (app.snapshot) the books are BookRecords from memory.
+        """
+        if catalogue_snapshot.enabled:
+            position = decode_cursor(after) if after else None
+            return cls.page_result(catalogue_snapshot.page(category, position, page_size), page_size)
+        return cache.listing(category, ["page", after, page_size],
+                             lambda: cls._load_page(category, after, page_size))
+
+    @classmethod
+    def _load_page(cls, category, after, page_size):
+        query, sort, projection = cls.page_query(category, after)
+        books = list(cls._get_collection().find(query, projection, sort=sort, limit=page_size + 1))
+        return cls.page_result(books, page_size)
+
+    @staticmethod
+    def page_query(category, after):
+        """
+        (filter, sort, projection) of a listing page, as raw pymongo arguments.
+        Fetch page_size + 1 rows with them.
+        """
+        query = {} if category == "All" else {'category': category}
+        if after:
+            last_title, last_id = decode_cursor(after)
+            query['$or'] = [{'title': {'$gt': last_title}}, {'title': last_title, '_id': {'$gt': last_id}}]
+        # Copies: drivers may add to the projection they are given (mongomock adds _id)
+        return query, list(PAGE_SORT), dict(LISTING_PROJECTION)
+
+    @staticmethod
+    def page_result(books, page_size):
+        """(books, next_cursor) from the page_size + 1 rows of a page query."""
+        # The extra row only says whether another page follows
+        next_cursor = None
+        if len(books) > page_size:
+            books = books[:page_size]
+            next_cursor = encode_cursor(books[-1]['title'], books[-1]['_id'])
+        return books, next_cursor
+
+    @classmethod
+    def count_by_category(cls, category="All"):
+        """Count the books in a category (or all books if category='All')."""
+        if catalogue_snapshot.enabled:
+            return catalogue_snapshot.count(category)
+        if category == "All":
+            return cache.listing("All", ["count"], lambda: cls.objects.count())
+        return cache.listing(category, ["count"], lambda: cls.objects(category=category).count())
+
+    def save(self, *args, **kwargs):
+        """Save the book (giving it a slug if it has none) and drop any cached listing or lookup that shows it."""
+        assigned = not self.slug
+        if assigned:
+            base = slugify(self.title)
+            taken = set(Book.objects(slug__startswith=base, id__ne=self.id).distinct('slug'))
+            self.slug = unique_slug(self.title, taken)
+        self.updatedAt = datetime.utcnow()
+        for attempt in range(SLUG_ATTEMPTS):
+            try:
+                result = super().save(*args, **kwargs)
+                break
+            except NotUniqueError:
+                # A concurrent save of the same title (or a lagging read of the taken slugs) got
+                # this slug first; the slug is the only unique key, so take the next suffix
+                if not assigned or attempt == SLUG_ATTEMPTS - 1:
+                    raise
+                taken.add(self.slug)
+                self.slug = unique_slug(self.title, taken)
+        Book.changed(self.title, self.category, self.slug)
+        search_index.update_book(self)
+        return result
+
+    @staticmethod
+    def changed(title, category, slug=None):
+        """Called after any write to a book: drop cached copies and bump the catalogue version."""
+        cache.invalidate_book(title, category, slug)
+        CatalogueVersion.bump([category])
+        catalogue_snapshot.touch()
+
+    @staticmethod
+    def changed_many(books):
+        """Book.changed() for a batch of raw book dicts, with a single version bump."""
+        for book in books:
+            cache.invalidate_book(book['title'], book['category'], book.get('slug'))
+        CatalogueVersion.bump({book['category'] for book in books})
+        catalogue_snapshot.touch()
+
+    @classmethod
+    def prepare_indexes(cls):
+        """
+        Give slugs to books saved before slugs existed, so the unique slug index covers them.
+        updatedAt moves with the slug, so cached book cards (app.fragments) pick up the new links.
+        """
+        taken = set(cls.objects(slug__ne=None).distinct('slug'))
+        backfilled = []
+        for book in cls.objects(slug=None).only('title', 'category'):
+            slug = unique_slug(book.title, taken)
+            taken.add(slug)
+            cls.objects(id=book.id).update_one(set__slug=slug, set__updatedAt=datetime.utcnow())
+            backfilled.append({'title': book.title, 'category': book.category, 'slug': slug})
+        if backfilled:
+            cls.changed_many(backfilled)
+
+    @classmethod
+    def get_listing_by_ids(cls, ids):
+        """
+        Retrieve the listing fields of the given books in one $in query,
+        returned in the order of `ids` (books that no longer exist are skipped).
+        """
+        books = {
+            book['_id']: book
+            for book in cls.objects(id__in=list(ids)).only(*LISTING_FIELDS).as_pymongo()
+        }
+        return [books[book_id] for book_id in ids if book_id in books]
 
         # --- METHOD 1: Borrow a book ---
     def borrow(self):
-        """Decreases available count when a book is borrowed."""
-        if self.available <= 0:
-            raise ValueError(f"'{self.title}' is currently not available for loan.")
+        """
+        Decreases available count when a book is borrowed.
+        Single conditional update: only succeeds while a copy is available,
+        so concurrent borrowers can never take the count below zero.
+        """
+        updated = Book.objects(id=self.id, available__gt=0).update_one(
+            dec__available=1, set__updatedAt=datetime.utcnow()
+        )
+        if not updated:
+            raise LoanError(f"'{self.title}' is currently not available for loan.", 'unavailable')
         self.available -= 1
-        self.save()
+        Book.changed(self.title, self.category, self.slug)
 
     # --- METHOD 2: Return a book ---
     def return_book(self):
-        """Increases available count when a book is returned."""
-        if self.available >= self.copies:
-            raise ValueError(f"All copies of '{self.title}' are already in the library.")
+        """
+        Increases available count when a book is returned.
+        Single conditional update: only succeeds while available < copies.
+        """
+        updated = Book.objects(
+            id=self.id, __raw__={'$expr': {'$lt': ['$available', '$copies']}}
+        ).update_one(inc__available=1, set__updatedAt=datetime.utcnow())
+        if not updated:
+            raise LoanError(f"All copies of '{self.title}' are already in the library.", 'all_copies_in')
         self.available += 1
-        self.save()
-    
+        Book.changed(self.title, self.category, self.slug)
+
 
 
 # ----------------------------------------------------------------------
 # --- NEW USER MODEL (Database Model) ---
 # ----------------------------------------------------------------------
 
-class User(UserMixin, Document):
+class User(Routed, UserMixin, Document):
     email = db.StringField(required=True, unique=True)
     password = db.StringField(required=True)
     name = db.StringField(required=True)
     is_admin = db.BooleanField(default=False)  # <-- add this field
 
+    mongo_route = 'members'  # read preference / write concern, see app.mongo
+    # The unique index on email (login/register lookups) comes from unique=True above
+    meta = {'auto_create_index': False}
+
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return hasher.verify(self.password, password)
+
+    def verify_password(self, password):
+        """
+        Check the password and, if it is right but was hashed with another method or
+        cost than configured, store a fresh hash (transparent upgrade/downgrade).
+        """
+        if not self.check_password(password):
+            return False
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+            User.objects(id=self.id).update_one(set__password=self.password)
+        return True
 
     # Flask-Login needs this to get user by ID
     def get_id(self):
         return str(self.pk)
 
+    def save(self, *args, **kwargs):
+        """Save the user and drop their cached principal (name, admin flag or password may have changed)."""
+        from app.principal import principals
 
-class Loan(db.Document):
+        result = super().save(*args, **kwargs)
+        principals.invalidate(self.pk)
+        return result
+
+
+class Loan(Routed, db.Document):
     """
     MongoEngine model for a user's loan.
     """
@@ -118,103 +495,757 @@ class Loan(db.Document):
     dueDate = db.DateTimeField()  # NEW FIELD for VIEWLOAN
     returnDate = db.DateTimeField()
     renewCount = db.IntField(default=0)
+    active = db.BooleanField()  # True until returned; drives the unique active-loan index
+    overdue = db.BooleanField()  # materialised by the overdue sweeper (app.overdue), cleared on return/renew
+    batch = db.ObjectIdField()  # nonce of the return_many/renew_many request that last changed it
 
-    meta = {'collection': 'loans'}
+    mongo_route = 'members'  # read preference / write concern, see app.mongo
+    meta = {
+        'collection': 'loans',
+        'auto_create_index': False,
+        'indexes': [
+            # At most one active (unreturned) loan per member and book, enforced by MongoDB
+            {
+                'fields': ['member', 'book'],
+                'unique': True,
+                'partialFilterExpression': {'active': True},
+                'name': 'one_active_loan_per_book',
+            },
+            # get_member_loans: all loans of a member, newest first
+            ('member', '-borrowDate'),
+            # Overdue sweeper: active loans by due date (returned loans are not indexed)
+            {
+                'fields': ['dueDate'],
+                'partialFilterExpression': {'active': True},
+                'name': 'active_loans_by_due_date',
+            },
+            # Overdue report: only loans currently marked overdue
+            {
+                'fields': ['member', 'book'],
+                'partialFilterExpression': {'overdue': True},
+                'name': 'overdue_loans',
+            },
+            # Archiving: returned loans by return date (they leave the collection once archived)
+            {
+                'fields': ['returnDate'],
+                'partialFilterExpression': {'active': False},
+                'name': 'returned_loans_by_return_date',
+            },
+        ],
+    }
 
     # ----------------------------
     # CREATE a loan
     # ----------------------------
     @classmethod
+    @tracked('borrow')
     def create_loan(cls, member, book, borrow_date=None):
         """
         Create a loan for the member if there is no active (unreturned) loan for the same book.
         Decrease book.available if loan is successful.
         borrow_date: optional datetime for random borrow date
+
+        Three round trips: a check for an active loan of the same book, a conditional
+        decrement of book.available, then the insert. The check alone leaves a window for
+        two concurrent borrows; the one_active_loan_per_book unique partial index closes
+        it where it has been built (`flask bootstrap`), and the copy is then put back.
         """
         if borrow_date is None:
             borrow_date = datetime.utcnow()  
 
-        # Check for existing unreturned loan
-        existing_loan = cls.objects(member=member, book=book, returnDate=None).first()
-        if existing_loan:
-            raise ValueError(f"User {member.name} already has an unreturned loan for '{book.title}'.")
+        # Also enforced by the index, but it may not exist (MONGODB_INDEX_CHECK 'off', no bootstrap)
+        if cls.objects(member=member.pk, book=book.id, returnDate=None).only('id').first():
+            raise LoanError(f"User {member.name} already has an unreturned loan for '{book.title}'.",
+                            'already_borrowed')
 
-        # Check book availability
-        if book.available <= 0:
-            raise ValueError(f"'{book.title}' is currently not available for loan.")
-
-        # Decrease available count
-        book.available -= 1
-        book.save()
+        # Take a copy (fails if none is available)
+        book.borrow()
 
         # Set due date 2 weeks after borrow date
         due_date = borrow_date + timedelta(weeks=2)
 
         # Create new loan
-        loan = cls(member=member, book=book, borrowDate=borrow_date, dueDate=due_date)
-        loan.save()
+        loan = cls(member=member.pk, book=book, borrowDate=borrow_date, dueDate=due_date, active=True)
+        try:
+            loan.save(force_insert=True)
+        except NotUniqueError:
+            Book.objects(id=book.id).update_one(inc__available=1, set__updatedAt=datetime.utcnow())
+            book.available += 1
+            Book.changed(book.title, book.category, book.slug)
+            raise LoanError(f"User {member.name} already has an unreturned loan for '{book.title}'.",
+                            'already_borrowed')
+        LoanEvent.append([LoanEvent.of('borrowed', loan.id, member.pk, book.id, borrow_date)])
         return loan
 
+    @classmethod
+    def prepare_indexes(cls):
+        """
+        Set the active flag on loans created before it existed, so the
+        one_active_loan_per_book index covers them. Called before index builds.
+        """
+        cls.objects(returnDate=None, active=None).update(set__active=True)
+        cls.objects(returnDate__ne=None, active=None).update(set__active=False)
+
+    def book_id(self):
+        """Id of the loaned book, without dereferencing it."""
+        ref = self._data.get('book')
+        return getattr(ref, 'id', ref)
+
+    def _member_id(self):
+        ref = self._data.get('member')
+        return getattr(ref, 'id', ref)
+
 
     # ----------------------------
     # RETRIEVE loans
     # ----------------------------
     @classmethod
     def get_member_loans(cls, member):
-        """Retrieve all loans for a given member."""
-        return cls.objects(member=member).order_by('-borrowDate')
+        """
+        Retrieve the loans of a given member (a User or Principal) still in the loans
+        collection: active and recently returned ones. Older returned loans are in
+        LoanArchive; get_member_history() pages through both.
+        """
+        return cls.objects(member=member.pk).order_by('-borrowDate')
+
+    @classmethod
+    def get_member_history(cls, member, after=None, page_size=25):
+        """
+        One page of a member's loans, newest first, from both tiers: `loans` and
+        `loans_archive`. Keyset pagination on (borrowDate, _id): `after` is the cursor
+        returned with the previous page. Three queries: page_size + 1 loans from each
+        tier and one $in fetch of their books.
+        Returns (LoanRow list with loan.book as a BookSummary, next_cursor or None).
+        """
+        query, sort, projection = cls.history_query(member.pk, after)
+        loans = list(cls._get_collection().find(query, projection, sort=sort, limit=page_size + 1))
+        archived = list(LoanArchive._get_collection().find(query, projection, sort=sort, limit=page_size + 1))
+        loans, next_cursor = cls.history_result(loans, archived, page_size)
+
+        book_ids = list({loan['book'] for loan in loans})
+        books = Book.objects(id__in=book_ids).only(*BOOK_SUMMARY_FIELDS).as_pymongo() if book_ids else []
+        return cls.loan_rows(loans, books), next_cursor
+
+    @staticmethod
+    def history_query(member_id, after):
+        """
+        (filter, sort, projection) of a history page in either tier, as raw pymongo
+        arguments, so both tiers run the same query. Fetch page_size + 1 rows with them.
+        """
+        query = {'member': member_id}
+        if after:
+            last_date, last_id = decode_loan_cursor(after)
+            query['$or'] = [{'borrowDate': {'$lt': last_date}}, {'borrowDate': last_date, '_id': {'$lt': last_id}}]
+        return query, list(HISTORY_SORT), dict.fromkeys(LOAN_ROW_FIELDS, 1)
+
+    @staticmethod
+    def history_result(loans, archived, page_size):
+        """(loans, next_cursor) from the page_size + 1 rows of each tier's history query."""
+        # A loan being archived right now can be in both tiers for a moment
+        merged = {loan['_id']: loan for loan in archived}
+        merged.update((loan['_id'], loan) for loan in loans)
+        rows = sorted(merged.values(), key=lambda loan: (loan['borrowDate'], loan['_id']), reverse=True)
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_loan_cursor(rows[-1]['borrowDate'], rows[-1]['_id'])
+        return rows, next_cursor
+
+    @staticmethod
+    def loan_rows(loans, books):
+        """LoanRows from raw loan documents and the raw documents of their books."""
+        summaries = {
+            book['_id']: BookSummary(book['_id'], book['title'], book.get('url'), book.get('authors', []))
+            for book in books
+        }
+        return [
+            LoanRow(
+                id=loan['_id'],
+                # A book removed from the catalogue still shows up in the loan history
+                book=summaries.get(loan['book'], BookSummary(loan['book'], "(Removed title)", None, [])),
+                borrowDate=loan.get('borrowDate'),
+                dueDate=loan.get('dueDate'),
+                returnDate=loan.get('returnDate'),
+                renewCount=loan.get('renewCount', 0),
+            )
+            for loan in loans
+        ]
 
     @classmethod
     def get_specific_loan(cls, member, book):
         """Retrieve a specific loan (active or returned) for a member and book."""
-        return cls.objects(member=member, book=book).first()
+        return cls.objects(member=member.pk, book=book).first()
 
     # ----------------------------
     # UPDATE loans
     # ----------------------------
+    @tracked('renew')
     def renew_loan(self):
-        """Renew an active loan by generating a new borrow date 10–20 days after current borrow date."""
+        """
+        Renew an active loan by generating a new borrow date 10–20 days after current borrow date.
+        One conditional update: only while the loan is unreturned and still at the renewal
+        count read, so a concurrent return or renewal makes it fail instead of being overwritten.
+        """
         if self.returnDate:
-            raise ValueError("Cannot renew a loan that has already been returned.")
+            raise LoanError("Cannot renew a loan that has already been returned.", 'already_returned')
         if self.renewCount >= 2:
-            raise ValueError("Cannot renew loan more than 2 times.")
+            raise LoanError("Cannot renew loan more than 2 times.", 'renewal_limit')
 
         # Generate a random new borrow date (10–20 days after current borrow date, not after today)
-        days_after = random.randint(10, 20)
-        new_borrow_date = self.borrowDate + timedelta(days=days_after)
-        if new_borrow_date > datetime.utcnow():
-            new_borrow_date = datetime.utcnow()
-
-        self.borrowDate = new_borrow_date
-        self.dueDate = self.borrowDate + timedelta(weeks=2)
+        borrow_date = random_date_after(self.borrowDate)
+        due_date = borrow_date + timedelta(weeks=2)
+        updated = Loan._get_collection().update_one(
+            {'_id': self.id, 'returnDate': None, 'renewCount': renewed_from({'renewCount': self.renewCount})},
+            {'$set': {'borrowDate': borrow_date, 'dueDate': due_date, 'overdue': False},  # swept again if overdue
+             '$inc': {'renewCount': 1}},
+        ).modified_count
+        if not updated:
+            raise LoanError("Loan was returned or renewed in the meantime.", 'conflict')
+        self.borrowDate, self.dueDate = borrow_date, due_date
         self.renewCount += 1
-        self.save()
+        self.overdue = False
+        LoanEvent.append([LoanEvent.of('renewed', self.id, self._member_id(), self.book_id(), datetime.utcnow())])
 
+    @tracked('return')
     def return_loan(self):
-        """Return a borrowed book by setting returnDate 10–20 days after borrowDate, capped at today."""
+        """
+        Return a borrowed book by setting returnDate 10–20 days after borrowDate, capped at today.
+        The loan is closed first with a conditional update (only if still unreturned), so
+        of two concurrent returns exactly one goes on to put the copy back. The copy goes
+        back like in return_many(), capped at the book's copies: a drifted counter is never
+        a reason to keep a member's loan open.
+        """
         if self.returnDate:
-            raise ValueError("Loan has already been returned.")
+            raise LoanError("Loan has already been returned.", 'already_returned')
 
         # Generate a random return date (10–20 days after borrow date, not after today)
-        days_after = random.randint(10, 20)
-        random_return_date = self.borrowDate + timedelta(days=days_after)
-        if random_return_date > datetime.utcnow():
-            random_return_date = datetime.utcnow()
-
+        random_return_date = random_date_after(self.borrowDate)
+        updated = Loan.objects(id=self.id, returnDate=None).update_one(
+            set__returnDate=random_return_date, set__active=False, set__overdue=False
+        )
+        if not updated:
+            raise LoanError("Loan has already been returned.", 'already_returned')
         self.returnDate = random_return_date
-        self.save()
+        self.active = False
+        self.overdue = False
+
+        # Returns the keys needed for cache invalidation in the same round trip
+        book = Book._get_collection().find_one_and_update(
+            {'_id': self.book_id()}, copies_back(1, datetime.utcnow()),
+            projection={'title': 1, 'category': 1, 'slug': 1},
+        )
+        if book:
+            Book.changed(book['title'], book['category'], book.get('slug'))
+        LoanEvent.append([LoanEvent.of('returned', self.id, self._member_id(), self.book_id(), random_return_date)])
+
+    # ----------------------------
+    # OVERDUE state
+    # ----------------------------
+    @classmethod
+    def sweep_overdue(cls, now=None):
+        """
+        Mark active loans whose due date has passed as overdue. Incremental: only loans
+        not yet marked are touched, found through the active_loans_by_due_date index.
+        Returns the number of loans newly marked.
+        """
+        now = now or datetime.utcnow()
+        result = cls._get_collection().update_many(
+            {'active': True, 'dueDate': {'$lt': now}, 'overdue': {'$ne': True}},
+            {'$set': {'overdue': True}},
+        )
+        return result.modified_count
+
+    @classmethod
+    def overdue_report(cls):
+        """
+        Overdue loans per member and per book, read from the materialised overdue flag only.
+        Returns {'total', 'members': [{'id', 'name', 'email', 'count'}], 'books': [{'id', 'title', 'count'}]}.
+        """
+        collection = routing.collection(cls._get_collection(), 'reports')
+        per_member = list(collection.aggregate([
+            {'$match': {'overdue': True}},
+            {'$group': {'_id': '$member', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}},
+        ]))
+        per_book = list(collection.aggregate([
+            {'$match': {'overdue': True}},
+            {'$group': {'_id': '$book', 'count': {'$sum': 1}}},
+            {'$sort': {'count': -1}},
+        ]))
+
+        users = {
+            user['_id']: user for user in
+            User.objects(id__in=[row['_id'] for row in per_member]).only('name', 'email').as_pymongo()
+        } if per_member else {}
+        books = {
+            book['_id']: book for book in
+            Book.objects(id__in=[row['_id'] for row in per_book]).only('title', 'slug').as_pymongo()
+        } if per_book else {}
+
+        return {
+            'total': sum(row['count'] for row in per_member),
+            'members': [
+                {'id': row['_id'], 'name': users.get(row['_id'], {}).get('name', '(Removed user)'),
+                 'email': users.get(row['_id'], {}).get('email'), 'count': row['count']}
+                for row in per_member
+            ],
+            'books': [
+                {'id': row['_id'], 'title': books.get(row['_id'], {}).get('title', '(Removed title)'),
+                 'slug': books.get(row['_id'], {}).get('slug'), 'count': row['count']}
+                for row in per_book
+            ],
+        }
+
+    # ----------------------------
+    # ARCHIVING returned loans
+    # ----------------------------
+    @classmethod
+    def archive_returned(cls, older_than, batch_size=1000, now=None):
+        """
+        Move loans returned more than `older_than` (a timedelta) ago to loans_archive,
+        so `loans` keeps only active and recent loans. Per batch: one bulk_write of
+        insert-only upserts into the archive, then one delete_many from loans, so a run
+        that dies in between is completed by the next one without duplicates. A loan the
+        member deleted meanwhile has a tombstone in the archive (LoanArchive.bury), which
+        the insert-only upsert leaves alone. Returns the number of loans moved.
+        """
+        cutoff = (now or datetime.utcnow()) - older_than
+        loans, archive = cls._get_collection(), LoanArchive._get_collection()
+        moved = 0
+        while True:
+            # Found through the returned_loans_by_return_date index
+            batch = list(loans.find({'active': False, 'returnDate': {'$lt': cutoff}},
+                                    dict.fromkeys(ARCHIVE_FIELDS, 1), limit=batch_size))
+            if not batch:
+                break
+            archived_at = datetime.utcnow()
+            # Insert-only: an archived copy or a tombstone already there is kept as it is
+            archive.bulk_write([
+                UpdateOne({'_id': loan['_id']}, {'$setOnInsert': dict(loan, archivedAt=archived_at)}, upsert=True)
+                for loan in batch
+            ], ordered=False)
+
+            ids = [loan['_id'] for loan in batch]
+            deleted = loans.delete_many({'_id': {'$in': ids}, 'active': False}).deleted_count
+            moved += deleted
+            LOANS_ARCHIVED.inc(deleted)
+            if len(batch) < batch_size:
+                break
+        return moved
 
-        book = self.book
-        if book.available >= book.copies:
-            raise ValueError(f"All copies of '{book.title}' are already in the library.")
-        book.available += 1
-        book.save()
+    # ----------------------------
+    # BATCH updates
+    # ----------------------------
+    @classmethod
+    def _load_batch(cls, member, loan_ids):
+        """
+        Fetch the member's loans among loan_ids plus their books' titles (two queries).
+        Returns (loans by id, titles by book id, outcomes for ids that are invalid or not found).
+        """
+        outcomes, ids = [], []
+        for loan_id in dict.fromkeys(loan_ids):  # de-duplicate, keep order
+            try:
+                ids.append(ObjectId(loan_id))
+            except (InvalidId, TypeError):
+                outcomes.append(LoanOutcome(loan_id, None, False, "Loan not found or unauthorized.",
+                                            'not_found'))
+
+        loans = {
+            loan['_id']: loan
+            for loan in cls.objects(id__in=ids, member=member.pk)
+                           .only('book', 'borrowDate', 'returnDate', 'renewCount').as_pymongo()
+        }
+        for loan_id in ids:
+            if loan_id not in loans:
+                outcomes.append(LoanOutcome(str(loan_id), None, False, "Loan not found or unauthorized.",
+                                            'not_found'))
+
+        book_ids = list({loan['book'] for loan in loans.values()})
+        books = {
+            book['_id']: book
+            for book in Book.objects(id__in=book_ids).only('title', 'category', 'slug', 'genres').as_pymongo()
+        } if book_ids else {}
+        return loans, books, outcomes
+
+    @classmethod
+    def return_many(cls, member, loan_ids):
+        """
+        Return several of a member's loans at once in a constant number of round trips:
+        load loans and books, one bulk_write closing the loans, one bulk_write putting the
+        copies back with a single aggregated increment per book (capped at copies).
+        Returns a list of LoanOutcome, one per requested loan id.
+        """
+        loans, books, outcomes = cls._load_batch(member, loan_ids)
+        now = datetime.utcnow()
+        nonce = ObjectId()  # tells this request's writes apart from a concurrent identical one
+
+        closing = {}  # loan id -> return date we set
+        for loan_id, loan in loans.items():
+            title = books.get(loan['book'], {}).get('title')
+            if loan.get('returnDate'):
+                outcomes.append(LoanOutcome(str(loan_id), title, False, "Loan has already been returned.",
+                                            'already_returned'))
+            else:
+                closing[loan_id] = random_date_after(loan['borrowDate'])
+
+        if closing:
+            result = cls._get_collection().bulk_write([
+                UpdateOne({'_id': loan_id, 'returnDate': None},
+                          {'$set': {'returnDate': return_date, 'active': False, 'overdue': False, 'batch': nonce}})
+                for loan_id, return_date in closing.items()
+            ], ordered=False)
+
+            # Only if another request raced us: find out which loans we actually closed
+            if result.modified_count < len(closing):
+                closed_by_us = {
+                    loan['_id'] for loan in cls._get_collection().find(
+                        {'_id': {'$in': list(closing)}, 'batch': nonce}, {'_id': 1})
+                }
+                for loan_id in list(closing):
+                    if loan_id not in closed_by_us:
+                        title = books.get(loans[loan_id]['book'], {}).get('title')
+                        outcomes.append(LoanOutcome(str(loan_id), title, False, "Loan has already been returned.",
+                                                    'already_returned'))
+                        del closing[loan_id]
+
+        # One increment per book, however many of its copies came back
+        returned_per_book = {}
+        for loan_id in closing:
+            book_id = loans[loan_id]['book']
+            returned_per_book[book_id] = returned_per_book.get(book_id, 0) + 1
+
+        if returned_per_book:
+            Book._get_collection().bulk_write([
+                UpdateOne({'_id': book_id}, copies_back(count, now))
+                for book_id, count in returned_per_book.items()
+            ], ordered=False)
+            Book.changed_many([books[book_id] for book_id in returned_per_book if book_id in books])
+            LoanEvent.append([
+                LoanEvent.of('returned', loan_id, member.pk, loans[loan_id]['book'], return_date)
+                for loan_id, return_date in closing.items()
+            ])
+
+        for loan_id in closing:
+            title = books.get(loans[loan_id]['book'], {}).get('title')
+            outcomes.append(LoanOutcome(str(loan_id), title, True, f"Returned '{title}'."))
+        count_outcomes('return', outcomes)
+        return outcomes
+
+    @classmethod
+    def renew_many(cls, member, loan_ids):
+        """
+        Renew several of a member's loans at once: load loans and books, then one
+        bulk_write of conditional updates (still unreturned, fewer than 2 renewals).
+        Returns a list of LoanOutcome, one per requested loan id.
+        """
+        loans, books, outcomes = cls._load_batch(member, loan_ids)
+        nonce = ObjectId()  # tells this request's writes apart from a concurrent identical one
+
+        renewing = {}  # loan id -> (new borrow date, new due date)
+        for loan_id, loan in loans.items():
+            title = books.get(loan['book'], {}).get('title')
+            if loan.get('returnDate'):
+                outcomes.append(LoanOutcome(str(loan_id), title, False,
+                                            "Cannot renew a loan that has already been returned.",
+                                            'already_returned'))
+            elif loan.get('renewCount', 0) >= 2:
+                outcomes.append(LoanOutcome(str(loan_id), title, False, "Cannot renew loan more than 2 times.",
+                                            'renewal_limit'))
+            else:
+                borrow_date = random_date_after(loan['borrowDate'])
+                renewing[loan_id] = (borrow_date, borrow_date + timedelta(weeks=2))
+
+        if renewing:
+            result = cls._get_collection().bulk_write([
+                # Only from the renewal count we read, so a repeated request cannot renew twice
+                UpdateOne({'_id': loan_id, 'returnDate': None, 'renewCount': renewed_from(loans[loan_id])},
+                          {'$set': {'borrowDate': borrow_date, 'dueDate': due_date, 'overdue': False,
+                                    'batch': nonce},
+                           '$inc': {'renewCount': 1}})
+                for loan_id, (borrow_date, due_date) in renewing.items()
+            ], ordered=False)
+
+            # Only if another request raced us: find out which renewals were applied
+            if result.modified_count < len(renewing):
+                applied = {
+                    loan['_id'] for loan in cls._get_collection().find(
+                        {'_id': {'$in': list(renewing)}, 'batch': nonce}, {'_id': 1})
+                }
+                for loan_id in list(renewing):
+                    if loan_id not in applied:
+                        title = books.get(loans[loan_id]['book'], {}).get('title')
+                        outcomes.append(LoanOutcome(str(loan_id), title, False, "Loan could not be renewed.",
+                                                    'conflict'))
+                        del renewing[loan_id]
+
+        if renewing:
+            now = datetime.utcnow()
+            LoanEvent.append([
+                LoanEvent.of('renewed', loan_id, member.pk, loans[loan_id]['book'], now) for loan_id in renewing
+            ])
+
+        for loan_id, (_, due_date) in renewing.items():
+            title = books.get(loans[loan_id]['book'], {}).get('title')
+            outcomes.append(LoanOutcome(str(loan_id), title, True,
+                                        f"Renewed '{title}', due {due_date.strftime('%Y-%m-%d')}."))
+        count_outcomes('renew', outcomes)
+        return outcomes
 
     # ----------------------------
     # DELETE loan
     # ----------------------------
+    @tracked('delete')
     def delete_loan(self):
         """Delete a loan only if it has been returned."""
         if not self.returnDate:
-            raise ValueError("Cannot delete a loan that has not been returned.")
+            raise LoanError("Cannot delete a loan that has not been returned.", 'not_returned')
+        # Tombstone first, so an archiving batch that read the loan cannot bring it back
+        LoanArchive.bury(self.id)
         self.delete()
+        LoanEvent.append([LoanEvent.of('deleted', self.id, self._member_id(), self.book_id(), datetime.utcnow())])
+
+
+class LoanArchive(Routed, db.Document):
+    """
+    Returned loans moved out of `loans` by Loan.archive_returned(), kept for the
+    members' loan history (Loan.get_member_history) and the statistics rebuild.
+    """
+    member = db.ReferenceField(User, required=True)
+    book = db.ReferenceField(Book, required=True)
+    borrowDate = db.DateTimeField()
+    dueDate = db.DateTimeField()
+    returnDate = db.DateTimeField()
+    renewCount = db.IntField(default=0)
+    archivedAt = db.DateTimeField()
+    deleted = db.BooleanField()  # tombstone of a deleted loan: only _id and this flag are left
+
+    mongo_route = 'members'  # read preference / write concern, see app.mongo
+    meta = {
+        'collection': 'loans_archive',
+        'auto_create_index': False,
+        'indexes': [
+            # get_member_history: a member's archived loans, newest first
+            ('member', '-borrowDate', '-_id'),
+        ],
+    }
+
+    @classmethod
+    def bury(cls, loan_id):
+        """
+        Replace a loan's archived copy (or its future one) with a tombstone. Tombstones
+        have no member, so the history and the Delete button never find them.
+        """
+        cls._get_collection().replace_one({'_id': loan_id}, {'deleted': True}, upsert=True)
+
+    @tracked('delete')
+    def delete_loan(self):
+        """Delete an archived loan (the Delete button of the loan history)."""
+        LoanArchive.bury(self.id)
+        member, book = self._data.get('member'), self._data.get('book')
+        LoanEvent.append([LoanEvent.of('deleted', self.id, getattr(member, 'id', member),
+                                       getattr(book, 'id', book), datetime.utcnow())])
+
+
+class LoanEvent(Routed, db.Document):
+    """
+    Append-only outbox of loan changes, one document per change, written by Loan's
+    methods right after the change itself. Consumers (app.outbox) read it in _id
+    order to update statistics and caches outside the request.
+    """
+    id = db.ObjectIdField(primary_key=True)
+    type = db.StringField(required=True, choices=('borrowed', 'renewed', 'returned', 'deleted'))
+    loan = db.ObjectIdField(required=True)
+    member = db.ObjectIdField()
+    book = db.ObjectIdField()
+    at = db.DateTimeField()       # when it happened on the loan: borrow / return date, time of renewal
+    origin = db.StringField()     # 'host:pid' of the process that wrote it
+    created = db.DateTimeField()  # when it was written
+
+    mongo_route = 'members'  # written next to the loans, see app.mongo
+    meta = {
+        'collection': 'loan_events',
+        'auto_create_index': False,
+        'indexes': [
+            # Events are kept for 90 days, long after every consumer has read them
+            {'fields': ['created'], 'expireAfterSeconds': 90 * 24 * 3600, 'name': 'loan_events_expiry'},
+        ],
+    }
+
+    @staticmethod
+    def of(event_type, loan_id, member_id, book_id, at):
+        """Raw event document for append(). The _id is taken now, so ids follow write order closely."""
+        from app.outbox import outbox
+
+        return {'_id': ObjectId(), 'type': event_type, 'loan': loan_id, 'member': member_id, 'book': book_id,
+                'at': at, 'origin': outbox.origin, 'created': datetime.utcnow()}
+
+    @classmethod
+    def append(cls, events):
+        """Write events made by of() in one round trip."""
+        if events:
+            cls._get_collection().insert_many(events, ordered=False)
+
+
+class LoanEventCheckpoint(Routed, db.Document):
+    """Position of a shared app.outbox consumer in loan_events, and the process holding its lease."""
+    id = db.StringField(primary_key=True)  # consumer name
+    position = db.ObjectIdField()          # _id of the last event handled
+    owner = db.StringField()
+    leaseUntil = db.DateTimeField()
+    updated = db.DateTimeField()
+
+    mongo_route = 'members'
+    meta = {'collection': 'loan_event_checkpoints', 'auto_create_index': False}
+
+
+class CirculationStat(Routed, db.Document):
+    """
+    Pre-aggregated loan counters (borrows, renewals, returns), one document per book,
+    category, genre and day plus one overall total, so reports read a handful of
+    documents instead of scanning loans. Kept current by the 'stats' consumer of the
+    loan_events outbox (app.outbox); rebuild() recomputes everything from the loans collection.
+
+    Ids are '<kind>:<key>', e.g. 'book:<book id>', 'genre:Fantasy', 'day:2024-05-01', 'total:all'.
+    Day counters use the date the event is recorded for on the loan (borrowDate,
+    returnDate) and the day a renewal was made.
+    """
+    id = db.StringField(primary_key=True)
+    kind = db.StringField(required=True)  # 'total', 'book', 'category', 'genre' or 'day'
+    key = db.StringField()
+    borrows = db.IntField(default=0)
+    renewals = db.IntField(default=0)
+    returns = db.IntField(default=0)
+
+    mongo_route = 'reports'  # read preference / write concern, see app.mongo
+    meta = {
+        'collection': 'stats',
+        'auto_create_index': False,
+        'indexes': [
+            # top(): most borrowed books / categories / genres
+            ('kind', '-borrows'),
+        ],
+    }
+
+    EVENTS = ('borrows', 'renewals', 'returns')
+
+    @staticmethod
+    def _scopes(book, when=None):
+        """(kind, key) pairs a loan event on `book` (a raw document) counts towards."""
+        yield 'total', 'all'
+        yield 'book', str(book['_id'])
+        if book.get('category'):
+            yield 'category', book['category']
+        for genre in set(book.get('genres') or []):
+            yield 'genre', genre
+        if when is not None:
+            yield 'day', when.strftime('%Y-%m-%d')
+
+    @classmethod
+    def record(cls, event, items):
+        """
+        Count one `event` ('borrows', 'renewals' or 'returns') per (book, when) item,
+        book being a raw document with _id, category and genres. All counters are
+        updated with one unordered bulk_write of upserts.
+        """
+        increments = {}
+        for book, when in items:
+            for scope in cls._scopes(book, when):
+                increments[scope] = increments.get(scope, 0) + 1
+        if not increments:
+            return
+        cls._get_collection().bulk_write([
+            UpdateOne({'_id': f'{kind}:{key}'},
+                      {'$inc': {event: count}, '$setOnInsert': {'kind': kind, 'key': key}},
+                      upsert=True)
+            for (kind, key), count in increments.items()
+        ], ordered=False)
+
+    @staticmethod
+    def _row(doc):
+        """Plain dict for a stats document, with active = borrows - returns."""
+        row = {'kind': doc['kind'], 'key': doc['key']}
+        row.update({event: doc.get(event, 0) for event in CirculationStat.EVENTS})
+        row['active'] = row['borrows'] - row['returns']
+        return row
+
+    @classmethod
+    def get(cls, kind, key):
+        """Counters for one scope (zeros if nothing was recorded yet)."""
+        doc = cls._get_collection().find_one({'_id': f'{kind}:{key}'}) or {'kind': kind, 'key': key}
+        return cls._row(doc)
+
+    @classmethod
+    def top(cls, kind, limit=10):
+        """Scopes of a kind ordered by borrows, most borrowed first (limit=None for all)."""
+        cursor = cls._get_collection().find({'kind': kind}).sort([('kind', 1), ('borrows', -1)])
+        if limit:
+            cursor = cursor.limit(limit)
+        return [cls._row(doc) for doc in cursor]
+
+    @classmethod
+    def days(cls, start, end):
+        """Counters for every day from start to end (dates, inclusive), oldest first."""
+        keys = [(start + timedelta(days=n)).strftime('%Y-%m-%d') for n in range((end - start).days + 1)]
+        docs = {doc['key']: doc for doc in cls._get_collection().find({'_id': {'$in': [f'day:{k}' for k in keys]}})}
+        return [cls._row(docs.get(key, {'kind': 'day', 'key': key})) for key in keys]
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute all counters from the loans and loans_archive collections with
+        aggregation pipelines, writing them to a scratch collection that then replaces
+        `stats` in one rename. Deleted loans are not counted, and renewals have no day
+        (loans do not keep renewal dates). Events recorded while this runs may be lost,
+        so run it when the library is quiet. Returns the number of stats documents written.
+        """
+        counters = {}
+        # Both tiers run the same pipelines; their counts add up per scope
+        for model in (Loan, LoanArchive):
+            loans = routing.collection(model._get_collection(), 'reports')
+
+            per_book = loans.aggregate([
+                {'$match': {'deleted': {'$ne': True}}},  # tombstones of deleted archived loans
+                {'$group': {
+                    '_id': '$book',
+                    'borrows': {'$sum': 1},
+                    'renewals': {'$sum': {'$ifNull': ['$renewCount', 0]}},
+                    'returns': {'$sum': {'$cond': [{'$ifNull': ['$returnDate', False]}, 1, 0]}},
+                }},
+                {'$lookup': {'from': Book._get_collection_name(), 'localField': '_id',
+                             'foreignField': '_id', 'as': 'book'}},
+                {'$unwind': {'path': '$book', 'preserveNullAndEmptyArrays': True}},
+                {'$project': {'borrows': 1, 'renewals': 1, 'returns': 1,
+                              'category': '$book.category', 'genres': '$book.genres'}},
+            ])
+            per_day = {
+                event: loans.aggregate([
+                    {'$match': {field: {'$ne': None}}},
+                    {'$group': {'_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': f'${field}'}},
+                                'count': {'$sum': 1}}},
+                ])
+                for event, field in (('borrows', 'borrowDate'), ('returns', 'returnDate'))
+            }
+
+            for row in per_book:
+                for scope in cls._scopes(row):
+                    totals = counters.setdefault(scope, dict.fromkeys(cls.EVENTS, 0))
+                    for event in cls.EVENTS:
+                        totals[event] += row[event]
+            for event, rows in per_day.items():
+                for row in rows:
+                    counters.setdefault(('day', row['_id']), dict.fromkeys(cls.EVENTS, 0))[event] += row['count']
+
+        scratch = cls._get_collection().database[f'{cls._get_collection_name()}_rebuild']
+        scratch.drop()
+        scratch.create_index([('kind', 1), ('borrows', -1)])
+        if counters:
+            scratch.insert_many([
+                {'_id': f'{kind}:{key}', 'kind': kind, 'key': key, **totals}
+                for (kind, key), totals in counters.items()
+            ])
+            scratch.rename(cls._get_collection_name(), dropTarget=True)
+        else:
+            scratch.drop()
+            cls._get_collection().delete_many({})
+        return len(counters)
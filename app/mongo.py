@@ -0,0 +1,195 @@
+"""
+MongoDB connection settings from the environment, and per-route read/write options.
+
+mongo_settings_from_env() builds MONGODB_SETTINGS in create_app(). Every variable
+is optional; without any of them the app connects to localhost/libraryDB as before.
+
+    MONGODB_URI                          mongodb:// or mongodb+srv:// URI (may name the database)
+    MONGODB_DB                           database name when the URI has none (libraryDB)
+    MONGODB_MAX_POOL_SIZE                connections per worker process (pymongo: 100)
+    MONGODB_MIN_POOL_SIZE                connections kept open when idle (pymongo: 0)
+    MONGODB_MAX_CONNECTING               connections a pool opens at once (pymongo: 2)
+    MONGODB_MAX_IDLE_TIME_MS             close pooled connections idle this long
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS        how long a request waits for a pooled connection
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS  how long to look for a suitable server (pymongo: 30000)
+    MONGODB_CONNECT_TIMEOUT_MS           TCP connect timeout
+    MONGODB_SOCKET_TIMEOUT_MS            per-operation network timeout
+    MONGODB_COMPRESSORS                  e.g. 'zstd,snappy,zlib' (needs the matching packages)
+    MONGODB_READ_PREFERENCE              client default, e.g. 'primary'
+    MONGODB_MAX_STALENESS_SECONDS        for secondary reads (at least 90)
+    MONGODB_W, MONGODB_JOURNAL, MONGODB_WTIMEOUT_MS   client default write concern
+
+Models are grouped into routes, each with its own read preference and write concern:
+
+    catalogue   Book, CatalogueVersion   MONGODB_CATALOGUE_READ_PREFERENCE, MONGODB_CATALOGUE_W
+    members     User, Loan               MONGODB_MEMBERS_READ_PREFERENCE, MONGODB_MEMBERS_W
+    reports     CirculationStat and the overdue report
+                                         MONGODB_REPORTS_READ_PREFERENCE, MONGODB_REPORTS_W
+
+so catalogue pages and reports can read from secondaries while loans stay on the
+primary. Writes always go to the primary; conditional updates (borrow, return)
+never act on a stale read.
+
+The client is created with connect=False and discarded in forked children, so a
+pre-fork server (gunicorn --preload) gives every worker its own pool, opened on
+the worker's first query rather than all at once in the master.
+"""
+import os
+
+from pymongo import WriteConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.uri_parser import parse_uri
+
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+# Environment variable -> MongoClient option, for the integer options
+INT_OPTIONS = {
+    'MONGODB_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGODB_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGODB_MAX_CONNECTING': 'maxConnecting',
+    'MONGODB_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGODB_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGODB_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+    'MONGODB_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGODB_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+}
+
+ROUTES = ('catalogue', 'members', 'reports')
+
+
+def read_preference(name, max_staleness=-1):
+    """pymongo read preference for a mode name such as 'secondaryPreferred'."""
+    try:
+        mode = READ_PREFERENCES[name]
+    except KeyError:
+        raise ValueError(f"Unknown MongoDB read preference '{name}', "
+                         f"expected one of {', '.join(READ_PREFERENCES)}.") from None
+    return mode() if mode is Primary else mode(max_staleness=max_staleness)
+
+
+def _w(value):
+    """Write concern 'w' from the environment: a number of nodes or a tag such as 'majority'."""
+    return int(value) if value.isdigit() else value
+
+
+def _with_database(uri, db):
+    """The URI with `db` as its database, unless it already names one."""
+    if parse_uri(uri)['database']:
+        return uri
+    base, _, query = uri.partition('?')
+    return f"{base.rstrip('/')}/{db}" + (f"?{query}" if query else '')
+
+
+def mongo_settings_from_env(environ=os.environ):
+    """MONGODB_SETTINGS for flask-mongoengine from the environment (see the module docstring)."""
+    db = environ.get('MONGODB_DB', 'libraryDB')
+    uri = environ.get('MONGODB_URI')
+    settings = {'host': _with_database(uri, db)} if uri else {'db': db, 'host': 'localhost', 'port': 27017}
+
+    # Pool and sockets are opened on first use, in whichever process makes it
+    settings['connect'] = False
+
+    for variable, option in INT_OPTIONS.items():
+        if environ.get(variable):
+            settings[option] = int(environ[variable])
+    if environ.get('MONGODB_COMPRESSORS'):
+        settings['compressors'] = environ['MONGODB_COMPRESSORS']
+
+    max_staleness = int(environ.get('MONGODB_MAX_STALENESS_SECONDS', -1))
+    settings['read_preference'] = read_preference(environ.get('MONGODB_READ_PREFERENCE', 'primary'),
+                                                  max_staleness)
+
+    if environ.get('MONGODB_W'):
+        settings['w'] = _w(environ['MONGODB_W'])
+    if environ.get('MONGODB_JOURNAL'):
+        settings['journal'] = environ['MONGODB_JOURNAL'].lower() in ('1', 'true', 'yes')
+    if environ.get('MONGODB_WTIMEOUT_MS'):
+        settings['wTimeoutMS'] = int(environ['MONGODB_WTIMEOUT_MS'])
+    return settings
+
+
+def mongo_routes_from_env(environ=os.environ):
+    """MONGODB_ROUTES: {route: {'read_preference', 'max_staleness', 'w'}} for the routes configured."""
+    routes = {}
+    for route in ROUTES:
+        options = {}
+        if environ.get(f'MONGODB_{route.upper()}_READ_PREFERENCE'):
+            options['read_preference'] = environ[f'MONGODB_{route.upper()}_READ_PREFERENCE']
+            options['max_staleness'] = int(environ.get('MONGODB_MAX_STALENESS_SECONDS', -1))
+        if environ.get(f'MONGODB_{route.upper()}_W'):
+            options['w'] = _w(environ[f'MONGODB_{route.upper()}_W'])
+        if options:
+            routes[route] = options
+    return routes
+
+
+def _forget_inherited_clients():
+    """In a forked child: drop the parent's MongoClient so this process creates its own."""
+    from mongoengine import Document, connection
+    from mongoengine.base.common import _get_documents_by_db
+
+    for alias in list(connection._connections):
+        connection._connections.pop(alias, None)
+        if connection._dbs.pop(alias, None) is not None:
+            for document in _get_documents_by_db(alias, connection.DEFAULT_CONNECTION_NAME):
+                if issubclass(document, Document):
+                    document._disconnect()
+    routing.clear()
+
+
+class MongoRouting:
+    """Per-route read preference and write concern, applied to the models' collections."""
+
+    def __init__(self):
+        self.routes = {}
+        self._collections = {}
+        self._fork_hook = False
+
+    def init_app(self, app):
+        self.routes = {}
+        for route, spec in app.config.get('MONGODB_ROUTES', {}).items():
+            options = {}
+            if spec.get('read_preference'):
+                options['read_preference'] = read_preference(spec['read_preference'],
+                                                             spec.get('max_staleness', -1))
+            if spec.get('w') is not None:
+                options['write_concern'] = WriteConcern(w=spec['w'])
+            self.routes[route] = options
+        self.clear()
+
+        if not self._fork_hook and hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_forget_inherited_clients)
+            self._fork_hook = True
+
+    def clear(self):
+        self._collections = {}
+
+    def collection(self, collection, route):
+        """The collection with the route's options (the same object if the route has none)."""
+        options = self.routes.get(route)
+        if not options:
+            return collection
+        key = (route, collection.full_name)
+        cached = self._collections.get(key)
+        if cached is None or cached[0] is not collection:
+            cached = (collection, collection.with_options(**options))
+            self._collections[key] = cached
+        return cached[1]
+
+
+routing = MongoRouting()
+
+
+class Routed:
+    """Mixin for models whose collection uses the options of the route named by `mongo_route`."""
+    mongo_route = None
+
+    @classmethod
+    def _get_collection(cls):
+        return routing.collection(super()._get_collection(), cls.mongo_route)
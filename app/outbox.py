@@ -0,0 +1,354 @@
+"""
+Consumers of the loan_events outbox.
+
+Loan's create/renew/return/delete methods append a LoanEvent for every change, in
+the same method right after the loan write. MongoDB could only make the two
+writes atomic inside a transaction (replica sets only, and MongoEngine cannot
+join a session), so a process dying between them loses that event; `flask
+rebuild-stats` recomputes the statistics from the loans themselves.
+
+Work that only has to follow a change runs in consumers that read the events
+in batches, outside the request:
+
+    stats            CirculationStat counters (one process at a time)
+    catalogue-cache  in every worker: drop cached listings and lookups of books
+                     whose availability another worker changed
+
+A consumer is a Consumer subclass registered with outbox.register():
+
+    class OverdueNotices(Consumer):
+        name = 'overdue-notices'
+        types = ('returned',)
+
+        def handle(self, events):
+            books = book_details(events)
+            ...
+
+Shared consumers (the default) run in one process at a time: a batch is taken
+under a lease on the consumer's document in loan_event_checkpoints, and the
+checkpoint (the _id of the last event handled) is saved after the batch, so
+every event is handled at least once. A batch that raises is retried on the
+next poll. Per-process consumers (shared = False) run in every worker, from the
+events written after the worker started.
+
+Events are read in _id order once they are LOAN_EVENTS_SETTLE_SECONDS old, so an
+event that took its id just before another but was written just after it is
+not skipped.
+
+Configured in create_app():
+
+    LOAN_EVENTS_CONSUMERS        'thread': a daemon thread polls every LOAN_EVENTS_POLL seconds,
+                                 started by the first request a worker process serves (so
+                                 CLI commands and a pre-fork master never poll); 'off': none
+                                 in the app, run `flask consume-loan-events` as its own process
+    LOAN_EVENTS_BATCH_SIZE       events per batch
+    LOAN_EVENTS_SETTLE_SECONDS   age an event must reach before it is read
+    LOAN_EVENTS_LEASE_SECONDS    how long a process keeps a shared consumer after its last batch
+
+replay() runs stored (or given) events through consumers here and now, without
+leases or checkpoints: for tests, and to rebuild what a consumer maintains
+(`flask replay-loan-events`). Only consumers whose handle() can see an event
+twice without harm (replayable = True) are replayed; the stats counters would
+be counted twice, so they are rebuilt with `flask rebuild-stats` instead.
+"""
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.metrics import LOAN_EVENTS_CONSUMED, LOAN_EVENT_BATCHES_FAILED
+
+EVENT_TYPES = ('borrowed', 'renewed', 'returned', 'deleted')
+
+
+class Consumer:
+    """Handles batches of loan events. Subclasses set name (and types) and implement handle()."""
+    name = None
+    types = EVENT_TYPES  # event types handed to handle()
+    shared = True        # False: every worker process runs its own copy
+    replayable = True    # False: handling an event twice corrupts its result, so replay() skips it
+
+    def handle(self, events):
+        """Process a batch of raw event documents, oldest first."""
+        raise NotImplementedError
+
+
+def book_details(events, fields=('title', 'slug', 'category', 'genres')):
+    """{book id: raw book document with `fields`} for the books of a batch, in one query."""
+    from app.model import Book
+
+    ids = list({event['book'] for event in events if event.get('book')})
+    if not ids:
+        return {}
+    return {book['_id']: book for book in Book._get_collection().find({'_id': {'$in': ids}}, dict.fromkeys(fields, 1))}
+
+
+# --------------------------------------------------------------------------
+# Built-in consumers
+# --------------------------------------------------------------------------
+class StatsConsumer(Consumer):
+    """Counts borrows, renewals and returns in CirculationStat."""
+    name = 'stats'
+    types = ('borrowed', 'renewed', 'returned')
+    replayable = False  # counts are added, not set: `flask rebuild-stats` recomputes them
+    COUNTERS = {'borrowed': 'borrows', 'renewed': 'renewals', 'returned': 'returns'}
+
+    def handle(self, events):
+        from app.model import CirculationStat
+
+        books = book_details(events, ('category', 'genres'))
+        per_counter = {}
+        for event in events:
+            # A book removed since still counts towards the total and its own counter
+            book = books.get(event['book'], {'_id': event['book']})
+            per_counter.setdefault(self.COUNTERS[event['type']], []).append((book, event['at']))
+        for counter, items in per_counter.items():
+            CirculationStat.record(counter, items)
+
+
+class CatalogueCacheConsumer(Consumer):
+    """Drops this worker's cached copies of books whose availability another worker changed."""
+    name = 'catalogue-cache'
+    types = ('borrowed', 'returned')
+    shared = False
+
+    def handle(self, events):
+        from app.cache import cache
+        from app.snapshot import catalogue_snapshot
+
+        # This process already invalidated its own writes in the request
+        foreign = [event for event in events if event.get('origin') != outbox.origin]
+        for book in book_details(foreign).values():
+            cache.invalidate_book(book['title'], book['category'], book.get('slug'))
+        if foreign:
+            catalogue_snapshot.touch()
+
+
+# --------------------------------------------------------------------------
+# Running consumers
+# --------------------------------------------------------------------------
+class Outbox:
+    def __init__(self):
+        self.consumers = {}
+        self.app = None
+        self.batch_size = 500
+        self.poll = 1.0
+        self.settle = 2.0
+        self.lease = 30
+        self._pid = None
+        self._started = datetime.utcnow()
+        self._positions = {}  # per-process consumers: name -> last event id
+        self._origin = None
+        self._thread = None
+        self._thread_pid = None  # process the poll thread runs in
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config.get('LOAN_EVENTS_BATCH_SIZE', 500)
+        self.poll = app.config.get('LOAN_EVENTS_POLL', 1.0)
+        self.settle = app.config.get('LOAN_EVENTS_SETTLE_SECONDS', 2.0)
+        self.lease = app.config.get('LOAN_EVENTS_LEASE_SECONDS', 30)
+        if app.config.get('LOAN_EVENTS_CONSUMERS', 'thread') == 'thread':
+            app.before_request(self._start_in_worker)
+
+    def register(self, consumer):
+        self.consumers[consumer.name] = consumer
+        return consumer
+
+    @property
+    def origin(self):
+        """'host:pid' of this process, stored on the events it writes."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._origin = f"{socket.gethostname()}:{self._pid}"
+        return self._origin
+
+    @property
+    def owner(self):
+        """Lease holder name: the process and thread (a CLI loop and the poll thread may share a process)."""
+        return f"{self.origin}:{threading.get_ident()}"
+
+    # ----------------------------
+    # Reading events
+    # ----------------------------
+    def _read(self, consumer, after):
+        from app.model import LoanEvent
+
+        settled = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=self.settle))
+        query = {'_id': {'$lt': settled}, 'type': {'$in': list(consumer.types)}}
+        if after is not None:
+            query['_id']['$gt'] = after
+        return list(LoanEvent._get_collection().find(query, sort=[('_id', 1)], limit=self.batch_size))
+
+    def _handle(self, consumer, events):
+        try:
+            consumer.handle(events)
+        except Exception:
+            LOAN_EVENT_BATCHES_FAILED.inc(consumer=consumer.name)
+            raise
+        LOAN_EVENTS_CONSUMED.inc(len(events), consumer=consumer.name)
+
+    # ----------------------------
+    # One batch of a consumer
+    # ----------------------------
+    def run_batch(self, consumer):
+        """Handle the consumer's next batch; returns the number of events (0 if none, or its lease is held elsewhere)."""
+        if not consumer.shared:
+            with self._lock:
+                after = self._positions.setdefault(consumer.name, ObjectId.from_datetime(self._started))
+                events = self._read(consumer, after)
+                if events:
+                    self._handle(consumer, events)
+                    self._positions[consumer.name] = events[-1]['_id']
+                return len(events)
+
+        from app.model import LoanEventCheckpoint
+
+        checkpoints = LoanEventCheckpoint._get_collection()
+        now = datetime.utcnow()
+        try:
+            checkpoint = checkpoints.find_one_and_update(
+                {'_id': consumer.name,
+                 '$or': [{'owner': self.owner}, {'leaseUntil': {'$lt': now}}, {'leaseUntil': None}]},
+                {'$set': {'owner': self.owner, 'leaseUntil': now + timedelta(seconds=self.lease)}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            return 0  # another process (or seek()) holds the lease
+
+        events = self._read(consumer, checkpoint.get('position'))
+        if events:
+            self._handle(consumer, events)
+            checkpoints.update_one(
+                {'_id': consumer.name, 'owner': self.owner},
+                {'$set': {'position': events[-1]['_id'], 'updated': datetime.utcnow()}},
+            )
+        return len(events)
+
+    def drain(self, names=None):
+        """Run consumers until they are caught up; returns {name: events handled}."""
+        handled = {}
+        for name, consumer in self.consumers.items():
+            if names and name not in names:
+                continue
+            handled[name] = 0
+            while True:
+                count = self.run_batch(consumer)
+                handled[name] += count
+                if count < self.batch_size:
+                    break
+        return handled
+
+    def seek(self, name, position=None):
+        """
+        Move a shared consumer's checkpoint (default: past every event written so far).
+        Takes the consumer's lease over first, so the process holding it can neither renew
+        it nor save its checkpoint afterwards, waits for the batch that process may be
+        running to end with its lease, then saves the position and releases the lease.
+        """
+        from app.model import LoanEventCheckpoint
+
+        checkpoints = LoanEventCheckpoint._get_collection()
+        position = position or ObjectId.from_datetime(datetime.utcnow() + timedelta(seconds=1))
+        now = datetime.utcnow()
+        # Twice the lease: ours must outlast the previous holder's, which may have just been renewed
+        takeover = {'$set': {'owner': self.owner, 'leaseUntil': now + timedelta(seconds=2 * self.lease)}}
+        try:
+            previous = checkpoints.find_one_and_update({'_id': name}, takeover, upsert=True)
+        except DuplicateKeyError:
+            # A consumer created the checkpoint at the same moment; it exists now
+            previous = checkpoints.find_one_and_update({'_id': name}, takeover)
+        if previous and previous.get('owner') not in (None, self.owner):
+            held_until = previous.get('leaseUntil')
+            if held_until is not None and held_until > now:
+                time.sleep((held_until - now).total_seconds())
+
+        result = checkpoints.update_one(
+            {'_id': name, 'owner': self.owner},
+            {'$set': {'position': position, 'updated': datetime.utcnow(), 'owner': None, 'leaseUntil': None}},
+        )
+        if not result.modified_count:
+            raise RuntimeError(f"The '{name}' consumer's lease was taken by another seek.")
+
+    def replay(self, names=None, events=None, since=None, until=None):
+        """
+        Run events through consumers in this process, without leases or checkpoints.
+        `events` is a list of event documents; without it the stored events between
+        `since` and `until` (datetimes) are read. Returns {name: events handled}.
+        Consumers that are not replayable are skipped, or raise ValueError if named.
+        """
+        from app.model import LoanEvent
+
+        refused = [name for name in names or () if name in self.consumers and not self.consumers[name].replayable]
+        if refused:
+            raise ValueError(f"Consumer(s) {', '.join(refused)} cannot be replayed: "
+                             "their events would be counted twice.")
+
+        if events is None:
+            query = {}
+            if since or until:
+                query['_id'] = {}
+                if since:
+                    query['_id']['$gte'] = ObjectId.from_datetime(since)
+                if until:
+                    query['_id']['$lt'] = ObjectId.from_datetime(until)
+            events = list(LoanEvent._get_collection().find(query, sort=[('_id', 1)]))
+
+        handled = {}
+        for name, consumer in self.consumers.items():
+            if names and name not in names or not consumer.replayable:
+                continue
+            mine = [event for event in events if event['type'] in consumer.types]
+            for start in range(0, len(mine), self.batch_size):
+                self._handle(consumer, mine[start:start + self.batch_size])
+            handled[name] = len(mine)
+        return handled
+
+    # ----------------------------
+    # Background thread
+    # ----------------------------
+    def start(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='loan-events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+
+    def _start_in_worker(self):
+        """Start the poll thread on the first request of this process."""
+        if self._thread_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread_pid == os.getpid():
+                return
+            # Threads do not survive fork: a worker forked from a process that polled starts afresh
+            self._started = datetime.utcnow()
+            self._positions = {}
+            self._lock = threading.Lock()
+            self.start()
+            self._thread_pid = os.getpid()
+
+    def _run(self):
+        while not self._stop.wait(self.poll):
+            with self.app.app_context():
+                for name, consumer in self.consumers.items():
+                    try:
+                        while self.run_batch(consumer) == self.batch_size:
+                            pass
+                    except Exception:
+                        # The batch is retried on the next poll
+                        self.app.logger.exception("Loan event consumer '%s' failed.", name)
+
+
+outbox = Outbox()
+outbox.register(StatsConsumer())
+outbox.register(CatalogueCacheConsumer())
@@ -0,0 +1,29 @@
+"""
+Background overdue-loan sweeper.
+
+Loan.sweep_overdue() marks active loans past their due date as overdue. It can run:
+
+    - from cron, with `flask sweep-overdue`, or
+    - in-process, every OVERDUE_SWEEP_INTERVAL seconds (see app.periodic).
+
+The sweep is an idempotent update_many, so overlapping runs from several workers are harmless.
+"""
+from flask import current_app
+
+from app.periodic import PeriodicTask
+
+
+def sweep():
+    """One run of the in-process sweeper."""
+    from app.model import Loan
+
+    marked = Loan.sweep_overdue()
+    if marked:
+        current_app.logger.info("Marked %d loan(s) overdue.", marked)
+
+
+def init_app(app):
+    """Start the in-process sweeper if OVERDUE_SWEEP_INTERVAL is set."""
+    interval = app.config.get('OVERDUE_SWEEP_INTERVAL', 0)
+    if interval:
+        app.extensions['overdue_sweeper'] = PeriodicTask(app, interval, 'overdue-sweeper', sweep).start()
@@ -0,0 +1,87 @@
+"""
+Password hashing with a configurable algorithm and cost, run on a bounded thread pool.
+
+Configured in create_app():
+
+    PASSWORD_HASH_METHOD         Werkzeug method string, e.g. 'scrypt' or 'pbkdf2:sha256:600000'
+    PASSWORD_SALT_LENGTH         salt length for new hashes
+    PASSWORD_HASH_WORKERS        threads that hash/verify passwords
+    PASSWORD_HASH_MAX_PENDING    hash jobs allowed in flight (running + queued) at once
+    PASSWORD_HASH_WAIT           seconds a request waits for a slot before giving up
+
+Hashes made with another method or cost are upgraded (or downgraded) on the
+next successful login, see User.verify_password(). When every slot is taken the
+request fails fast with PasswordHashingBusy, so login storms cannot tie up all
+the workers that also serve the catalogue.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHashingBusy(Exception):
+    """Raised when no hashing slot frees up within PASSWORD_HASH_WAIT seconds."""
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = 'scrypt'
+        self.salt_length = 16
+        self.wait = 5.0
+        self._canonical_method = None
+        self._pool = None
+        self._slots = None
+        self._workers = 4
+        self._max_pending = 16
+        self._init_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+        self.salt_length = app.config.get('PASSWORD_SALT_LENGTH', 16)
+        self.wait = app.config.get('PASSWORD_HASH_WAIT', 5.0)
+        self._workers = app.config.get('PASSWORD_HASH_WORKERS', 4)
+        self._max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING', 16)
+        self._canonical_method = None
+        self._pool = None
+        self._slots = None
+
+    def _run(self, fn, *args):
+        """Run fn on the pool, holding one of the limited slots while it is queued and running."""
+        if self._pool is None:
+            # Created on first use so worker startup stays cheap (and after any fork)
+            with self._init_lock:
+                if self._pool is None:
+                    self._slots = threading.BoundedSemaphore(self._max_pending)
+                    self._pool = ThreadPoolExecutor(max_workers=self._workers,
+                                                    thread_name_prefix='password-hash')
+
+        if not self._slots.acquire(timeout=self.wait):
+            raise PasswordHashingBusy("Too many logins in progress, please try again in a moment.")
+        try:
+            return self._pool.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """Hash a password with the configured method and cost."""
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, stored_hash, password):
+        """Check a password against a stored hash (any method Werkzeug understands)."""
+        return self._run(check_password_hash, stored_hash, password)
+
+    @property
+    def canonical_method(self):
+        """Method string as it appears in new hashes, with the default cost filled in."""
+        if self._canonical_method is None:
+            sample = generate_password_hash('', self.method, self.salt_length)
+            self._canonical_method = sample.split('$', 1)[0]
+        return self._canonical_method
+
+    def needs_rehash(self, stored_hash):
+        """True if a stored hash was made with a different method or cost than configured."""
+        return stored_hash.split('$', 1)[0] != self.canonical_method
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,39 @@
+"""
+Periodic jobs on a daemon thread, for maintenance that can also run from cron.
+
+The jobs (app.overdue, app.archive) each have a CLI command for cron, which is
+the better choice with several worker processes, and an interval setting that
+runs them in-process instead; 0, the default, leaves the thread off so worker
+boot does no database work. Every job must tolerate overlapping runs from
+several workers.
+"""
+import threading
+
+
+class PeriodicTask:
+    """Calls job() inside an app context every `interval` seconds in a daemon thread."""
+
+    def __init__(self, app, interval, name, job):
+        self.app = app
+        self.interval = interval
+        self.name = name
+        self.job = job
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.job()
+                except Exception:
+                    # Run again on the next tick even if the database hiccups
+                    self.app.logger.exception("Periodic job '%s' failed.", self.name)
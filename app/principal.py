@@ -0,0 +1,77 @@
+"""
+Slim, cached identity for logged-in users.
+
+Flask-Login's user_loader runs on every authenticated request. Instead of loading
+the full User document each time, it returns a Principal (id, name, is_admin)
+from a small per-process TTL cache, so most requests resolve identity without a
+MongoDB query.
+
+User.save() invalidates the cached principal, so changes made through the app
+(password, admin flag) apply on the next request. Changes made directly in MongoDB
+show up within PRINCIPAL_CACHE_TTL seconds.
+"""
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from app.cache import MemoryBackend
+
+
+class Principal:
+    """Read-only stand-in for User with what requests need: id, name and admin flag."""
+    __slots__ = ('pk', 'name', 'is_admin')
+
+    # Flask-Login interface
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, pk, name, is_admin):
+        self.pk = pk
+        self.name = name
+        self.is_admin = is_admin
+
+    @property
+    def id(self):
+        return self.pk
+
+    def get_id(self):
+        return str(self.pk)
+
+    def __repr__(self):
+        return f"<Principal {self.pk} {self.name!r}{' admin' if self.is_admin else ''}>"
+
+
+class PrincipalCache:
+    def __init__(self):
+        self.backend = MemoryBackend(maxsize=10000, ttl=30)
+
+    def init_app(self, app):
+        self.backend = MemoryBackend(
+            maxsize=app.config.get('PRINCIPAL_CACHE_SIZE', 10000),
+            ttl=app.config.get('PRINCIPAL_CACHE_TTL', 30),
+        )
+
+    def load(self, user_id):
+        """Principal for a user id (from the session), or None if the user does not exist."""
+        principal = self.backend.get(user_id)
+        if principal is not None:
+            return principal
+
+        from app.model import User
+
+        try:
+            user = User.objects(pk=ObjectId(user_id)).only('name', 'is_admin').as_pymongo().first()
+        except InvalidId:
+            return None
+        if user is None:
+            return None
+
+        principal = Principal(user['_id'], user.get('name'), bool(user.get('is_admin', False)))
+        self.backend.set(user_id, principal)
+        return principal
+
+    def invalidate(self, user_id):
+        self.backend.delete(str(user_id))
+
+
+principals = PrincipalCache()
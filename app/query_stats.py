@@ -0,0 +1,164 @@
+"""
+Per-request MongoDB instrumentation from pymongo command events.
+
+A CommandListener registered before the MongoDB client is created counts the
+commands each request sends, the documents they return and the time they take.
+Configured in create_app():
+
+    QUERY_STATS_HEADERS   add X-DB-Queries / X-DB-Documents / X-DB-Time-ms and a
+                          Server-Timing entry to every response
+    QUERY_STATS_DETAIL    also keep the list of commands of each request (on with
+                          DEBUG_TB_ENABLED, for the toolbar panel in app.debug_panel)
+    SLOW_QUERY_MS         log commands at least this slow to the 'app.slow_queries'
+                          logger with the route and query shape (0 = off)
+
+Query shapes have every literal replaced by '?', so logs show which filter, sort
+and pipeline a route used without leaking values. Commands outside a request
+(CLI, background threads) are only considered for the slow-query log.
+"""
+import threading
+
+from flask import request
+from pymongo import monitoring
+
+# Connection handshake, auth and session bookkeeping, not queries the app made
+IGNORED_COMMANDS = {'hello', 'ismaster', 'isMaster', 'ping', 'buildinfo', 'buildInfo', 'saslStart',
+                    'saslContinue', 'getnonce', 'authenticate', 'endSessions'}
+
+# Command fields kept in query shapes
+SHAPE_FIELDS = ('filter', 'query', 'sort', 'projection', 'pipeline', 'updates', 'deletes', 'limit')
+MAX_DETAIL = 200  # commands kept per request when QUERY_STATS_DETAIL is on
+
+
+def _shape(value):
+    """Replace literals with '?', keeping keys and operators."""
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # Pipelines, bulk updates and $and/$or lists: the first element shows the shape
+        if value and isinstance(value[0], dict):
+            return [_shape(value[0])] + (['...'] if len(value) > 1 else [])
+        return '?'
+    return '?'
+
+
+def query_shape(command_name, command):
+    """e.g. {'find': 'books', 'filter': {'slug': '?'}, 'limit': '?'} for a slug lookup."""
+    shape = {command_name: command.get(command_name)}
+    for field in SHAPE_FIELDS:
+        if field in command:
+            # Sort and projection specs hold field names and directions, never user data
+            shape[field] = command[field] if field in ('sort', 'projection') else _shape(command[field])
+    return shape
+
+
+def _documents_returned(reply):
+    """Documents in a reply: cursor batches, or the document of a findAndModify."""
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or ())
+    if 'value' in reply:
+        return 1 if reply['value'] is not None else 0
+    return 0
+
+
+class RequestQueries:
+    """What one request sent to MongoDB."""
+    __slots__ = ('route', 'count', 'documents', 'micros', 'commands')
+
+    def __init__(self, route):
+        self.route = route
+        self.count = 0
+        self.documents = 0
+        self.micros = 0
+        self.commands = []  # (command name, collection, shape, ms, documents) with detail on
+
+    @property
+    def ms(self):
+        return self.micros / 1000
+
+
+class QueryStats(monitoring.CommandListener):
+    def __init__(self):
+        self.headers = True
+        self.detail = False
+        self.slow_ms = 100
+        self.logger = None
+        self._local = threading.local()
+        self._registered = False
+
+    def init_app(self, app):
+        """Register the listener (before db.init_app creates the client) and the request hooks."""
+        self.headers = app.config.get('QUERY_STATS_HEADERS', True)
+        self.detail = (app.config.get('QUERY_STATS_DETAIL', False)
+                       or app.config.get('DEBUG_TB_ENABLED', False))
+        self.slow_ms = app.config.get('SLOW_QUERY_MS', 100)
+        self.logger = app.logger.getChild('slow_queries')
+        if not self._registered:
+            monitoring.register(self)
+            self._registered = True
+
+        app.before_request(self._begin)
+        app.after_request(self._add_headers)
+        app.teardown_request(self._end)
+
+    def current(self):
+        """RequestQueries of the request running on this thread, or None."""
+        return getattr(self._local, 'current', None)
+
+    # ----------------------------
+    # Request hooks
+    # ----------------------------
+    def _begin(self):
+        self._local.current = RequestQueries(request.endpoint)
+
+    def _add_headers(self, response):
+        current = self.current()
+        if current is not None and self.headers:
+            response.headers['X-DB-Queries'] = str(current.count)
+            response.headers['X-DB-Documents'] = str(current.documents)
+            response.headers['X-DB-Time-ms'] = f"{current.ms:.1f}"
+            response.headers.add('Server-Timing', f'db;dur={current.ms:.1f};desc="{current.count} queries"')
+        return response
+
+    def _end(self, exc=None):
+        self._local.current = None
+
+    # ----------------------------
+    # pymongo CommandListener interface (called on the thread that sent the command)
+    # ----------------------------
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        # Kept until the reply arrives, for the shape of slow or detailed commands
+        pending = self._local.__dict__.setdefault('pending', {})
+        pending[event.request_id] = event.command
+
+    def succeeded(self, event):
+        self._finish(event, _documents_returned(event.reply))
+
+    def failed(self, event):
+        self._finish(event, 0)
+
+    def _finish(self, event, documents):
+        command = self._local.__dict__.get('pending', {}).pop(event.request_id, None)
+        if command is None:
+            return
+        ms = event.duration_micros / 1000
+        current = self.current()
+
+        if current is not None:
+            current.count += 1
+            current.documents += documents
+            current.micros += event.duration_micros
+            if self.detail and len(current.commands) < MAX_DETAIL:
+                current.commands.append((event.command_name, command.get(event.command_name),
+                                         query_shape(event.command_name, command), ms, documents))
+
+        if self.slow_ms and ms >= self.slow_ms:
+            self.logger.warning("Slow query (%.1f ms) from %s: %s", ms,
+                                current.route if current is not None else threading.current_thread().name,
+                                query_shape(event.command_name, command))
+
+
+query_stats = QueryStats()
@@ -0,0 +1,216 @@
+"""
+Rate limiting and admission control for the login, registration and loan endpoints.
+
+Rate limits: each endpoint in RATE_LIMITS gives every client a token bucket per
+scope, holding `requests` tokens and refilling continuously over `seconds`. A
+request takes one token from each of its buckets and is refused with 429 and a
+Retry-After header when one is empty; the tokens it already took from its other
+buckets are given back, so a refused request costs none. Scopes:
+
+    'ip'     the client address (request.remote_addr; behind a reverse proxy wrap
+             the app in werkzeug's ProxyFix so this is the client and not the proxy).
+             Requests without one (some WSGI servers, unix sockets) share one bucket
+    'user'   the logged-in user, whatever address the requests come from
+
+Admission control: at most MAX_CONCURRENT_REQUESTS requests run at once in a
+worker process. The next ones are refused straight away with 429 instead of
+queueing behind them, so a burst is shed before the worker's threads are
+saturated. /metrics and static files are always admitted.
+
+Configured in create_app():
+
+    RATE_LIMIT_BACKEND        'memory' (buckets per worker), 'redis' (shared by all workers) or 'none'
+    RATE_LIMIT_URL            redis:// URL for the shared backend (needs the `redis` package)
+    RATE_LIMIT_SIZE           buckets the memory backend keeps (least recently used dropped first)
+    RATE_LIMITS               {endpoint: {'ip': (requests, seconds), 'user': (requests, seconds),
+                                          'methods': ('POST',)}}; methods is optional (default: all)
+    MAX_CONCURRENT_REQUESTS   requests in flight per worker process (0 = no limit)
+    CONCURRENCY_RETRY_AFTER   Retry-After, in seconds, of a request refused for concurrency
+
+Refused requests are counted in requests_rejected_total{endpoint, reason}, reason
+being 'rate_ip', 'rate_user' or 'concurrency'.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, g, request
+from flask_login import current_user
+
+from app.metrics import REQUESTS_REJECTED
+
+# Endpoints that are never refused: monitoring must keep working under load
+EXEMPT_ENDPOINTS = frozenset({'static', 'metrics_endpoint'})
+SCOPES = ('user', 'ip')
+UNKNOWN_CLIENT = 'unknown'  # 'ip' bucket of the requests that come without an address
+
+
+class MemoryBuckets:
+    """Token buckets of this process."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, time.monotonic() of the last take)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, seconds):
+        """Take a token; returns 0 if there was one, else the seconds until there is."""
+        rate = capacity / seconds
+        now = time.monotonic()
+        with self._lock:
+            tokens, at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - at) * rate)
+            if tokens >= 1:
+                tokens, wait = tokens - 1, 0.0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # A dropped bucket starts full again, and the least recently used ones are the idle clients
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def refund(self, key, capacity, seconds):
+        """Give back a token taken by take()."""
+        with self._lock:
+            if key in self._buckets:
+                tokens, at = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + 1), at)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker process, updated atomically by a Lua script."""
+
+    # Redis's own clock, so workers on different hosts agree on how much has refilled.
+    # The wait is returned as a string: Lua numbers become integers on the way back.
+    SCRIPT = """
+        local capacity, rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local clock = redis.call('TIME')
+        local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+        local tokens = math.min(capacity, (tonumber(state[1]) or capacity) + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    """
+    # An expired bucket is full again: nothing to give back. take() caps the tokens at capacity.
+    REFUND = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then redis.call('HINCRBYFLOAT', KEYS[1], 'tokens', 1) end
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        import redis  # optional dependency, only needed for the shared backend
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(self.SCRIPT)
+        self._refund = self.client.register_script(self.REFUND)
+
+    def take(self, key, capacity, seconds):
+        return float(self._take(keys=[self.prefix + key], args=[capacity, capacity / seconds]))
+
+    def refund(self, key, capacity, seconds):
+        self._refund(keys=[self.prefix + key])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class Limiter:
+    def __init__(self):
+        self.backend = None
+        self.rules = {}
+        self.retry_after = 1
+        self._slots = None
+
+    def init_app(self, app):
+        backend = app.config.get('RATE_LIMIT_BACKEND', 'memory')
+        if backend == 'memory':
+            self.backend = MemoryBuckets(app.config.get('RATE_LIMIT_SIZE', 100000))
+        elif backend == 'redis':
+            self.backend = RedisBuckets(app.config['RATE_LIMIT_URL'])
+        elif backend == 'none':
+            self.backend = None
+        else:
+            raise ValueError(f"Unknown RATE_LIMIT_BACKEND '{backend}'.")
+        self.rules = app.config.get('RATE_LIMITS', {})
+
+        max_concurrent = app.config.get('MAX_CONCURRENT_REQUESTS', 0)
+        self._slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.retry_after = app.config.get('CONCURRENCY_RETRY_AFTER', 1)
+
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    # ----------------------------
+    # Request hooks
+    # ----------------------------
+    def _admit(self):
+        endpoint = request.endpoint
+        if endpoint in EXEMPT_ENDPOINTS:
+            return None
+
+        if self._slots is not None:
+            if not self._slots.acquire(blocking=False):
+                return self._reject('concurrency', self.retry_after)
+            g._admitted = True
+
+        rule = self.rules.get(endpoint)
+        if rule is None or self.backend is None or request.method not in rule.get('methods', (request.method,)):
+            return None
+        taken = []
+        for scope in SCOPES:
+            if scope not in rule:
+                continue
+            client = self._client(scope)
+            if client is None:
+                continue
+            key = f"{endpoint}:{scope}:{client}"
+            try:
+                wait = self.backend.take(key, *rule[scope])
+                if wait:
+                    # Refused: the buckets of the scopes that admitted it keep their tokens
+                    for taken_key, taken_scope in taken:
+                        self.backend.refund(taken_key, *rule[taken_scope])
+            except Exception:
+                # An unreachable shared store must not take the site down with it
+                current_app.logger.warning("Rate limit backend failed; request let through.", exc_info=True)
+                return None
+            if wait:
+                return self._reject('rate_' + scope, wait)
+            taken.append((key, scope))
+        return None
+
+    def _release(self, exc=None):
+        if g.pop('_admitted', False):
+            self._slots.release()
+
+    @staticmethod
+    def _client(scope):
+        """Who a bucket of this scope belongs to for the current request (None: the scope does not apply)."""
+        if scope == 'ip':
+            return request.remote_addr or UNKNOWN_CLIENT
+        # Only resolved for rules with a 'user' scope, so other requests load no user
+        return current_user.get_id() if current_user.is_authenticated else None
+
+    @staticmethod
+    def _reject(reason, wait):
+        REQUESTS_REJECTED.inc(endpoint=request.endpoint, reason=reason)
+        seconds = max(1, math.ceil(wait))
+        return Response(f"Too many requests, please try again in {seconds} second(s).", 429,
+                        {'Retry-After': str(seconds)}, mimetype='text/plain')
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+limiter = Limiter()
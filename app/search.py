@@ -0,0 +1,269 @@
+"""
+In-process inverted index for catalogue search.
+
+Indexes title, authors, genres and description of every book, with per-field
+weights. A query matches books that contain all its terms; the last term also
+matches as a prefix, for typeahead. Results are ranked by a TF-IDF score, and
+facet counts per category and genre come from the same match set, so a search
+never scans the books collection.
+
+The index is built on first use and kept in sync by Book.save(). Writes made by other
+worker processes are picked up by a rebuild once SEARCH_INDEX_MAX_AGE seconds have passed:
+it runs on a background thread into new structures while queries keep using the current
+index, and the finished index is swapped in under the lock, so no request waits for it.
+"""
+import math
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from heapq import nlargest
+
+FIELD_WEIGHTS = {'title': 10.0, 'authors': 5.0, 'genres': 3.0, 'description': 1.0}
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have her his in is it its of on or "
+    "she that the their them they this to was were will with you your".split()
+)
+MAX_PREFIX_EXPANSIONS = 50
+PREFIX_PENALTY = 0.5  # a prefix match counts half as much as a whole-word match
+REBUILD_RETRY = 30  # seconds before a failed background rebuild is tried again
+
+
+def tokenize(text, keep_stopwords=False):
+    """Lowercase, strip accents and split into alphanumeric words, dropping stopwords."""
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii').lower()
+    words = re.findall(r"[a-z0-9]+", text)
+    return words if keep_stopwords else [word for word in words if word not in STOPWORDS]
+
+
+class IndexedBook:
+    """What the index keeps per book: enough for facets and typeahead, nothing more."""
+    __slots__ = ('id', 'title', 'slug', 'category', 'genres', 'tokens')
+
+    def __init__(self, book_id, title, slug, category, genres, tokens):
+        self.id = book_id
+        self.title = title
+        self.slug = slug
+        self.category = category
+        self.genres = genres
+        self.tokens = tokens
+
+
+class SearchIndex:
+    def __init__(self):
+        self.max_age = 300
+        self._books = {}                       # book id -> IndexedBook
+        self._postings = defaultdict(dict)     # token -> {book id: weighted term frequency}
+        self._vocabulary = []                  # sorted tokens, for prefix lookups
+        self._vocabulary_dirty = False
+        self._built_at = None
+        self._replay = None                    # books saved while a build reads the collection
+        self._rebuilding = False
+        self._retry_at = 0.0
+        self.app = None
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        self.app = app
+        self.max_age = app.config.get('SEARCH_INDEX_MAX_AGE', 300)
+
+    # ----------------------------
+    # Building and syncing
+    # ----------------------------
+    def build(self):
+        """(Re)build the index from the books collection and swap it in."""
+        from app.model import Book
+
+        with self._lock:
+            self._replay = []  # saves from now on are applied to the new index too
+        books, postings = {}, defaultdict(dict)
+        try:
+            for book in Book.objects.only('title', 'slug', 'authors', 'genres', 'category', 'description').as_pymongo():
+                self._add(book, books, postings)
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+
+        with self._lock:
+            # The read may predate saves made meanwhile: re-apply them before the swap
+            for book in self._replay:
+                self._remove(book['_id'], books, postings)
+                self._add(book, books, postings)
+            self._replay = None
+            self._books, self._postings = books, postings
+            self._vocabulary = sorted(postings)
+            self._vocabulary_dirty = False
+            self._built_at = time.monotonic()
+
+    def invalidate(self):
+        """Rebuild in the background on the next query (e.g. after a bulk import)."""
+        with self._lock:
+            if self._built_at is not None:
+                self._built_at = float('-inf')
+
+    def update_book(self, book):
+        """Re-index one Book document after it was saved in this process."""
+        doc = {
+            '_id': book.id, 'title': book.title, 'slug': book.slug, 'authors': book.authors,
+            'genres': book.genres, 'category': book.category, 'description': book.description,
+        }
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append(doc)
+            if self._built_at is None:
+                return  # not built yet; the first query will index it
+            self._remove(book.id, self._books, self._postings)
+            self._add(doc, self._books, self._postings)
+            self._vocabulary_dirty = True
+
+    def _ensure_fresh(self):
+        if self._built_at is None:
+            self.build()  # first query of this process: nothing to answer from yet
+        elif time.monotonic() - self._built_at > self.max_age:
+            self._rebuild_in_background()
+        if self._vocabulary_dirty:
+            with self._lock:
+                self._vocabulary = sorted(self._postings)
+                self._vocabulary_dirty = False
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._rebuilding or time.monotonic() < self._retry_at:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._run_rebuild, name='search-index-rebuild', daemon=True).start()
+
+    def _run_rebuild(self):
+        try:
+            with self.app.app_context():
+                self.build()
+        except Exception:
+            # Queries keep using the current index meanwhile
+            self._retry_at = time.monotonic() + REBUILD_RETRY
+            self.app.logger.exception("Search index rebuild failed.")
+        finally:
+            self._rebuilding = False
+
+    def _add(self, book, books, postings):
+        weighted = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            value = book.get(field) or []
+            text = value if isinstance(value, str) else " ".join(value)
+            for token in tokenize(text):
+                weighted[token] += weight
+
+        book_id = book['_id']
+        for token, tf in weighted.items():
+            postings[token][book_id] = tf
+        books[book_id] = IndexedBook(
+            book_id, book['title'], book.get('slug'), book.get('category'),
+            list(book.get('genres') or []), list(weighted)
+        )
+
+    def _remove(self, book_id, books, postings):
+        old = books.pop(book_id, None)
+        if old is None:
+            return
+        for token in old.tokens:
+            posting = postings.get(token)
+            if posting is not None:
+                posting.pop(book_id, None)
+                if not posting:
+                    del postings[token]
+
+    # ----------------------------
+    # Querying
+    # ----------------------------
+    def _prefix_tokens(self, prefix):
+        start = bisect_left(self._vocabulary, prefix)
+        tokens = []
+        for token in self._vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not token.startswith(prefix):
+                break
+            tokens.append(token)
+        return tokens
+
+    def _term_scores(self, term, prefix):
+        """Score contribution of one query term per book: {book id: score}."""
+        total = len(self._books) or 1
+        scores = defaultdict(float)
+        candidates = [(term, 1.0)]
+        if prefix:
+            candidates += [(token, PREFIX_PENALTY) for token in self._prefix_tokens(term) if token != term]
+
+        for token, factor in candidates:
+            posting = self._postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + total / len(posting))
+            for book_id, tf in posting.items():
+                scores[book_id] = max(scores[book_id], factor * tf * idf)
+        return scores
+
+    def _match(self, query):
+        """Books matching every term of the query (last term as prefix): {book id: score}."""
+        # The last word is kept even if it is a stopword: as a prefix it may start a real word
+        words = tokenize(query, keep_stopwords=True)
+        terms = [word for word in words[:-1] if word not in STOPWORDS] + words[-1:]
+        if not terms:
+            return {}
+
+        matched = None
+        for position, term in enumerate(terms):
+            term_scores = self._term_scores(term, prefix=position == len(terms) - 1)
+            if matched is None:
+                matched = dict(term_scores)
+            else:
+                matched = {book_id: score + term_scores[book_id]
+                           for book_id, score in matched.items() if book_id in term_scores}
+            if not matched:
+                return {}
+        return matched
+
+    def search(self, query, category=None, genre=None, limit=20):
+        """
+        Ranked search with facets.
+        Returns {'total', 'results': [(book id, score)], 'facets': {'category': {...}, 'genre': {...}}}.
+        Facets count the whole match set; category/genre only filter the results.
+        """
+        with self._lock:
+            self._ensure_fresh()
+            matched = self._match(query)
+
+            category_counts = Counter()
+            genre_counts = Counter()
+            for book_id in matched:
+                book = self._books[book_id]
+                category_counts[book.category] += 1
+                genre_counts.update(book.genres)
+
+            def keep(book_id):
+                book = self._books[book_id]
+                return ((not category or book.category == category)
+                        and (not genre or genre in book.genres))
+
+            filtered = [(book_id, score) for book_id, score in matched.items() if keep(book_id)]
+
+        return {
+            'total': len(filtered),
+            'results': nlargest(limit, filtered, key=lambda item: item[1]),
+            'facets': {
+                'category': dict(category_counts.most_common()),
+                'genre': dict(genre_counts.most_common()),
+            },
+        }
+
+    def suggest(self, prefix, limit=10):
+        """Typeahead: titles of the best-matching books for a partial query."""
+        with self._lock:
+            self._ensure_fresh()
+            matched = self._match(prefix)
+            best = nlargest(limit, matched.items(), key=lambda item: item[1])
+            return [{'id': str(book_id), 'title': self._books[book_id].title, 'slug': self._books[book_id].slug}
+                    for book_id, _ in best]
+
+
+search_index = SearchIndex()
@@ -0,0 +1,237 @@
+"""
+Compact in-process snapshot of the catalogue for whole-category reads.
+
+Book.get_all_books(), Book.find_by_category(), Book.get_page() and
+Book.count_by_category() answer from it when CATALOGUE_SNAPSHOT is on. Every
+book is one BookRecord (__slots__, no per-book dict) held in (title, _id) order,
+and each category and genre has a precomputed tuple of its records in that
+order, so a read returns an existing tuple or a slice of one: no query and no
+BSON decoding per request. A listing page is found by bisecting its category's
+tuple for the cursor's (title, _id), the same keyset the database pages use.
+
+Configured in create_app():
+
+    CATALOGUE_SNAPSHOT               on/off
+    CATALOGUE_SNAPSHOT_POLL          seconds between checks of the catalogue version,
+                                     which picks up other worker processes' writes
+    CATALOGUE_SNAPSHOT_MAX_AGE       seconds before a full rebuild (drops deleted books)
+
+The snapshot is built on first use, not at worker boot. Book writes in this
+process (Book.changed / changed_many) mark it stale, and the next read fetches
+only the books whose updatedAt moved since the last load, so loans and returns
+refresh one record in place. Changes of title, category or genres re-sort and
+re-index the (small) snapshot.
+"""
+import threading
+import time
+from bisect import bisect_right
+from datetime import timedelta
+
+# Fields kept per book: everything the listing and category reads returned
+RECORD_FIELDS = ('title', 'slug', 'url', 'authors', 'available', 'copies', 'category', 'genres',
+                 'pages', 'description', 'updatedAt')
+
+# Incremental loads look this far behind the newest updatedAt seen, so writes
+# stamped by another process with a slightly slower clock are not missed
+CLOCK_SKEW = timedelta(seconds=5)
+
+
+def sort_key(record):
+    """Listing order of the snapshot: (title, _id), like PAGE_SORT."""
+    return record.title, record.id
+
+
+class BookRecord:
+    """
+    Read-only book of the snapshot. Also answers book['title'] / book.get('url'),
+    like the raw documents Book.find_by_category() used to return.
+    """
+    __slots__ = ('id',) + RECORD_FIELDS
+
+    def __init__(self, doc):
+        self.id = doc['_id']
+        self.update(doc)
+
+    def update(self, doc):
+        self.title = doc['title']
+        self.slug = doc.get('slug')
+        self.url = doc.get('url')
+        self.authors = tuple(doc.get('authors') or ())
+        self.available = doc.get('available', 0)
+        self.copies = doc.get('copies', 0)
+        self.category = doc.get('category')
+        self.genres = tuple(doc.get('genres') or ())
+        self.pages = doc.get('pages')
+        self.description = tuple(doc.get('description') or ())
+        self.updatedAt = doc.get('updatedAt')
+
+    def __getitem__(self, key):
+        if key == '_id':
+            return self.id
+        if key not in RECORD_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"<BookRecord {self.id} {self.title!r}>"
+
+
+class CatalogueSnapshot:
+    def __init__(self):
+        self.enabled = True
+        self.poll = 5
+        self.max_age = 3600
+        self._records = ()       # every BookRecord, in (title, id) order
+        self._by_id = {}
+        self._by_category = {}   # category -> tuple of records in title order
+        self._by_genre = {}      # genre -> tuple of records in title order
+        self._watermark = None   # newest updatedAt loaded
+        self._version = None     # catalogue version ('All') when last checked
+        self._built_at = None
+        self._checked_at = None
+        self._stale = False
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CATALOGUE_SNAPSHOT', True)
+        self.poll = app.config.get('CATALOGUE_SNAPSHOT_POLL', 5)
+        self.max_age = app.config.get('CATALOGUE_SNAPSHOT_MAX_AGE', 3600)
+
+    # ----------------------------
+    # Reads
+    # ----------------------------
+    def all_books(self):
+        """Every book, sorted by title."""
+        with self._lock:
+            self._ensure_fresh()
+            return self._records
+
+    def by_category(self, category):
+        """Books of a category, sorted by title ('All' for every book)."""
+        with self._lock:
+            self._ensure_fresh()
+            return self._records if category == "All" else self._by_category.get(category, ())
+
+    def by_genre(self, genre):
+        """Books with a genre, sorted by title."""
+        with self._lock:
+            self._ensure_fresh()
+            return self._by_genre.get(genre, ())
+
+    def page(self, category, after, page_size):
+        """Up to page_size + 1 books of a category following the (title, _id) position `after`."""
+        with self._lock:
+            self._ensure_fresh()
+            records = self._records if category == "All" else self._by_category.get(category, ())
+        start = bisect_right(records, after, key=sort_key) if after else 0
+        return records[start:start + page_size + 1]
+
+    def count(self, category):
+        """Number of books in a category ('All' for every book)."""
+        return len(self.by_category(category))
+
+    def get(self, book_id):
+        with self._lock:
+            self._ensure_fresh()
+            return self._by_id.get(book_id)
+
+    # ----------------------------
+    # Building and syncing
+    # ----------------------------
+    def touch(self):
+        """A book was written in this process: reload changed books on the next read."""
+        self._stale = True
+
+    def invalidate(self):
+        """Force a full rebuild on the next read (e.g. after a bulk import)."""
+        with self._lock:
+            self._built_at = None
+
+    def build(self):
+        """(Re)build the snapshot from the books collection."""
+        from app.model import Book
+
+        self._stale = False  # before loading, so a write during the load marks it stale again
+        version = self._current_version()
+        docs = Book._get_collection().find({}, dict.fromkeys(RECORD_FIELDS, 1))
+        with self._lock:
+            self._by_id = {}
+            self._watermark = None
+            for doc in docs:
+                self._by_id[doc['_id']] = BookRecord(doc)
+                self._advance(doc)
+            self._reindex()
+            self._version = version
+            self._built_at = self._checked_at = time.monotonic()
+
+    def refresh(self):
+        """Load the books written since the last load; re-index only if their order or groups changed."""
+        from app.model import Book
+
+        self._stale = False
+        version = self._current_version()
+        query = {'updatedAt': {'$gte': self._watermark - CLOCK_SKEW}} if self._watermark else {}
+        docs = Book._get_collection().find(query, dict.fromkeys(RECORD_FIELDS, 1))
+        with self._lock:
+            reindex = False
+            for doc in docs:
+                record = self._by_id.get(doc['_id'])
+                if record is None:
+                    self._by_id[doc['_id']] = BookRecord(doc)
+                    reindex = True
+                else:
+                    placement = (record.title, record.category, record.genres)
+                    record.update(doc)
+                    reindex = reindex or placement != (record.title, record.category, record.genres)
+                self._advance(doc)
+            if reindex:
+                self._reindex()
+            self._version = version
+            self._checked_at = time.monotonic()
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if self._built_at is None or now - self._built_at > self.max_age:
+            self.build()
+        elif self._stale:
+            self.refresh()
+        elif now - self._checked_at > self.poll:
+            # Another process may have written: compare the catalogue version
+            if self._current_version() != self._version:
+                self.refresh()
+            else:
+                self._checked_at = now
+
+    @staticmethod
+    def _current_version():
+        from app.model import CatalogueVersion
+
+        doc = CatalogueVersion._get_collection().find_one({'_id': 'catalogue'}, {'versions.All': 1})
+        return CatalogueVersion.version_of(doc, "All")[0]
+
+    def _advance(self, doc):
+        updated = doc.get('updatedAt')
+        if updated is not None and (self._watermark is None or updated > self._watermark):
+            self._watermark = updated
+
+    def _reindex(self):
+        """Title order and the per-category / per-genre posting lists."""
+        records = sorted(self._by_id.values(), key=sort_key)
+        by_category, by_genre = {}, {}
+        for record in records:
+            by_category.setdefault(record.category, []).append(record)
+            for genre in dict.fromkeys(record.genres):
+                by_genre.setdefault(genre, []).append(record)
+        self._records = tuple(records)
+        self._by_category = {category: tuple(group) for category, group in by_category.items()}
+        self._by_genre = {genre: tuple(group) for genre, group in by_genre.items()}
+
+
+catalogue_snapshot = CatalogueSnapshot()
@@ -0,0 +1,225 @@
+"""
+Async (app.asgi) vs WSGI serving of the catalogue and loan pages under many concurrent clients.
+
+Seeds a scratch database (bench/seed.py) and drives book_titles, book_details and
+view_loans at each --concurrency level in both modes, in one process:
+
+    wsgi   every request takes one of --threads worker threads (a threaded WSGI
+           server such as gunicorn --threads) for its whole lifetime
+    asgi   requests arrive as tasks on one event loop, then run through the Flask
+           app on at most --threads threads (app.asgi.application)
+
+Each simulated client is slow: its request arrives --client-delay-ms after the
+connection is accepted. Under WSGI the worker thread waits for it; under ASGI
+only the task does. Results (p50/p95/p99, throughput, errors per mode, route and
+level) are JSON on stdout or --output, with a summary table on stderr:
+
+    PYTHONPATH=. python bench/async_vs_wsgi.py --mongo mongodb://localhost:27017 \\
+        --concurrency 10 --concurrency 100 --concurrency 1000 --output async.json
+
+Needs a real mongod and the async extras (pip install uvicorn "flask[async]"). The
+--database is dropped and reseeded, so use a scratch one.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.test import Client, EnvironBuilder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.load_test import CommandCounter, connect, git_commit, percentile  # noqa: E402
+from bench.seed import SCALES, CATEGORIES, BENCH_PASSWORD, seed  # noqa: E402
+
+ROUTES = ['book_titles', 'book_details', 'view_loans']
+MODES = ['wsgi', 'asgi']
+
+
+def request_path(route, rng, books):
+    if route == 'book_titles':
+        return f"/book_titles?category={rng.choice(['All'] + CATEGORIES)}"
+    if route == 'book_details':
+        return f"/book/book-{rng.randrange(books)}"
+    return '/view_loans'
+
+
+# --------------------------------------------------------------------------
+# One request in each mode
+# --------------------------------------------------------------------------
+def wsgi_request(app, path, cookie, delay):
+    """On a worker thread: wait for the slow client, then run the request through the WSGI app."""
+    time.sleep(delay)
+    environ = EnvironBuilder(path=path, headers={'Cookie': cookie}).get_environ()
+    status = []
+    body = app(environ, lambda s, h, exc_info=None: status.append(int(s.split(' ', 1)[0])))
+    try:
+        b''.join(body)
+    finally:
+        body.close()
+    return status[0]
+
+
+async def asgi_request(application, path, cookie, delay):
+    """On the event loop: the request body arrives after the delay."""
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+        'method': 'GET', 'path': path, 'root_path': '', 'query_string': query.encode('latin-1'),
+        'headers': [(b'host', b'localhost'), (b'cookie', cookie.encode('latin-1'))],
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+    }
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(delay)
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            sent.append(message['status'])
+
+    await application(scope, receive, send)
+    return sent[0]
+
+
+# --------------------------------------------------------------------------
+# Driving one route at one concurrency level
+# --------------------------------------------------------------------------
+async def run_level(mode, route, clients, requests, cookies, books, delay, app, application, pool, seed_value):
+    """`clients` concurrent clients sharing `requests` requests; each sends its next one when the last returns."""
+    loop = asyncio.get_running_loop()
+    remaining = [requests]
+    latencies, statuses = [], collections.Counter()
+
+    async def client(n):
+        rng, cookie = random.Random(seed_value + n), cookies[n % len(cookies)]
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            path = request_path(route, rng, books)
+            started = time.perf_counter()
+            try:
+                if mode == 'wsgi':
+                    status = await loop.run_in_executor(pool, wsgi_request, app, path, cookie, delay)
+                else:
+                    status = await asgi_request(application, path, cookie, delay)
+            except Exception:
+                status = 599  # unhandled error, as the server would log it
+            latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(clients)))
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if status >= 500),
+        'status': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput_rps': round(len(latencies) / seconds, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p95': round(percentile(latencies, 95) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+    }
+
+
+def summary(results):
+    print(f"{'route':<14}{'clients':>8}{'wsgi p95 ms':>14}{'asgi p95 ms':>14}{'wsgi rps':>11}{'asgi rps':>11}",
+          file=sys.stderr)
+    for route, levels in results['wsgi'].items():
+        for clients, wsgi in levels.items():
+            asgi = results['asgi'][route][clients]
+            print(f"{route:<14}{clients:>8}{wsgi['latency_ms']['p95']:>14.1f}{asgi['latency_ms']['p95']:>14.1f}"
+                  f"{wsgi['throughput_rps']:>11.1f}{asgi['throughput_rps']:>11.1f}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mongo', required=True, help='MongoDB URI, e.g. mongodb://localhost:27017')
+    parser.add_argument('--database', default='library_bench', help='scratch database (dropped and reseeded)')
+    parser.add_argument('--scale', choices=SCALES, default='small', help=str(SCALES))
+    parser.add_argument('--concurrency', type=int, action='append', help='concurrent clients (repeatable; 10, 100, 1000)')
+    parser.add_argument('--threads', type=int, default=16, help='WSGI worker threads')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per route and level')
+    parser.add_argument('--client-delay-ms', type=float, default=50.0, help='how long each request takes to arrive')
+    parser.add_argument('--route', action='append', choices=ROUTES, help='only these routes (repeatable)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+    levels = args.concurrency or [10, 100, 1000]
+
+    from app.asgi import application
+    from app.cache import cache
+    from app.indexes import verify_indexes
+    from app.passwords import hasher
+
+    app = application.app
+    if args.database == app.config['MONGODB_SETTINGS'].get('db'):
+        sys.exit(f"Refusing to reseed the app's own database {args.database!r}; pick a scratch --database.")
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    database = connect(args.mongo, args.database, CommandCounter())
+    application.threads = args.threads  # the same number of threads in both modes
+
+    scale = SCALES[args.scale]
+    print(f"Seeding {scale} into {args.database!r}...", file=sys.stderr)
+    seed(database, **scale, seed=args.seed, password_hash=hasher.hash(BENCH_PASSWORD))
+    verify_indexes(app, build=True, background=False)
+
+    # One logged-in session per simulated member, shared by both modes
+    cookies = []
+    for n in range(min(max(levels), scale['users'], 200)):
+        client = Client(app)
+        client.post('/login', data={'email': f"bench{n}@example.com", 'password': BENCH_PASSWORD}).close()
+        cookies.append(f"session={client.get_cookie('session').value}")
+
+    async def run_all():
+        results = {}
+        with ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix='wsgi') as pool:
+            for mode in MODES:
+                for route in ROUTES:
+                    if args.route and route not in args.route:
+                        continue
+                    for clients in levels:
+                        cache.clear()  # both modes start cold
+                        print(f"{mode} {route} x{clients}...", file=sys.stderr)
+                        results.setdefault(mode, {}).setdefault(route, {})[str(clients)] = await run_level(
+                            mode, route, clients, args.requests, cookies, scale['books'],
+                            args.client_delay_ms / 1000, app, application, pool, args.seed)
+        return results
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'scale': scale,
+            'wsgi_threads': args.threads,
+            'client_delay_ms': args.client_delay_ms,
+            'requests_per_level': args.requests,
+            'seed': args.seed,
+        },
+    }
+    results.update(asyncio.run(run_all()))
+    summary(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
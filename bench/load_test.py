@@ -0,0 +1,337 @@
+"""
+Load test of the main routes against a seeded scratch database.
+
+Seeds a synthetic catalogue and loan history (bench/seed.py), builds the indexes,
+then drives each route with concurrent clients, one logged-in member each, and
+records p50/p95/p99 latency, throughput and MongoDB commands per request. Results
+are JSON (stdout, or --output) so runs can be compared between commits:
+
+    PYTHONPATH=. python bench/load_test.py --scale small --clients 8 --output before.json
+    PYTHONPATH=. python bench/load_test.py --scale small --clients 8 --compare before.json
+
+--mongo mock (the default) runs on mongomock (pip install mongomock) and needs no
+server, so it measures the app side only. It ignores partial index filters, so the
+one_active_loan_per_book build is logged as failing there. --mongo
+mongodb://localhost:27017 uses a real mongod. The --database is dropped and
+reseeded, so use a scratch one. Clients are threads in one process, as under a
+threaded WSGI server.
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+from werkzeug.test import Client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.seed import SCALES, CATEGORIES, BENCH_PASSWORD, seed  # noqa: E402
+
+# In the order they run: later phases work on the loans earlier ones created
+ROUTES = ['book_titles', 'book_details', 'login', 'make_loan', 'view_loans',
+          'renew_loan', 'return_loan', 'delete_loan']
+
+# mongomock Collection methods that stand for one MongoDB command each
+MONGOMOCK_COMMANDS = ['find', 'find_one', 'find_one_and_update', 'find_one_and_replace',
+                      'find_one_and_delete', 'insert_one', 'insert_many', 'update_one',
+                      'update_many', 'replace_one', 'delete_one', 'delete_many', 'bulk_write',
+                      'aggregate', 'count_documents', 'estimated_document_count', 'distinct']
+
+
+# --------------------------------------------------------------------------
+# Counting MongoDB commands per route
+# --------------------------------------------------------------------------
+class CommandCounter(monitoring.CommandListener):
+    """Counts MongoDB commands against the route the current thread is timing."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self):
+        route = getattr(self.local, 'route', None)
+        if route is not None:
+            with self._lock:
+                self.counts[route] += 1
+
+    # pymongo CommandListener interface (real mongod)
+    def started(self, event):
+        self.count()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def instrument_mongomock(self):
+        """mongomock sends no command events, so count calls to its Collection methods instead."""
+        from mongomock.collection import Collection
+
+        counter = self
+        for name in MONGOMOCK_COMMANDS:
+            original = getattr(Collection, name)
+
+            def counted(collection, *args, _original=original, **kwargs):
+                # mongomock calls its own methods (find_one -> find); count the outermost only
+                if getattr(counter.local, 'depth', 0):
+                    return _original(collection, *args, **kwargs)
+                counter.local.depth = 1
+                counter.count()
+                try:
+                    return _original(collection, *args, **kwargs)
+                finally:
+                    counter.local.depth = 0
+
+            setattr(Collection, name, counted)
+
+
+def connect(mongo, database, counter):
+    """Point the app's models at the scratch database; returns it as a pymongo Database."""
+    import mongoengine
+
+    mongoengine.disconnect()  # the connection create_app() configured
+    if mongo == 'mock':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--mongo mock needs mongomock: pip install mongomock")
+        counter.instrument_mongomock()
+        mongoengine.connect(db=database, host='mongodb://localhost',
+                            mongo_client_class=mongomock.MongoClient)
+    else:
+        mongoengine.connect(db=database, host=mongo, event_listeners=[counter])
+    return mongoengine.get_db()
+
+
+# --------------------------------------------------------------------------
+# Simulated members and the requests each route phase makes
+# --------------------------------------------------------------------------
+class Member:
+    """One simulated member: a client that keeps its session cookie, plus their loan ids."""
+
+    def __init__(self, app, user_id, email):
+        self.client = Client(app)
+        self.user_id = user_id
+        self.email = email
+        self.active = []
+        self.returned = []
+
+    def refresh_loans(self):
+        from app.model import Loan
+
+        loans = Loan._get_collection().find({'member': self.user_id}, {'active': 1})
+        self.active, self.returned = [], []
+        for loan in loans:
+            (self.active if loan.get('active') else self.returned).append(str(loan['_id']))
+
+
+def next_request(route, member, rng, books):
+    """(method, path, form data) for the member's next request, or None when they have nothing to do."""
+    if route == 'book_titles':
+        return 'GET', f"/book_titles?category={rng.choice(['All'] + CATEGORIES)}", None
+    if route == 'book_details':
+        return 'GET', f"/book/book-{rng.randrange(books)}", None
+    if route == 'login':
+        return 'POST', '/login', {'email': member.email, 'password': BENCH_PASSWORD}
+    if route == 'make_loan':
+        return 'GET', f"/book/book-{rng.randrange(books)}/loan", None
+    if route == 'view_loans':
+        return 'GET', '/view_loans', None
+    if route == 'renew_loan':
+        return ('POST', f"/renew_loan/{rng.choice(member.active)}", None) if member.active else None
+    if route == 'return_loan':
+        if not member.active:
+            return None
+        loan_id = member.active.pop()
+        member.returned.append(loan_id)
+        return 'POST', f"/return_loan/{loan_id}", None
+    if route == 'delete_loan':
+        return ('POST', f"/delete_loan/{member.returned.pop()}", None) if member.returned else None
+    raise ValueError(f"Unknown route {route!r}")
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an ascending list."""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def run_route(route, members, requests, counter, books, seed):
+    """Send `requests` requests to one route, spread over the members' threads."""
+    counter.counts[route] = 0
+    shares = [requests // len(members) + (n < requests % len(members)) for n in range(len(members))]
+
+    def worker(n):
+        member, rng = members[n], random.Random(seed + n)
+        latencies, statuses = [], collections.Counter()
+        for _ in range(shares[n]):
+            request = next_request(route, member, rng, books)
+            if request is None:
+                break
+            method, path, data = request
+
+            counter.local.route = route
+            started = time.perf_counter()
+            response = member.client.open(path, method=method, data=data)
+            latencies.append(time.perf_counter() - started)
+            counter.local.route = None
+
+            statuses[response.status_code] += 1
+            response.close()
+            # Follow redirects untimed so flashed messages are rendered and leave the session
+            if response.status_code in (301, 302, 303) and response.location:
+                member.client.get(response.location).close()
+        return latencies, statuses
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(members)) as pool:
+        results = list(pool.map(worker, range(len(members))))
+    seconds = time.perf_counter() - started
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    statuses = sum((result[1] for result in results), collections.Counter())
+    if not latencies:
+        return {'requests': 0}
+    return {
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if status >= 500),
+        'status': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput_rps': round(len(latencies) / seconds, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 3),
+            'p95': round(percentile(latencies, 95) * 1000, 3),
+            'p99': round(percentile(latencies, 99) * 1000, 3),
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+        'queries': counter.counts[route],
+        'queries_per_request': round(counter.counts[route] / len(latencies), 2),
+    }
+
+
+# --------------------------------------------------------------------------
+# Comparing runs
+# --------------------------------------------------------------------------
+def compare(current, baseline, threshold):
+    """Print p95/throughput/query changes per route to stderr; return the routes whose p95 regressed."""
+    regressions = []
+    print(f"{'route':<14}{'p95 ms':>20}{'rps':>22}{'queries/req':>18}", file=sys.stderr)
+    for route, now in current['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if not before or not before.get('requests') or not now.get('requests'):
+            continue
+        p95_before, p95_now = before['latency_ms']['p95'], now['latency_ms']['p95']
+        change = p95_now / p95_before - 1 if p95_before else 0.0
+        print(f"{route:<14}{p95_before:>9.2f} -> {p95_now:<8.2f}"
+              f"{before['throughput_rps']:>10.1f} -> {now['throughput_rps']:<9.1f}"
+              f"{before['queries_per_request']:>7.2f} -> {now['queries_per_request']:<6.2f}"
+              f"{'  REGRESSION' if change > threshold else ''}", file=sys.stderr)
+        if change > threshold:
+            regressions.append(route)
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mongo', default='mock', help="'mock' or a MongoDB URI, e.g. mongodb://localhost:27017")
+    parser.add_argument('--database', default='library_bench', help='scratch database (dropped and reseeded)')
+    parser.add_argument('--scale', choices=SCALES, default='small', help=str(SCALES))
+    parser.add_argument('--books', type=int, help='override the scale')
+    parser.add_argument('--users', type=int, help='override the scale')
+    parser.add_argument('--loans', type=int, help='override the scale')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent members')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--route', action='append', choices=ROUTES, help='only these routes (repeatable)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='p95 increase (fraction) counted as a regression by --compare')
+    args = parser.parse_args()
+
+    from app.app import app
+    from app.cache import cache
+    from app.indexes import verify_indexes
+    from app.passwords import hasher
+    from app.search import search_index
+
+    if args.database == app.config['MONGODB_SETTINGS'].get('db'):
+        sys.exit(f"Refusing to reseed the app's own database {args.database!r}; pick a scratch --database.")
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    counter = CommandCounter()
+    database = connect(args.mongo, args.database, counter)
+
+    scale = dict(SCALES[args.scale])
+    scale.update({key: getattr(args, key) for key in scale if getattr(args, key)})
+    print(f"Seeding {scale} into {args.database!r}...", file=sys.stderr)
+    seeded = seed(database, **scale, seed=args.seed, password_hash=hasher.hash(BENCH_PASSWORD))
+    verify_indexes(app, build=True, background=False)
+    cache.clear()
+    search_index.invalidate()
+
+    members = [Member(app, seeded['user_ids'][n], f"bench{n}@example.com")
+               for n in range(min(args.clients, scale['users']))]
+    for member in members:
+        member.client.post('/login', data={'email': member.email, 'password': BENCH_PASSWORD}).close()
+
+    routes = {}
+    for route in ROUTES:
+        if args.route and route not in args.route:
+            continue
+        if route in ('renew_loan', 'return_loan', 'delete_loan'):
+            for member in members:
+                member.refresh_loans()
+        print(f"Running {route}...", file=sys.stderr)
+        routes[route] = run_route(route, members, args.requests, counter, scale['books'], args.seed)
+
+    seeded.pop('user_ids')
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'mongo': 'mongomock' if args.mongo == 'mock' else 'mongod',
+            'scale': scale,
+            'clients': len(members),
+            'requests_per_route': args.requests,
+            'seed': args.seed,
+        },
+        'seed': seeded,
+        'routes': routes,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(f"p95 regressed by more than {args.threshold:.0%} on: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Login throughput per core for password hashing settings.
+
+Times check_password_hash for each method on one thread (logins/s per core),
+then through app.passwords.PasswordHasher with its thread pool, and prints JSON.
+
+    PYTHONPATH=. python bench/password_hashing.py --seconds 3 --method scrypt --method pbkdf2:sha256:600000
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app.passwords import PasswordHasher
+
+DEFAULT_METHODS = ['scrypt', 'pbkdf2:sha256:1000000', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:100000']
+
+
+class _App:
+    """Just enough of a Flask app for PasswordHasher.init_app()."""
+
+    def __init__(self, **config):
+        self.config = config
+
+
+def per_core(method, seconds):
+    """Verifications per second on a single thread."""
+    stored = generate_password_hash('correct horse', method)
+    done, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        check_password_hash(stored, 'correct horse')
+        done += 1
+    return done / (time.perf_counter() - started)
+
+
+def through_pool(method, seconds, workers, clients):
+    """Verifications per second through PasswordHasher with `clients` concurrent callers."""
+    hasher = PasswordHasher()
+    hasher.init_app(_App(PASSWORD_HASH_METHOD=method, PASSWORD_HASH_WORKERS=workers,
+                         PASSWORD_HASH_MAX_PENDING=workers * 4, PASSWORD_HASH_WAIT=30))
+    stored = generate_password_hash('correct horse', method)
+    deadline = time.perf_counter() + seconds
+
+    def client():
+        done = 0
+        while time.perf_counter() < deadline:
+            hasher.verify(stored, 'correct horse')
+            done += 1
+        return done
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        total = sum(pool.map(lambda _: client(), range(clients)))
+    return total / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--method', action='append', help='Werkzeug hash method (repeatable)')
+    parser.add_argument('--seconds', type=float, default=2.0, help='time per measurement')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='hashing pool size')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent simulated logins')
+    args = parser.parse_args()
+
+    results = []
+    for method in args.method or DEFAULT_METHODS:
+        results.append({
+            'method': method,
+            'logins_per_second_per_core': round(per_core(method, args.seconds), 2),
+            'logins_per_second_pool': round(through_pool(method, args.seconds, args.workers, args.clients), 2),
+            'pool_workers': args.workers,
+            'clients': args.clients,
+        })
+    print(json.dumps({'cpu_count': os.cpu_count(), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Synthetic catalogue, members and loan history for benchmarks.
+
+Documents are generated deterministically from a seed and written straight to the
+collections with unordered insert_many batches, so even the large scale (1M books,
+10M loans) seeds without going through MongoEngine validation. Loan histories are
+consistent with the app's invariants: at most one active loan per member and book,
+and available = copies - active loans for every book.
+
+Used by bench/load_test.py, which also builds the indexes afterwards.
+"""
+import array
+import random
+import time
+from datetime import datetime, timedelta
+
+SCALES = {
+    'small': {'books': 1_000, 'users': 500, 'loans': 10_000},
+    'medium': {'books': 100_000, 'users': 10_000, 'loans': 1_000_000},
+    'large': {'books': 1_000_000, 'users': 100_000, 'loans': 10_000_000},
+}
+
+CATEGORIES = ['Adult', 'Teens', 'Children']
+GENRES = ['Animals', 'Business', 'Comics', 'Fantasy', 'Fiction', 'Friendship', 'Graphic Novels',
+          'Historical Fiction', 'Magic', 'Mental Health', 'Nonfiction', 'Picture Books', 'Poetry',
+          'Psychology', 'Romance', 'School', 'Self Help']
+WORDS = ['silent', 'river', 'garden', 'shadow', 'winter', 'library', 'secret', 'golden', 'last',
+         'city', 'ocean', 'stone', 'letters', 'night', 'house', 'forest', 'paper', 'crown']
+
+BENCH_PASSWORD = 'bench-password'
+BATCH_SIZE = 10_000
+
+
+def book_document(i, rng, copies, available, now):
+    """Raw document for synthetic book number i."""
+    title = f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()} {i}"
+    return {
+        'title': title,
+        'slug': f"book-{i}",
+        'category': CATEGORIES[i % len(CATEGORIES)],
+        'genres': rng.sample(GENRES, rng.randint(1, 3)),
+        'authors': [f"Author {rng.randint(1, max(1, i // 10 + 1))}"],
+        'url': None,
+        'description': [f"Paragraph {n} of the synthetic description for book {i}. " * 4 for n in range(3)],
+        'pages': rng.randint(40, 900),
+        'copies': copies,
+        'available': available,
+        'updatedAt': now,
+    }
+
+
+def _insert_batches(collection, documents):
+    """insert_many in unordered batches; returns the number inserted."""
+    batch, total = [], 0
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            total += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        total += len(batch)
+    return total
+
+
+def seed(database, books, users, loans, active_ratio=0.02, seed=42, password_hash=None):
+    """
+    Drop and refill the books, user and loans collections of `database` (a pymongo
+    Database), dropping the derived catalogue_version and stats collections too.
+    Returns {'books', 'users', 'loans', 'active_loans', 'user_ids', 'seconds'}.
+    password_hash is stored for every user (hash BENCH_PASSWORD once, not per user).
+    """
+    from bson import ObjectId
+    from app.model import Book, User, Loan, CatalogueVersion, CirculationStat
+
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+    book_collection = database[Book._get_collection_name()]
+    user_collection = database[User._get_collection_name()]
+    loan_collection = database[Loan._get_collection_name()]
+    for collection in (book_collection, user_collection, loan_collection):
+        collection.drop()
+    for model in (CatalogueVersion, CirculationStat):
+        database[model._get_collection_name()].drop()
+
+    book_ids = [ObjectId() for _ in range(books)]
+    user_ids = [ObjectId() for _ in range(users)]
+    copies = array.array('b', (rng.randint(1, 5) for _ in range(books)))
+    available = array.array('b', copies)
+
+    _insert_batches(user_collection, (
+        {'_id': user_id, 'email': f"bench{n}@example.com", 'name': f"Bench User {n}",
+         'password': password_hash or '', 'is_admin': False}
+        for n, user_id in enumerate(user_ids)
+    ))
+
+    active_pairs = set()
+
+    def loan_documents():
+        for _ in range(loans):
+            member = rng.randrange(users)
+            book = rng.randrange(books)
+            borrow_date = now - timedelta(days=rng.randint(0, 730), seconds=rng.randint(0, 86399))
+            loan = {
+                'member': user_ids[member],
+                'book': book_ids[book],
+                'borrowDate': borrow_date,
+                'dueDate': borrow_date + timedelta(weeks=2),
+                'renewCount': rng.randint(0, 2),
+            }
+            wants_active = rng.random() < active_ratio
+            if wants_active and available[book] > 0 and (member, book) not in active_pairs:
+                active_pairs.add((member, book))
+                available[book] -= 1
+                loan.update(active=True, overdue=loan['dueDate'] < now)
+            else:
+                loan.update(returnDate=min(borrow_date + timedelta(days=rng.randint(1, 20)), now),
+                            active=False, overdue=False)
+            yield loan
+
+    loan_count = _insert_batches(loan_collection, loan_documents())
+
+    # Books last, once the active loans have settled each book's available count
+    _insert_batches(book_collection, (
+        dict(book_document(i, rng, copies[i], available[i], now), _id=book_ids[i])
+        for i in range(books)
+    ))
+
+    return {
+        'books': books,
+        'users': users,
+        'loans': loan_count,
+        'active_loans': len(active_pairs),
+        'user_ids': user_ids,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
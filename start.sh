@@ -8,5 +8,8 @@ export FLASK_APP=app/app.py
 export PYTHONPATH=.
 export FLASK_ENV=development
 
+# One-off per deployment: build indexes and seed the catalogue if empty
+flask bootstrap
+
 # Run the app
 flask run --host=0.0.0.0 --port=5000
@@ -0,0 +1,56 @@
+"""
+Shared fixtures: the app on an in-memory MongoDB (mongomock), emptied before every test.
+
+    pip install -r requirements-dev.txt
+    python -m pytest
+"""
+import os
+
+import mongomock
+import mongoengine.connection
+import pytest
+
+os.environ.setdefault('MONGODB_DB', 'library_test')
+# Before the app is imported: every MongoEngine connection is opened with this client class
+mongoengine.connection.MongoClient = mongomock.MongoClient
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app.app import app
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return app
+
+
+@pytest.fixture(autouse=True)
+def clean_db(app):
+    from app.cache import cache
+    from app.model import Book
+    from app.ratelimit import limiter
+    from app.snapshot import catalogue_snapshot
+
+    database = Book._get_db()
+    for name in database.list_collection_names():
+        database.drop_collection(name)
+    cache.clear()
+    catalogue_snapshot.invalidate()
+    limiter.clear()
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def member():
+    from app.model import User
+    return User(email='member@example.com', password='not-a-hash', name='Member').save()
+
+
+@pytest.fixture
+def make_book():
+    from app.model import Book
+
+    def make(title='Dune', copies=2, available=None, category='Adults'):
+        return Book(title=title, authors=['Author'], category=category, genres=['Fiction'],
+                    description=['First.', 'Last.'], pages=100, url=None, copies=copies,
+                    available=copies if available is None else available).save()
+    return make
@@ -0,0 +1,109 @@
+"""Loan.return_many / renew_many: per-loan outcomes, aggregated copy returns and concurrent requests."""
+from bson import ObjectId
+
+from app.model import Book, Loan, User
+
+
+def outcome_of(outcomes, loan):
+    return next(outcome for outcome in outcomes if outcome.loan_id == str(loan.id))
+
+
+def during_the_batch(monkeypatch, action):
+    """Run `action` after return_many/renew_many has read its loans and before it writes."""
+    load = Loan._load_batch.__func__
+
+    def load_then_act(cls, member, loan_ids):
+        loaded = load(cls, member, loan_ids)
+        action()
+        return loaded
+    monkeypatch.setattr(Loan, '_load_batch', classmethod(load_then_act))
+
+
+def test_return_many_returns_each_loan_once(member, make_book):
+    dune, emma = make_book('Dune', copies=1), make_book('Emma', copies=3)
+    loans = [Loan.create_loan(member, dune), Loan.create_loan(member, emma)]
+
+    outcomes = Loan.return_many(member, [str(loan.id) for loan in loans])
+
+    assert all(outcome.ok for outcome in outcomes) and len(outcomes) == 2
+    assert Loan.objects(returnDate=None).count() == 0
+    assert Book.objects.get(id=dune.id).available == 1
+    assert Book.objects.get(id=emma.id).available == 3
+
+
+def test_return_many_reports_unknown_foreign_and_returned_loans(member, make_book):
+    other = User(email='other@example.com', password='x', name='Other').save()
+    book = make_book(copies=3)
+    mine, returned = Loan.create_loan(member, book), Loan.create_loan(member, make_book('Emma'))
+    theirs = Loan.create_loan(other, Book.objects.get(id=book.id))
+    returned.return_loan()
+
+    outcomes = Loan.return_many(member, [str(mine.id), str(returned.id), str(theirs.id), 'not-an-id'])
+
+    assert outcome_of(outcomes, mine).ok
+    assert outcome_of(outcomes, returned).reason == 'already_returned'
+    assert outcome_of(outcomes, theirs).reason == 'not_found'
+    assert next(o for o in outcomes if o.loan_id == 'not-an-id').reason == 'not_found'
+    assert Loan.objects.get(id=theirs.id).returnDate is None
+
+
+def test_return_many_caps_the_copies_it_puts_back(member, make_book):
+    book = make_book(copies=2)
+    loan = Loan.create_loan(member, book)
+    Book.objects(id=book.id).update_one(set__available=2)
+
+    outcomes = Loan.return_many(member, [str(loan.id)])
+
+    assert outcomes[0].ok
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_return_many_leaves_a_loan_returned_concurrently_to_the_other_request(monkeypatch, member, make_book):
+    book = make_book(copies=2)
+    first, second = Loan.create_loan(member, book), Loan.create_loan(member, make_book('Emma'))
+    during_the_batch(monkeypatch, lambda: Loan.objects.get(id=first.id).return_loan())
+
+    outcomes = Loan.return_many(member, [str(first.id), str(second.id)])
+
+    assert outcome_of(outcomes, first).reason == 'already_returned'
+    assert outcome_of(outcomes, second).ok
+    # One copy back for the concurrent single return, none more for the batch
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_repeated_return_many_request_returns_nothing_twice(member, make_book):
+    book = make_book(copies=2)
+    loan = Loan.create_loan(member, book)
+    Loan.return_many(member, [str(loan.id)])
+
+    outcomes = Loan.return_many(member, [str(loan.id)])
+
+    assert outcomes[0].reason == 'already_returned'
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_renew_many_renews_and_applies_the_limit(member, make_book):
+    fresh, renewed_twice = Loan.create_loan(member, make_book('Dune')), Loan.create_loan(member, make_book('Emma'))
+    renewed_twice.renew_loan()
+    renewed_twice.renew_loan()
+
+    outcomes = Loan.renew_many(member, [str(fresh.id), str(renewed_twice.id)])
+
+    assert outcome_of(outcomes, fresh).ok
+    assert outcome_of(outcomes, renewed_twice).reason == 'renewal_limit'
+    assert Loan.objects.get(id=fresh.id).renewCount == 1
+
+
+def test_renew_many_does_not_renew_twice_when_raced(monkeypatch, member, make_book):
+    loan = Loan.create_loan(member, make_book())
+    during_the_batch(monkeypatch, lambda: Loan.objects.get(id=loan.id).renew_loan())
+
+    outcomes = Loan.renew_many(member, [str(loan.id)])
+
+    assert outcomes[0].reason == 'conflict'
+    assert Loan.objects.get(id=loan.id).renewCount == 1
+
+
+def test_batch_of_nothing_valid(member):
+    assert [o.reason for o in Loan.return_many(member, [str(ObjectId())])] == ['not_found']
+    assert Loan.renew_many(member, []) == []
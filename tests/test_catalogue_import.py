@@ -0,0 +1,58 @@
+"""Catalogue import: validation, insert/upsert by slug and the available/copies bookkeeping."""
+import pytest
+
+from app.catalogue_import import import_rows
+from app.model import Book
+
+
+def row(title, copies=2, **fields):
+    return dict({'title': title, 'authors': ['Author'], 'category': 'Adults', 'genres': ['Fiction'],
+                 'description': ['One.'], 'pages': 100, 'copies': copies}, **fields)
+
+
+def test_upsert_inserts_new_books_with_all_copies_available():
+    report = import_rows([row('Dune', copies=3), row('$100 Startup')])
+
+    assert (report.inserted, report.updated, report.rejected) == (2, 0, 0)
+    dune = Book.objects.get(slug='dune')
+    assert (dune.copies, dune.available) == (3, 3)
+    assert Book.objects.get(slug='100-startup').title == '$100 Startup'
+
+
+def test_upsert_updates_the_book_with_the_same_slug():
+    import_rows([row('Dune', pages=100)])
+
+    report = import_rows([row('Dune', pages=412)])
+
+    assert (report.inserted, report.updated) == (0, 1)
+    assert Book.objects.count() == 1
+    assert Book.objects.get(slug='dune').pages == 412
+
+
+@pytest.mark.parametrize('copies, available', [(5, 3), (3, 1), (1, 0)])
+def test_upsert_moves_available_by_the_change_in_copies(copies, available):
+    import_rows([row('Dune', copies=3)])
+    Book.objects(slug='dune').update_one(dec__available=2)  # two copies on loan
+
+    import_rows([row('Dune', copies=copies)])
+
+    dune = Book.objects.get(slug='dune')
+    assert (dune.copies, dune.available) == (copies, available)
+
+
+def test_invalid_rows_are_rejected_with_their_row_number():
+    report = import_rows([row('Dune'), {'title': 'No authors'}, {'unknown': 1}, ValueError('bad json')])
+
+    assert report.inserted == 1
+    assert [number for number, _ in report.rejects] == [2, 3, 4]
+
+
+def test_write_errors_are_reported_with_their_row_number(app):
+    from app.indexes import verify_indexes
+    verify_indexes(app, build=True, background=False)  # the unique slug index
+    import_rows([row('Dune')], mode='insert')
+
+    report = import_rows([row('Emma'), row('Dune'), row('Persuasion')], mode='insert')
+
+    assert report.inserted == 2
+    assert [number for number, _ in report.rejects] == [2]
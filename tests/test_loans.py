@@ -0,0 +1,145 @@
+"""Loan state machine: borrow, renew, return and delete, including stale and concurrent callers."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.model import Book, Loan, LoanError
+
+
+def reasons(excinfo):
+    return excinfo.value.reason
+
+
+def test_borrow_takes_a_copy(member, make_book):
+    book = make_book(copies=2)
+    loan = Loan.create_loan(member, book)
+
+    assert loan.active and loan.returnDate is None
+    assert loan.dueDate == loan.borrowDate + timedelta(weeks=2)
+    assert Book.objects.get(id=book.id).available == 1
+
+
+def test_second_borrow_of_the_same_book_is_refused_without_the_index(member, make_book):
+    book = make_book(copies=3)
+    Loan.create_loan(member, book)
+
+    with pytest.raises(LoanError) as excinfo:
+        Loan.create_loan(member, Book.objects.get(id=book.id))
+    assert reasons(excinfo) == 'already_borrowed'
+    assert Loan.objects(member=member, book=book, returnDate=None).count() == 1
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_borrow_of_an_unavailable_book_is_refused(member, make_book):
+    book = make_book(copies=1, available=0)
+
+    with pytest.raises(LoanError) as excinfo:
+        Loan.create_loan(member, book)
+    assert reasons(excinfo) == 'unavailable'
+    assert Loan.objects.count() == 0
+
+
+def test_renew_moves_the_dates_and_counts(member, make_book):
+    loan = Loan.create_loan(member, make_book(), borrow_date=datetime.utcnow() - timedelta(days=30))
+    borrowed = loan.borrowDate
+
+    loan.renew_loan()
+
+    stored = Loan.objects.get(id=loan.id)
+    assert stored.renewCount == 1
+    assert borrowed < stored.borrowDate <= datetime.utcnow()
+    assert stored.dueDate == stored.borrowDate + timedelta(weeks=2)
+
+
+def test_renewals_stop_at_two(member, make_book):
+    loan = Loan.create_loan(member, make_book())
+    loan.renew_loan()
+    loan.renew_loan()
+
+    with pytest.raises(LoanError) as excinfo:
+        loan.renew_loan()
+    assert reasons(excinfo) == 'renewal_limit'
+    assert Loan.objects.get(id=loan.id).renewCount == 2
+
+
+def test_stale_renewal_conflicts_instead_of_overwriting(member, make_book):
+    loan = Loan.create_loan(member, make_book())
+    first, second = Loan.objects.get(id=loan.id), Loan.objects.get(id=loan.id)
+
+    first.renew_loan()
+    with pytest.raises(LoanError) as excinfo:
+        second.renew_loan()
+    assert reasons(excinfo) == 'conflict'
+    assert Loan.objects.get(id=loan.id).renewCount == 1
+
+
+def test_renewal_of_a_loan_returned_meanwhile_conflicts(member, make_book):
+    loan = Loan.create_loan(member, make_book())
+    stale = Loan.objects.get(id=loan.id)
+    loan.return_loan()
+
+    with pytest.raises(LoanError) as excinfo:
+        stale.renew_loan()
+    assert reasons(excinfo) == 'conflict'
+
+
+def test_return_closes_the_loan_and_puts_the_copy_back(member, make_book):
+    book = make_book(copies=2)
+    loan = Loan.create_loan(member, book)
+
+    loan.return_loan()
+
+    stored = Loan.objects.get(id=loan.id)
+    assert stored.returnDate is not None and stored.active is False
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_second_return_of_the_same_loan_is_refused_once(member, make_book):
+    book = make_book(copies=2)
+    loan = Loan.create_loan(member, book)
+    stale = Loan.objects.get(id=loan.id)
+    loan.return_loan()
+
+    with pytest.raises(LoanError) as excinfo:
+        stale.return_loan()
+    assert reasons(excinfo) == 'already_returned'
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_return_with_a_drifted_counter_still_closes_the_loan(member, make_book):
+    book = make_book(copies=2)
+    loan = Loan.create_loan(member, book)
+    Book.objects(id=book.id).update_one(set__available=2)  # counter already shows every copy in
+
+    loan.return_loan()
+
+    assert Loan.objects.get(id=loan.id).returnDate is not None
+    assert Book.objects.get(id=book.id).available == 2
+
+
+def test_only_returned_loans_can_be_deleted(member, make_book):
+    loan = Loan.create_loan(member, make_book())
+    with pytest.raises(LoanError) as excinfo:
+        loan.delete_loan()
+    assert reasons(excinfo) == 'not_returned'
+
+    loan.return_loan()
+    loan.delete_loan()
+    assert Loan.objects.count() == 0
+
+
+def test_deleted_loan_is_not_archived_by_a_replayed_batch(member, make_book):
+    from app.model import ARCHIVE_FIELDS, LoanArchive
+
+    loan = Loan.create_loan(member, make_book(), borrow_date=datetime.utcnow() - timedelta(days=200))
+    loan.return_loan()
+    Loan.objects(id=loan.id).update_one(set__returnDate=datetime.utcnow() - timedelta(days=180))
+    read_by_archiver = Loan._get_collection().find_one({'_id': loan.id}, dict.fromkeys(ARCHIVE_FIELDS, 1))
+
+    Loan.objects.get(id=loan.id).delete_loan()
+    # The archiver's upsert of the batch it read before the delete
+    LoanArchive._get_collection().update_one({'_id': loan.id}, {'$setOnInsert': read_by_archiver}, upsert=True)
+    Loan.archive_returned(timedelta(days=90))
+
+    rows, _ = Loan.get_member_history(member)
+    assert rows == []
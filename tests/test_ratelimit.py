@@ -0,0 +1,103 @@
+"""Rate limiting: token buckets, the per-scope keys of a request and the refund of a refused request."""
+import flask_login
+import pytest
+
+from app.ratelimit import UNKNOWN_CLIENT, MemoryBuckets, limiter
+
+RULE = {'ip': (2, 60), 'user': (5, 60), 'methods': ('POST',)}
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    buckets = MemoryBuckets()
+    monkeypatch.setattr(limiter, 'backend', buckets)
+    monkeypatch.setattr(limiter, 'rules', {'login': RULE})
+    return buckets
+
+
+def admit(app, remote_addr='10.0.0.1', user=None, method='POST'):
+    with app.test_request_context('/login', method=method, environ_base={'REMOTE_ADDR': remote_addr}):
+        if user is not None:
+            flask_login.login_user(user)
+        return limiter._admit()
+
+
+def tokens(buckets, key):
+    return buckets._buckets[key][0]
+
+
+def test_bucket_refuses_once_empty_and_says_how_long_to_wait():
+    buckets = MemoryBuckets()
+
+    assert [buckets.take('k', 2, 60) for _ in range(2)] == [0, 0]
+    assert 0 < buckets.take('k', 2, 60) <= 30
+
+
+def test_bucket_refills_over_its_period(monkeypatch):
+    buckets, now = MemoryBuckets(), [100.0]
+    monkeypatch.setattr('app.ratelimit.time.monotonic', lambda: now[0])
+    buckets.take('k', 2, 60)
+    buckets.take('k', 2, 60)
+
+    now[0] += 30
+    assert buckets.take('k', 2, 60) == 0
+    assert buckets.take('k', 2, 60) > 0
+
+
+def test_refund_gives_a_token_back_up_to_capacity():
+    buckets = MemoryBuckets()
+    buckets.take('k', 2, 60)
+
+    buckets.refund('k', 2, 60)
+    buckets.refund('k', 2, 60)
+    buckets.refund('missing', 2, 60)
+
+    assert tokens(buckets, 'k') == 2
+    assert 'missing' not in buckets._buckets
+
+
+def test_least_recently_used_buckets_are_dropped():
+    buckets = MemoryBuckets(maxsize=2)
+    for key in ('a', 'b', 'a', 'c'):
+        buckets.take(key, 2, 60)
+
+    assert list(buckets._buckets) == ['a', 'c']
+
+
+def test_requests_without_an_address_share_one_bucket(app, buckets):
+    assert admit(app, remote_addr=None) is None
+    assert admit(app, remote_addr=None) is None
+
+    refused = admit(app, remote_addr=None)
+
+    assert refused.status_code == 429
+    assert f'login:ip:{UNKNOWN_CLIENT}' in buckets._buckets
+    assert admit(app, remote_addr='10.0.0.2') is None
+
+
+def test_refused_request_gets_retry_after(app, buckets):
+    admit(app)
+    admit(app)
+
+    refused = admit(app)
+
+    assert refused.status_code == 429
+    assert int(refused.headers['Retry-After']) >= 1
+
+
+def test_request_refused_by_its_address_gives_the_user_token_back(app, buckets, member):
+    admit(app, user=member)
+    admit(app, user=member)
+    user_key = f'login:user:{member.get_id()}'
+    before = tokens(buckets, user_key)
+
+    refused = admit(app, user=member)
+
+    assert refused.status_code == 429
+    assert tokens(buckets, user_key) == pytest.approx(before, abs=0.01)
+
+
+def test_methods_outside_the_rule_are_not_counted(app, buckets):
+    for _ in range(5):
+        assert admit(app, method='GET') is None
+    assert buckets._buckets == {}